@@ -0,0 +1,36 @@
+"""Decode throughput: the per-call reference parser vs iflame_codec (single and batch).
+
+    python bench/codec_bench.py [-n 200000] [--distinct 500]
+"""
+import argparse, json, os, random, sys, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, "..", "src"), os.path.join(HERE, "..", "tests")]
+import iflame_codec as codec
+import codec_reference as ref
+
+
+def rate(fn, n):
+    t0 = time.perf_counter()
+    fn()
+    return round(n / (time.perf_counter() - t0))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=200000)
+    ap.add_argument("--distinct", type=int, default=500, help="distinct commands in the archive")
+    args = ap.parse_args()
+
+    rng = random.Random(0)
+    pool = [ref.random_cmd(rng) for _ in range(args.distinct)]
+    pool = [c for c in pool if len(c.split(":")) in (5, 6)]
+    cmds = [rng.choice(pool) for _ in range(args.n)]
+
+    print(json.dumps({
+        "commands": args.n,
+        "numpy": codec.np is not None,
+        "reference_per_sec": rate(lambda: [ref.parse_cmd_string(c) for c in cmds], args.n),
+        "decode_per_sec": rate(lambda: [codec.decode(c) for c in cmds], args.n),
+        "decode_columns_per_sec": rate(lambda: codec.decode_columns(cmds), args.n),
+    }, indent=2))
@@ -0,0 +1,364 @@
+"""In-process stand-ins for everything the bridge talks to: Cognito, the iot-data REST
+API, the AWS IoT MQTT connection (with a simulated hub) and the HA MQTT broker.
+
+install() patches them into an imported bridge module; nothing leaves the process.
+"""
+import copy, io, json, os, sys, threading, time
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+FAKE_ENV = {
+    "COGNITO_POOL_ID": "us-east-1_bench", "COGNITO_CLIENT_ID": "bench", "COGNITO_CLIENT_SECRET": "bench",
+    "COGNITO_IDENTITY_POOL": "us-east-1:bench", "IOT_ENDPOINT": "bench-ats.iot.us-east-1.amazonaws.com",
+    "IOT_THING_NAME": "RFF-BENCH01", "IFLAME_EMAIL": "bench@example.com", "IFLAME_PASSWORD": "bench",
+    "HA_MQTT_HOST": "127.0.0.1", "HA_MQTT_USER": "bench", "HA_MQTT_PASS": "bench",
+    "CRED_CACHE_PATH": "", "HISTORY_DIR": "", "STATE_SNAPSHOT_PATH": "",
+}
+
+
+def import_bridge(**env):
+    """Import the bridge with a fake environment (never the real .env credentials)."""
+    os.environ.update(FAKE_ENV)
+    os.environ.update({k: str(v) for k, v in env.items()})
+    if SRC not in sys.path:
+        sys.path.insert(0, SRC)
+    import flametech_mqtt_bridge
+    return flametech_mqtt_bridge
+
+
+def _resolved(value=None):
+    f = Future()
+    f.set_result(value)
+    return f
+
+
+class Latency:
+    """Fixed delay plus optional jitter, in seconds."""
+
+    def __init__(self, base=0.0, jitter=0.0):
+        self.base, self.jitter = base, jitter
+
+    def sleep(self):
+        import random
+        d = self.base + (random.random() * self.jitter if self.jitter else 0)
+        if d > 0:
+            time.sleep(d)
+
+
+# ── AWS side ──
+
+class FakeThing:
+    """A thing shadow plus the hub behind it.
+
+    Accepting an update bumps the version and emits accepted/documents/delta; after
+    hub_latency the hub "applies" the command: reported.CID follows desired.CID and
+    reported.ST1 becomes the smart target (0 for simple commands).
+    """
+
+    def __init__(self, name, ambient=70.0, hub_latency=0.5):
+        self.name = name
+        self.hub_latency = hub_latency
+        self.lock = threading.Lock()
+        self.doc = {
+            "state": {
+                "desired": {"CID": "100", "CMD_LST": {"CMD_steps": [{"C": "2:0:1:192:34", "D": 0.2}]}},
+                "reported": {"AT": ambient, "ST1": 0, "CID": "100"},
+            },
+            "version": 1,
+        }
+        self.updates = 0
+
+    def snapshot(self):
+        with self.lock:
+            return copy.deepcopy(self.doc)
+
+    def update(self, desired, client_token=None):
+        """Apply a desired-state update; returns the messages the broker would emit."""
+        with self.lock:
+            previous = copy.deepcopy(self.doc)
+            self.doc["state"]["desired"].update(desired)
+            self.doc["version"] += 1
+            self.updates += 1
+            current = copy.deepcopy(self.doc)
+        accepted = {"state": {"desired": desired}, "version": current["version"], "timestamp": int(time.time())}
+        if client_token:
+            accepted["clientToken"] = client_token
+        return [
+            ("update/accepted", accepted),
+            ("update/documents", {"previous": previous, "current": current, "timestamp": int(time.time())}),
+            ("update/delta", {"state": desired, "version": current["version"], "timestamp": int(time.time())}),
+        ]
+
+    def hub_apply(self):
+        """The hub reacts to the latest desired state."""
+        with self.lock:
+            previous = copy.deepcopy(self.doc)
+            d, r = self.doc["state"]["desired"], self.doc["state"]["reported"]
+            cmd = d.get("CMD_LST", {}).get("CMD_steps", [{}])[0].get("C", "")
+            parts = cmd.split(":")
+            r["ST1"] = int(parts[3]) if len(parts) == 6 else 0
+            r["CID"] = d.get("CID")
+            self.doc["version"] += 1
+            current = copy.deepcopy(self.doc)
+        return [("update/documents", {"previous": previous, "current": current, "timestamp": int(time.time())})]
+
+    def set_ambient(self, at):
+        with self.lock:
+            previous = copy.deepcopy(self.doc)
+            self.doc["state"]["reported"]["AT"] = at
+            self.doc["version"] += 1
+            current = copy.deepcopy(self.doc)
+        return [("update/documents", {"previous": previous, "current": current, "timestamp": int(time.time())})]
+
+
+class FakeAws:
+    """Shared fake AWS account: things, REST latency, MQTT latency and call counters."""
+
+    def __init__(self, things, rest_latency=None, puback_latency=None, push_latency=None):
+        self.things = {t.name: t for t in things}
+        self.rest_latency = rest_latency or Latency()
+        self.puback_latency = puback_latency or Latency()
+        self.push_latency = push_latency or Latency()
+        self.calls = {"get_thing_shadow": 0, "publish": 0, "connect": 0, "cognito_auth": 0,
+                      "cognito_refresh": 0, "get_id": 0, "get_credentials_for_identity": 0}
+        self.connections = []
+        self._timers = []
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def emit(self, thing, messages, delay=0.0):
+        """Deliver shadow messages to every connection subscribed to them."""
+        def deliver():
+            for suffix, body in messages:
+                topic = f"$aws/things/{thing.name}/shadow/{suffix}"
+                payload = json.dumps(body).encode()
+                for conn in list(self.connections):
+                    conn.deliver(topic, payload)
+        if delay > 0:
+            t = threading.Timer(delay, deliver)
+            t.daemon = True
+            t.start()
+        else:
+            deliver()
+
+    # boto3-style clients
+
+    def client(self, name):
+        aws = self
+        if name == "iot-data":
+            def get_thing_shadow(thingName):
+                aws.count("get_thing_shadow")
+                aws.rest_latency.sleep()
+                return {"payload": io.BytesIO(json.dumps(aws.things[thingName].snapshot()).encode())}
+            return SimpleNamespace(get_thing_shadow=get_thing_shadow)
+        if name == "cognito-identity":
+            def get_id(**kwargs):
+                aws.count("get_id")
+                return {"IdentityId": "us-east-1:bench-identity"}
+
+            def get_credentials_for_identity(**kwargs):
+                aws.count("get_credentials_for_identity")
+                return {"Credentials": {"AccessKeyId": "AKIABENCH", "SecretKey": "bench", "SessionToken": "bench",
+                                        "Expiration": time.time() + 3600}}
+            return SimpleNamespace(get_id=get_id, get_credentials_for_identity=get_credentials_for_identity)
+        return SimpleNamespace(attach_policy=lambda **kwargs: None)
+
+    def cognito_class(self):
+        aws = self
+
+        class FakeCognito:
+            def __init__(self, *args, refresh_token=None, **kwargs):
+                self.refresh_token = refresh_token
+                self.id_token = self.access_token = None
+
+            def authenticate(self, password):
+                aws.count("cognito_auth")
+                self.id_token, self.access_token, self.refresh_token = "id", "access", "refresh"
+
+            def renew_access_token(self):
+                aws.count("cognito_refresh")
+                self.id_token, self.access_token = "id", "access"
+        return FakeCognito
+
+    def connection_builder(self):
+        aws = self
+
+        def websockets_with_default_aws_signing(**kwargs):
+            conn = FakeAwsConnection(aws, kwargs)
+            aws.connections.append(conn)
+            return conn
+        return SimpleNamespace(websockets_with_default_aws_signing=websockets_with_default_aws_signing)
+
+
+class FakeAwsConnection:
+    """Just enough of awscrt.mqtt.Connection for the bridge."""
+
+    def __init__(self, aws, kwargs):
+        self.aws = aws
+        self.kwargs = kwargs
+        self.subscriptions = {}
+
+    def connect(self):
+        self.aws.count("connect")
+        return _resolved({"session_present": False})
+
+    def disconnect(self):
+        if self in self.aws.connections:
+            self.aws.connections.remove(self)
+        return _resolved()
+
+    def subscribe(self, topic, qos, callback=None):
+        self.subscriptions[topic] = callback
+        return _resolved({"topic": topic, "qos": qos}), 1
+
+    def resubscribe_existing_topics(self):
+        return _resolved({"topics": list(self.subscriptions)})
+
+    def deliver(self, topic, payload):
+        callback = self.subscriptions.get(topic)
+        if callback is not None:
+            callback(topic=topic, payload=payload, dup=False, qos=1, retain=False)
+
+    def publish(self, topic, payload, qos, retain=False):
+        self.aws.count("publish")
+        # $aws/things/<thing>/shadow/update
+        thing = self.aws.things[topic.split("/")[2]]
+        body = json.loads(payload)
+        messages = thing.update(body.get("state", {}).get("desired", {}), body.get("clientToken"))
+        self.aws.puback_latency.sleep()
+        push = self.aws.push_latency.base
+        self.aws.emit(thing, messages, delay=push)
+        self._schedule_hub(thing, push + thing.hub_latency)
+        return _resolved({"packet_id": 1}), 1
+
+    def _schedule_hub(self, thing, delay):
+        def apply():
+            self.aws.emit(thing, thing.hub_apply())
+        t = threading.Timer(delay, apply)
+        t.daemon = True
+        t.start()
+
+
+# ── HA side ──
+
+class FakeHaBroker:
+    """A tiny in-process MQTT broker: retained messages, exact/+/# topic filters."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.retained = {}
+        self.clients = []
+        self.log = []  # (time, topic, payload)
+        self.listeners = []
+
+    @staticmethod
+    def matches(pattern, topic):
+        p, t = pattern.split("/"), topic.split("/")
+        for i, part in enumerate(p):
+            if part == "#":
+                return True
+            if i >= len(t) or (part != "+" and part != t[i]):
+                return False
+        return len(p) == len(t)
+
+    def route(self, sender, topic, payload, retain):
+        payload = payload if isinstance(payload, bytes) else str(payload).encode()
+        with self.lock:
+            self.log.append((time.perf_counter(), topic, payload))
+            if retain:
+                self.retained[topic] = payload
+            targets = [(c, f) for c in self.clients for f in c.filters if self.matches(f, topic)]
+            listeners = list(self.listeners)
+        for client, _ in targets:
+            client.deliver(topic, payload)
+        for listener in listeners:
+            listener(topic, payload)
+
+    def client(self, *args, **kwargs):
+        c = FakeHaClient(self)
+        with self.lock:
+            self.clients.append(c)
+        return c
+
+    def inject(self, topic, payload):
+        """Publish as Home Assistant would (a command from the UI)."""
+        self.route(None, topic, payload, retain=False)
+
+    def paho_module(self):
+        broker = self
+        return SimpleNamespace(Client=lambda *a, **k: broker.client(*a, **k),
+                               CallbackAPIVersion=SimpleNamespace(VERSION2=2))
+
+
+class FakeHaClient:
+    """Just enough of paho.mqtt.client.Client for the bridge."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.filters = set()
+        self.on_connect = self.on_message = None
+
+    def username_pw_set(self, *args):
+        pass
+
+    def will_set(self, *args, **kwargs):
+        pass
+
+    def connect(self, host, port=1883, *args, **kwargs):
+        return 0
+
+    def loop_start(self):
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0, None)
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def is_connected(self):
+        return True
+
+    def subscribe(self, topic, qos=0):
+        filters = [f for f, _ in topic] if isinstance(topic, list) else [topic]
+        with self.broker.lock:
+            self.filters.update(filters)
+            retained = [(t, p) for t, p in self.broker.retained.items()
+                        if any(self.broker.matches(f, t) for f in filters)]
+        for t, p in retained:
+            self.deliver(t, p)
+        return 0, 1
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.broker.route(self, topic, payload if payload is not None else b"", retain)
+        return SimpleNamespace(rc=0, mid=1, wait_for_publish=lambda *a, **k: None)
+
+    def deliver(self, topic, payload):
+        if self.on_message:
+            self.on_message(self, None, SimpleNamespace(topic=topic, payload=payload, qos=0, retain=False))
+
+
+def install(bridge, aws, broker):
+    """Point the bridge at the fakes (module attributes only; the fakes stay in-process)."""
+    bridge.Cognito = aws.cognito_class()
+    bridge.aws_client = aws.client
+    bridge.mqtt_connection_builder = aws.connection_builder()
+    bridge.paho_mqtt = broker.paho_module()
+    bridge.save_cred_cache = lambda: None
+
+
+def start(bridge, aws, broker):
+    """Bring the bridge up the way __main__ does, minus the HTTP server."""
+    install(bridge, aws, broker)
+    bridge.refresh_creds()
+    bridge.setup_ha_mqtt()
+    bridge._startup_grace = 0
+    for fp in bridge.DEVICES:
+        threading.Thread(target=bridge.command_worker, args=(fp,), daemon=True).start()
+    if bridge.SHADOW_PUSH:
+        bridge.get_aws_conn()
+    bridge.poll_all(fresh=True)
@@ -0,0 +1,136 @@
+"""Offline end-to-end benchmark: the real bridge code against in-process fakes (bench/fakes.py).
+
+No AWS account, Cognito pool or MQTT broker is needed; latencies are simulated, so
+numbers compare code paths between commits rather than predict field latency.
+
+    python bench/offline_bench.py [-n 30] [--rest-ms 80] [--puback-ms 40] [--push-ms 60]
+                                  [--hub-ms 500] [--out bench/results] [--compare OLD.json]
+
+Results go to <out>/<timestamp>-<git sha>.json; --compare prints the p50/p95 delta
+against an earlier result file.
+"""
+import argparse, json, os, statistics, subprocess, time
+
+import fakes
+
+
+def percentiles(samples):
+    s = sorted(samples)
+    n = len(s)
+    pick = lambda q: round(s[min(n - 1, int(n * q))], 1)
+    return {"n": n, "mean_ms": round(statistics.mean(s), 1), "p50_ms": pick(0.50),
+            "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": round(s[-1], 1)}
+
+
+def timed(fn, n):
+    samples = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return percentiles(samples)
+
+
+def wait_for_status(bridge, broker, fp, pred, since, timeout=10.0):
+    """Time (ms, from `since`) at which HA first saw a status payload matching pred."""
+    topic = fp.topic(bridge.TOPIC_STATE)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with broker.lock:
+            hits = [t for t, tp, p in broker.log if tp == topic and t >= since and pred(json.loads(p))]
+        if hits:
+            return (hits[0] - since) * 1000
+        time.sleep(0.005)
+    raise TimeoutError(f"no matching {topic} within {timeout}s")
+
+
+def slider_burst(bridge, broker, fp, aws, steps, spacing):
+    """Drag the HA fan slider: `steps` values `spacing` seconds apart; time to final state."""
+    topic = fp.topic(bridge.TOPIC_FAN_CMD)
+    values = [(i % 6) + 1 for i in range(steps)]
+    final = values[-1]
+    before = aws.calls["publish"]
+    t0 = time.perf_counter()
+    for v in values:
+        broker.inject(topic, str(v).encode())
+        time.sleep(spacing)
+    ms = wait_for_status(bridge, broker, fp, lambda st: st.get("fan") == final, t0)
+    # let the coalescing window / worker settle before counting publishes
+    time.sleep(bridge.COMMAND_COALESCE_SECS + 0.2)
+    return ms, aws.calls["publish"] - before
+
+
+def git_sha():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)), text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(current, path):
+    with open(path) as f:
+        old = json.load(f)["scenarios"]
+    for name, cur in current.items():
+        if name not in old or "p50_ms" not in cur:
+            continue
+        d50 = cur["p50_ms"] - old[name]["p50_ms"]
+        d95 = cur["p95_ms"] - old[name]["p95_ms"]
+        print(f"{name:24s} p50 {cur['p50_ms']:8.1f}ms ({d50:+.1f})   p95 {cur['p95_ms']:8.1f}ms ({d95:+.1f})")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=30, help="iterations per scenario")
+    ap.add_argument("--smart-n", type=int, default=5, help="iterations for do_smart (sleeps 3s each)")
+    ap.add_argument("--bursts", type=int, default=5)
+    ap.add_argument("--rest-ms", type=float, default=80)
+    ap.add_argument("--puback-ms", type=float, default=40)
+    ap.add_argument("--push-ms", type=float, default=60)
+    ap.add_argument("--hub-ms", type=float, default=500)
+    ap.add_argument("--jitter-ms", type=float, default=20)
+    ap.add_argument("--out", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "results"))
+    ap.add_argument("--compare")
+    args = ap.parse_args()
+
+    bridge = fakes.import_bridge()
+    j = args.jitter_ms / 1000
+    aws = fakes.FakeAws([fakes.FakeThing(fp.thing, hub_latency=args.hub_ms / 1000) for fp in bridge.DEVICES],
+                        rest_latency=fakes.Latency(args.rest_ms / 1000, j),
+                        puback_latency=fakes.Latency(args.puback_ms / 1000, j),
+                        push_latency=fakes.Latency(args.push_ms / 1000))
+    broker = fakes.FakeHaBroker()
+    fakes.start(bridge, aws, broker)
+    fp = bridge.DEVICES[0]
+    api = bridge.app.test_client()
+
+    scenarios = {}
+    scenarios["do_on"] = timed(lambda: bridge.run_command(fp, bridge.do_on), args.n)
+    scenarios["do_set_fan"] = timed(lambda: bridge.run_command(fp, bridge.do_set_fan, 3), args.n)
+    scenarios["do_smart"] = timed(lambda: bridge.run_command(fp, bridge.do_smart, 72), args.smart_n)
+    scenarios["status_cached"] = timed(lambda: api.get("/status"), args.n)
+    scenarios["status_fresh"] = timed(lambda: api.get("/status?fresh=1"), args.n)
+
+    burst_ms, burst_pubs = [], []
+    for _ in range(args.bursts):
+        ms, pubs = slider_burst(bridge, broker, fp, aws, steps=10, spacing=0.03)
+        burst_ms.append(ms)
+        burst_pubs.append(pubs)
+    scenarios["slider_burst"] = {**percentiles(burst_ms), "aws_publishes_per_burst": round(statistics.mean(burst_pubs), 1)}
+
+    result = {
+        "sha": git_sha(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "latency_ms": {"rest": args.rest_ms, "puback": args.puback_ms, "push": args.push_ms,
+                       "hub": args.hub_ms, "jitter": args.jitter_ms},
+        "aws_calls": dict(aws.calls),
+        "scenarios": scenarios,
+    }
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"{time.strftime('%Y%m%d-%H%M%S')}-{result['sha']}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+    print(f"Saved {path}")
+    if args.compare:
+        compare(scenarios, args.compare)
@@ -0,0 +1,179 @@
+"""Replay a recorded session against the real bridge code and in-process fakes (bench/fakes.py).
+
+Record on the Pi with RECORD_PATH=/path/session.jsonl (see .env.example), copy the file
+over, then:
+
+    python bench/replay.py session.jsonl [--speed 10] [--hub-ms 500] [--push-ms 60]
+                                         [--out bench/results]
+
+The recorded HA commands are injected at their original spacing divided by --speed
+(0 = no waiting at all). Commands someone else sent (app, wall remote) and ambient
+changes are replayed into the fake shadow. The fake REST and PUBACK latencies are
+the recorded medians. The report compares the recording with the replay on:
+  - HA command -> next AWS publish latency for that unit (p50/p95/p99)
+  - AWS calls: shadow update publishes and get_thing_shadow reads
+  - the final status published to HA for each unit (exit status 1 on a mismatch)
+
+Coalescing windows, sleeps and timeouts are not scaled, so at --speed > 1 bursts that
+were separate in the recording can merge; compare replays at the same speed.
+"""
+import argparse, collections, json, os, statistics, sys, threading, time
+
+import fakes
+from offline_bench import git_sha, percentiles
+
+IGNORED_FIELDS = ("cid",)  # CIDs follow the number of publishes, compared separately
+
+
+class ReplayThing(fakes.FakeThing):
+    """FakeThing that timestamps every update the bridge publishes (they carry a clientToken)."""
+
+    def __init__(self, name, hub_latency):
+        super().__init__(name, hub_latency=hub_latency)
+        self.publishes = []
+
+    def update(self, desired, client_token=None):
+        if client_token is not None:
+            self.publishes.append(time.time())
+        return super().update(desired, client_token)
+
+
+def load(path):
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    # A file appended to across restarts holds several sessions; replay the last one
+    starts = [i for i, e in enumerate(events) if e["k"] == "start"]
+    if not starts:
+        raise SystemExit(f"{path}: no start record")
+    return events[starts[-1]], events[starts[-1] + 1:]
+
+
+def command_latencies(commands, publishes, window=30.0):
+    """ms from each HA command to the next publish for its unit; None when none follows."""
+    out = []
+    for t in commands:
+        nxt = next((p for p in publishes if p >= t), None)
+        out.append((nxt - t) * 1000 if nxt is not None and nxt - t <= window else None)
+    return out
+
+
+def summarize(latencies):
+    matched = [ms for ms in latencies if ms is not None]
+    summary = percentiles(matched) if matched else {"n": 0}
+    summary["without_publish"] = len(latencies) - len(matched)
+    return summary
+
+
+def median(values, default):
+    return statistics.median(values) if values else default
+
+
+def replay(header, events, args):
+    things = [spec.partition(":")[0].strip() for spec in header["things"]]
+    bridge = fakes.import_bridge(IOT_THING_NAMES=",".join(header["things"]))
+    by_kind = collections.defaultdict(list)
+    for e in events:
+        by_kind[e["k"]].append(e)
+
+    replay_things = {name: ReplayThing(name, args.hub_ms / 1000) for name in things}
+    for e in by_kind["shadow"]:
+        replay_things[e["d"]].doc = e["s"]
+    rest_ms = median([e["ms"] for e in by_kind["fetch"]], 80)
+    puback_ms = median([e["ms"] for e in by_kind["pub"] if e["ok"]], 40)
+    aws = fakes.FakeAws(list(replay_things.values()), rest_latency=fakes.Latency(rest_ms / 1000),
+                        puback_latency=fakes.Latency(puback_ms / 1000),
+                        push_latency=fakes.Latency(args.push_ms / 1000))
+    broker = fakes.FakeHaBroker()
+    fakes.start(bridge, aws, broker)
+    threading.Thread(target=bridge.poll_loop, daemon=True).start()
+    devices = {fp.thing: fp for fp in bridge.DEVICES}
+    base_calls = dict(aws.calls)
+
+    injected = collections.defaultdict(list)
+    t_rec0 = events[0]["t"] if events else 0
+    t0 = time.time()
+    for e in events:
+        if args.speed > 0:
+            delay = t0 + (e["t"] - t_rec0) / args.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        thing = replay_things.get(e.get("d"))
+        if e["k"] == "ha":
+            injected[e["d"]].append(time.time())
+            broker.inject(devices[e["d"]].topic(e["topic"]), e["p"].encode())
+        elif e["k"] == "ext":
+            desired = {"CID": e["cid"], "CMD_LST": {"CMD_steps": [{"C": e["cmd"], "D": 0.2}]}}
+            aws.emit(thing, thing.update(desired), delay=args.push_ms / 1000)
+            apply = threading.Timer(args.push_ms / 1000 + thing.hub_latency, lambda th=thing: aws.emit(th, th.hub_apply()))
+            apply.daemon = True
+            apply.start()
+        elif e["k"] == "at":
+            aws.emit(thing, thing.set_ambient(e["at"]), delay=args.push_ms / 1000)
+
+    # Let coalescing windows, command workers and hub confirmations finish
+    time.sleep(bridge.COMMAND_COALESCE_SECS + args.hub_ms / 1000 + args.push_ms / 1000 + 0.5)
+    bridge.drain_commands(30)
+    time.sleep(args.hub_ms / 1000 + 0.5)
+
+    report = {"sha": git_sha(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "recording": args.recording,
+              "speed": args.speed, "events": {k: len(v) for k, v in sorted(by_kind.items())},
+              "fake_latency_ms": {"rest": rest_ms, "puback": puback_ms, "push": args.push_ms, "hub": args.hub_ms},
+              "command_to_publish_ms": {}, "aws_calls": {}, "final_state": {}}
+
+    rec_lat, rep_lat = [], []
+    for name in things:
+        rec_pubs = sorted(e["t"] - e["ms"] / 1000 for e in by_kind["pub"] if e["d"] == name)
+        rec_lat += command_latencies([e["t"] for e in by_kind["ha"] if e["d"] == name], rec_pubs)
+        rep_lat += command_latencies(injected[name], replay_things[name].publishes)
+    report["command_to_publish_ms"] = {"recorded": summarize(rec_lat), "replay": summarize(rep_lat)}
+
+    report["aws_calls"] = {
+        "publish": {"recorded": len(by_kind["pub"]), "replay": aws.calls["publish"] - base_calls["publish"]},
+        "get_thing_shadow": {"recorded": len(by_kind["fetch"]),
+                             "replay": aws.calls["get_thing_shadow"] - base_calls["get_thing_shadow"]},
+    }
+
+    mismatches = 0
+    for name in things:
+        recorded = next((e["s"] for e in reversed(by_kind["state"]) if e["d"] == name), None)
+        fp = devices[name]
+        with broker.lock:
+            payload = broker.retained.get(fp.topic(bridge.TOPIC_STATE))
+        final = json.loads(payload) if payload else None
+        if recorded is None:
+            report["final_state"][name] = {"match": None, "replay": final}
+            continue
+        diff = {k: [recorded.get(k), (final or {}).get(k)] for k in sorted(set(recorded) | set(final or {}))
+                if k not in IGNORED_FIELDS and recorded.get(k) != (final or {}).get(k)}
+        mismatches += bool(diff)
+        report["final_state"][name] = {"match": not diff, "diff": diff}
+    return report, mismatches
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("recording")
+    ap.add_argument("--speed", type=float, default=1.0, help="1 = real time, 10 = ten times faster, 0 = no waits")
+    ap.add_argument("--hub-ms", type=float, default=500)
+    ap.add_argument("--push-ms", type=float, default=60)
+    ap.add_argument("--out", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "results"))
+    args = ap.parse_args()
+
+    header, events = load(args.recording)
+    report, mismatches = replay(header, events, args)
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"replay-{time.strftime('%Y%m%d-%H%M%S')}-{report['sha']}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    print(f"Saved {path}")
+    calls = report["aws_calls"]["publish"]
+    if calls["replay"] > calls["recorded"]:
+        print(f"More shadow publishes than recorded: {calls['replay']} vs {calls['recorded']}")
+    if mismatches:
+        print(f"Final state differs from the recording for {mismatches} unit(s)")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
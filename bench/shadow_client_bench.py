@@ -0,0 +1,52 @@
+"""Per-call get_thing_shadow latency: a new boto3 client per call vs the shared client.
+
+Uses the real account from .env (read-only: it only fetches the shadow).
+
+    python bench/shadow_client_bench.py [-n 20]
+"""
+import argparse, json, os, statistics, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import flametech_mqtt_bridge as bridge
+
+
+THING = bridge.DEVICES[0].thing
+
+
+def per_call_client():
+    # What get_shadow() did before the client registry
+    iot_data = bridge.iot_session.client("iot-data", endpoint_url=f"https://{bridge.IOT_EP}")
+    return iot_data.get_thing_shadow(thingName=THING)["payload"].read()
+
+
+def shared_client():
+    return bridge.aws_client("iot-data").get_thing_shadow(thingName=THING)["payload"].read()
+
+
+def measure(fn, n):
+    samples = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return {
+        "n": n,
+        "mean_ms": round(statistics.mean(samples), 1),
+        "p50_ms": round(samples[len(samples) // 2], 1),
+        "p95_ms": round(samples[min(n - 1, int(n * 0.95))], 1),
+        "max_ms": round(samples[-1], 1),
+    }
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=20)
+    args = ap.parse_args()
+
+    bridge.ensure_creds()
+    shared_client()  # warm the pool so "after" measures steady state
+    print(json.dumps({
+        "before_new_client_per_call": measure(per_call_client, args.n),
+        "after_shared_client": measure(shared_client, args.n),
+    }, indent=2))
@@ -1,12 +1,40 @@
-import boto3, json, time, threading, os
-from flask import Flask, jsonify, request
+import asyncio, base64, bisect, boto3, collections, copy, functools, hashlib, itertools, json, queue, re, signal, socket, time, threading, os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from flask import Flask, Response, has_request_context, jsonify, request
+from werkzeug.serving import make_server
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError
 from pycognito import Cognito
 from awsiot import mqtt_connection_builder
 from awscrt import mqtt as awsmqtt, auth
+from awscrt.exceptions import AwsCrtError
 import paho.mqtt.client as paho_mqtt
 from dotenv import load_dotenv
+import iflame_codec as codec
+from iflame_history import HistoryStore, FIELDS as HISTORY_FIELDS
+from iflame_budget import CircuitBreaker, LatencyWindow, TokenBucket, backoff
 import logging
 
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
+try:
+    from waitress.server import create_server
+except ImportError:
+    create_server = None
+
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
+
+try:
+    import iflame_aio as aio
+except ImportError:
+    aio = None
+
 load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.env'))
 
 logging.basicConfig(level=logging.INFO)
@@ -19,7 +47,6 @@ CLIENT_SECRET = os.environ["COGNITO_CLIENT_SECRET"]
 IDENTITY_POOL = os.environ["COGNITO_IDENTITY_POOL"]
 IOT_EP = os.environ["IOT_ENDPOINT"]
 R = os.environ.get("AWS_REGION", "us-east-1")
-THING = os.environ["IOT_THING_NAME"]
 EMAIL = os.environ["IFLAME_EMAIL"]
 IFLAME_PW = os.environ["IFLAME_PASSWORD"]
 
@@ -28,87 +55,1421 @@ HA_MQTT_HOST = os.environ.get("HA_MQTT_HOST", "192.168.42.5")
 HA_MQTT_PORT = int(os.environ.get("HA_MQTT_PORT", "1883"))
 HA_MQTT_USER = os.environ["HA_MQTT_USER"]
 HA_MQTT_PASS = os.environ["HA_MQTT_PASS"]
-TOPIC_STATE = "fireplace/status"
-TOPIC_CMD = "fireplace/set"
+# Bridge-wide availability (LWT); the per-device topics below hang off Fireplace.prefix
 TOPIC_AVAIL = "fireplace/available"
-TOPIC_CLIMATE_MODE_CMD = "fireplace/climate/mode/set"
-TOPIC_CLIMATE_TEMP_CMD = "fireplace/climate/temp/set"
-TOPIC_CLIMATE_STATE = "fireplace/climate/state"
-TOPIC_FAN_CMD = "fireplace/fan/set"
-TOPIC_FLAME_CMD = "fireplace/flame/set"
-TOPIC_SPLIT_CMD = "fireplace/split/set"
-TOPIC_EMBER_CMD = "fireplace/ember/set"
-TOPIC_OVERHEAD_CMD = "fireplace/overhead/set"
+TOPIC_STATE = "status"
+TOPIC_CMD = "set"
+TOPIC_CLIMATE_MODE_CMD = "climate/mode/set"
+TOPIC_CLIMATE_TEMP_CMD = "climate/temp/set"
+TOPIC_CLIMATE_STATE = "climate/state"
+TOPIC_FAN_CMD = "fan/set"
+TOPIC_FLAME_CMD = "flame/set"
+TOPIC_SPLIT_CMD = "split/set"
+TOPIC_EMBER_CMD = "ember/set"
+TOPIC_OVERHEAD_CMD = "overhead/set"
+TOPIC_FIELD_STATE = "state"
+TOPIC_STATE_CMD = "state/set"    # JSON: any subset of fields, mode, target_temp, preset
+TOPIC_PRESET_CMD = "preset/set"  # preset name
+# After (re)connecting, wait this long for the broker's retained discovery configs
+# before deciding which ones need publishing
+HA_DISCOVERY_SETTLE = float(os.environ.get("HA_DISCOVERY_SETTLE", "1"))
+
+# ── Devices (from .env) ──
+# IOT_THING_NAMES=RFF-10FDC28,RFF-22AB301:Basement  (THING[:Label], comma separated);
+# a single IOT_THING_NAME still works. The first device keeps the original fireplace/*
+# topics and HA entity ids; the others live under fireplace/<label>/*.
+DEVICE_SPECS = [e.strip() for e in os.environ.get("IOT_THING_NAMES", os.environ.get("IOT_THING_NAME", "")).split(",")
+                if e.strip()]
+if not DEVICE_SPECS:
+    raise KeyError("IOT_THING_NAMES")
+
+# ── AWS IoT connection tuning ──
+AWS_KEEPALIVE = int(os.environ.get("AWS_KEEPALIVE_SECS", "300"))
+AWS_PUBACK_TIMEOUT = float(os.environ.get("AWS_PUBACK_TIMEOUT", "10"))
+
+# ── AWS request budget ──
+# Every shadow read and update takes a token from its thing's bucket (the Device Shadow
+# API allows 20 requests/s per thing); the rate halves on a throttle response and
+# recovers on success. A call waits up to AWS_RATE_WAIT for a token.
+AWS_RATE = float(os.environ.get("AWS_RATE", "10"))
+AWS_BURST = float(os.environ.get("AWS_BURST", "20"))
+AWS_RATE_WAIT = float(os.environ.get("AWS_RATE_WAIT", "5"))
+# Throttles, 5xx, timeouts and connection errors are retried with full-jitter backoff
+AWS_RETRIES = int(os.environ.get("AWS_RETRIES", "3"))
+AWS_RETRY_BASE = float(os.environ.get("AWS_RETRY_BASE", "0.2"))
+AWS_RETRY_MAX = float(os.environ.get("AWS_RETRY_MAX", "5"))
+# This many consecutive failed attempts open the circuit: calls then fail fast for
+# AWS_BREAKER_COOLDOWN seconds, after which one trial call decides whether it closes
+AWS_BREAKER_FAILURES = int(os.environ.get("AWS_BREAKER_FAILURES", "5"))
+AWS_BREAKER_COOLDOWN = float(os.environ.get("AWS_BREAKER_COOLDOWN", "30"))
+# Hedged reads: if get_thing_shadow hasn't answered within the p95 of recent reads
+# (clamped to MIN..MAX seconds), a second request goes out and the first answer wins
+SHADOW_HEDGE = os.environ.get("SHADOW_HEDGE", "1") == "1"
+SHADOW_HEDGE_MIN = float(os.environ.get("SHADOW_HEDGE_MIN", "0.1"))
+SHADOW_HEDGE_MAX = float(os.environ.get("SHADOW_HEDGE_MAX", "2"))
+
+# ── Shadow sync ──
+# Push mode subscribes to shadow/update/documents + /delta; polling is then only a
+# slow reconciliation safety net, and drops back to POLL_SECS while the feed is down.
+SHADOW_PUSH = os.environ.get("SHADOW_PUSH", "1") == "1"
+POLL_SECS = int(os.environ.get("POLL_SECS", "30"))
+SHADOW_RECONCILE_SECS = int(os.environ.get("SHADOW_RECONCILE_SECS", "300"))
+# Adaptive polling on top of that base: after a command, poll every POLL_FAST_SECS until
+# the hub's reported state shows it applied (for at most POLL_FAST_WINDOW); while the unit is off and
+# unchanged, double the interval per poll up to POLL_IDLE_MAX_SECS; with the push feed
+# down, poll every POLL_NEAR_TARGET_SECS while the thermostat is within POLL_NEAR_TARGET_F.
+POLL_FAST_SECS = float(os.environ.get("POLL_FAST_SECS", "2"))
+POLL_FAST_WINDOW = float(os.environ.get("POLL_FAST_WINDOW", "30"))
+POLL_IDLE_MAX_SECS = int(os.environ.get("POLL_IDLE_MAX_SECS", "1800"))
+POLL_NEAR_TARGET_SECS = float(os.environ.get("POLL_NEAR_TARGET_SECS", "10"))
+POLL_NEAR_TARGET_F = float(os.environ.get("POLL_NEAR_TARGET_F", "1.5"))
+# Reads within this window share one snapshot (push mode keeps it current for longer)
+SHADOW_CACHE_TTL = float(os.environ.get("SHADOW_CACHE_TTL", "2"))
+# Also publish every state field to its own retained topic (fireplace/state/<field>)
+# and point the HA entities at those, so each entity only updates when its value does.
+HA_FIELD_TOPICS = os.environ.get("HA_FIELD_TOPICS", "0") == "1"
+
+# ── Command coalescing ──
+# HA sliders emit bursts; changes arriving within this window go out as one command.
+COMMAND_COALESCE_SECS = float(os.environ.get("COMMAND_COALESCE_SECS", "0.5"))
+
+# ── Command acknowledgements ──
+# A tracked command that isn't applied within this many seconds is reported as timed out
+COMMAND_ACK_TIMEOUT = float(os.environ.get("COMMAND_ACK_TIMEOUT", "30"))
+
+# ── Presets ──
+# Named scenes for PATCH /state {"preset": ...} and the preset/set topic
+PRESETS_PATH = os.path.expanduser(os.environ.get("PRESETS_PATH", "~/.config/flametech-bridge/presets.json"))
+
+# ── Command executor ──
+# Bound on queued NORMAL commands per device; URGENT (OFF) is always accepted
+COMMAND_QUEUE_MAX = int(os.environ.get("COMMAND_QUEUE_MAX", "16"))
+COMMAND_TIMEOUT = float(os.environ.get("COMMAND_TIMEOUT", "60"))
+
+# ── Blocking AWS SDK calls ──
+AWS_IO_WORKERS = int(os.environ.get("AWS_IO_WORKERS", "4"))
+AWS_CALL_TIMEOUT = float(os.environ.get("AWS_CALL_TIMEOUT", "15"))
+
+# ── Credential lifecycle ──
+# Credentials are renewed this long before they expire, in the background, using the
+# Cognito refresh token. Tokens + credentials persist (encrypted) across restarts.
+CRED_REFRESH_MARGIN = int(os.environ.get("CRED_REFRESH_MARGIN", "600"))
+CRED_CACHE_PATH = os.path.expanduser(os.environ.get("CRED_CACHE_PATH", "~/.cache/flametech-bridge/creds.enc"))
+CRED_CACHE_KEY = os.environ.get("CRED_CACHE_KEY", "")
+
+# ── boto3 clients ──
+# Built once per credential generation and reused, keeping their TLS connections alive
+AWS_POOL_CONNECTIONS = int(os.environ.get("AWS_POOL_CONNECTIONS", "4"))
+_boto_config = BotoConfig(max_pool_connections=AWS_POOL_CONNECTIONS, tcp_keepalive=True)
+# Shadow reads retry in aws_request() instead, so botocore makes a single attempt
+_iot_data_config = _boto_config.merge(BotoConfig(retries={"total_max_attempts": 1}))
+
+# ── History ──
+# Parsed state per shadow version: RAM ring + append-only file per device with rollover.
+# Set HISTORY_DIR empty to keep history in RAM only.
+HISTORY_DIR = os.path.expanduser(os.environ.get("HISTORY_DIR", "~/.cache/flametech-bridge/history"))
+HISTORY_RAM_POINTS = int(os.environ.get("HISTORY_RAM_POINTS", "10000"))
+HISTORY_FILE_MAX_MB = float(os.environ.get("HISTORY_FILE_MAX_MB", "8"))
+HISTORY_SEGMENTS = int(os.environ.get("HISTORY_SEGMENTS", "4"))
+HISTORY_MAX_BUCKETS = 2000
+
+# ── Warm start ──
+# Last state, CID and thermostat target per device, rewritten atomically when the state
+# changes and republished to HA as soon as it connects after a restart. Empty disables.
+STATE_SNAPSHOT_PATH = os.path.expanduser(os.environ.get("STATE_SNAPSHOT_PATH",
+                                                        "~/.cache/flametech-bridge/state.json"))
+
+# ── HTTP serving ──
+# asyncio (the default): the REST API, the HA MQTT client, the AWS IoT callbacks and the
+# poll scheduler share one event loop, and blocking SDK work runs on an executor of
+# HTTP_THREADS threads. HTTP_SERVER=waitress (threaded) or flask (dev server) serve the
+# same API with a thread per request. Always one process: the shadow cache, CID
+# sequence and command workers are in-process state.
+HTTP_SERVER = os.environ.get("HTTP_SERVER", "asyncio" if aio else "waitress" if create_server else "flask")
+HTTP_HOST = os.environ.get("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.environ.get("HTTP_PORT", "5088"))
+HTTP_THREADS = int(os.environ.get("HTTP_THREADS", "8"))
+# On SIGTERM, wait this long for queued commands and in-flight requests to finish.
+# The rest of shutdown takes at most SHUTDOWN_STEPS_SECS more (HTTP workers 5s, HA
+# offline publish 2s, AWS disconnect 5s); TimeoutStopSec in the systemd unit must
+# exceed the sum or systemd kills the bridge halfway through.
+SHUTDOWN_GRACE = float(os.environ.get("SHUTDOWN_GRACE", "20"))
+SHUTDOWN_HTTP_SECS, SHUTDOWN_HA_SECS, SHUTDOWN_AWS_SECS = 5, 2, 5
+SHUTDOWN_STEPS_SECS = SHUTDOWN_HTTP_SECS + SHUTDOWN_HA_SECS + SHUTDOWN_AWS_SECS
+
+# ── Event stream ──
+# Events buffered per /events client before it is dropped as too slow. Under waitress
+# and flask each open stream holds one HTTP thread, so the client cap leaves threads
+# for the API; on the event loop a stream holds no thread.
+EVENT_CLIENT_BUFFER = int(os.environ.get("EVENT_CLIENT_BUFFER", "100"))
+EVENT_MAX_CLIENTS = int(os.environ.get("EVENT_MAX_CLIENTS",
+                                       "100" if HTTP_SERVER == "asyncio" else str(max(1, HTTP_THREADS - 2))))
+EVENT_KEEPALIVE_SECS = float(os.environ.get("EVENT_KEEPALIVE_SECS", "15"))
+# waitress doesn't hand the raw socket to the app, so under waitress /events/ws is served
+# by a small threaded werkzeug server on this port (0 disables WebSocket there)
+EVENT_WS_PORT = int(os.environ.get("EVENT_WS_PORT", str(HTTP_PORT + 1)))
+
+# ── Tracing ──
+# Number of recent command traces kept for /debug/traces
+TRACE_BUFFER = int(os.environ.get("TRACE_BUFFER", "200"))
+
+# ── Recorder ──
+# Append HA commands, shadow changes, AWS call timings and published state to this
+# JSON-lines file for bench/replay.py. Empty disables; recording stops at RECORD_MAX_MB.
+RECORD_PATH = os.path.expanduser(os.environ.get("RECORD_PATH", ""))
+RECORD_MAX_MB = float(os.environ.get("RECORD_MAX_MB", "64"))
 
 app = Flask(__name__)
+# Shared state and who owns it:
+#   creds / creds_expire / iot_session  – written only by refresh_creds() under _creds_lock
+#   aws_conn                            – _aws_conn_lock
+#   per-device shadow cache, CID sequence – Fireplace.shadow_lock, Fireplace.cid_lock
+#   HA publish bookkeeping (Fireplace.published_*, streamed_state) – Fireplace.publish_lock,
+#                                         taken before _state_lock
+#   thermostat bookkeeping (Fireplace.user_*/last_*, _startup_grace) – _state_lock
+#   everything that sends a command     – that device's command worker
+#   poll schedule (Fireplace.poll_*)    – poll_loop thread (poll_task under asyncio); commands
+#                                         only pull poll_next earlier
+#   _loop                               – set once by core_main(); under asyncio the HA MQTT
+#                                         client, AWS IoT callbacks and timers run on it
+_creds_lock = threading.Lock()
+_state_lock = threading.RLock()
+_aws_io = ThreadPoolExecutor(max_workers=AWS_IO_WORKERS, thread_name_prefix="aws-io")
 creds = None
 creds_expire = 0
+cognito_tokens = {}
+identity_id = None
+creds_generation = 0
+_clients = {}
+_clients_lock = threading.Lock()
 iot_session = None
+aws_conn = None
+_aws_conn_lock = threading.RLock()
+_push_active = False
+_poll_wake = threading.Event()
+_poll_wakeup = None
+_loop = None
 ha_mqtt = None
-_user_target_temp = None
-_user_target_time = 0
 _startup_grace = 0
-_last_known_target = 72
-_last_mode_change = 0
+_cmd_seq = itertools.count(1)
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# Devices
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class Fireplace:
+    """One iFlame thing: its topics, shadow snapshot, CID sequence and command worker.
+
+    Cognito/AWS credentials, the IoT connection and the HA MQTT client are shared.
+    """
+
+    def __init__(self, spec, primary):
+        thing, _, label = spec.partition(":")
+        self.thing = thing.strip()
+        self.label = label.strip() or ("Fireplace" if primary else self.thing)
+        self.slug = re.sub(r"[^a-z0-9]+", "_", self.label.lower()).strip("_")
+        self.primary = primary
+        self.prefix = "fireplace" if primary else f"fireplace/{self.slug}"
+        # Suffix for HA unique_ids / discovery object ids; empty keeps the original ids
+        self.uid = "" if primary else f"_{self.slug}"
+        # Shadow API request budget (per thing, like the AWS limit)
+        self.aws_budget = TokenBucket(AWS_RATE, AWS_BURST)
+        # Shadow cache
+        self.shadow_lock = threading.Lock()
+        self.shadow = None
+        self.shadow_time = 0
+        self.shadow_min_version = 0
+        self.shadow_flight = None
+        # CID sequence
+        self.cid_lock = threading.Lock()
+        self.cid_last = None
+        self.cid_issued = {}
+        # Command acknowledgements by CID (ack_cond); (loop, asyncio.Event) per async waiter
+        self.ack_cond = threading.Condition()
+        self.commands = {}
+        self.ack_waiters = set()
+        # Thermostat bookkeeping (_state_lock)
+        self.user_target_temp = None
+        self.user_target_time = 0
+        self.last_known_target = 72
+        self.last_mode_change = 0
+        # Last published to HA, for change detection
+        self.publish_lock = threading.RLock()
+        self.published_version = None
+        self.published_state = None
+        self.published_climate = None
+        # Command coalescing + executor
+        self.pending = {}
+        self.pending_lock = threading.RLock()
+        self.pending_timer = None
+        self.batch_queued = False
+        self.cmd_queue = queue.PriorityQueue()  # COMMAND_QUEUE_MAX enforced in submit_command
+        self.cmd_cond = threading.Condition()
+        self.cmd_current_seq = 0
+        self.cmd_cancel_seq = 0
+        # Poll schedule
+        self.poll_next = 0
+        self.poll_backoff = 0
+        self.poll_signature = None
+        self.converge_cmd = None
+        self.converge_reported = None
+        self.converge_until = 0
+        # Last state sent to /events subscribers (also what the state snapshot saves)
+        self.streamed_state = None
+        # Previous run's state from the snapshot, published until the first shadow arrives
+        self.warm_state = None
+        # State history (/history)
+        self.history = HistoryStore(self.thing, HISTORY_DIR or None, ram_points=HISTORY_RAM_POINTS,
+                                    max_bytes=int(HISTORY_FILE_MAX_MB * 1024 * 1024), segments=HISTORY_SEGMENTS)
+
+    def __repr__(self):
+        return f"Fireplace({self.thing})"
+
+    def topic(self, suffix):
+        return f"{self.prefix}/{suffix}"
+
+    @property
+    def shadow_topic(self):
+        return f"$aws/things/{self.thing}/shadow"
+
+def _check_devices(devices):
+    """Refuse labels that would make two devices share a name or topic."""
+    # fireplace/<slug>/... must not land on one of the primary device's own topics
+    reserved = {value.split("/")[0] for name, value in globals().items() if name.startswith("TOPIC_")}
+    reserved.add(TOPIC_AVAIL.split("/")[1])
+    seen = {}
+    for fp in devices:
+        if not fp.primary and (not fp.slug or fp.slug in reserved):
+            raise ValueError(f"{fp.thing}: label {fp.label!r} gives topic prefix {fp.prefix!r}, "
+                             f"which clashes with the bridge's own topics; pick another label")
+        for name in {fp.thing, fp.slug}:
+            if name in seen:
+                raise ValueError(f"{fp.thing}: {name!r} is already used by {seen[name].thing}; "
+                                 f"thing names and labels must be unique")
+            seen[name] = fp
+
+DEVICES = [Fireplace(spec, i == 0) for i, spec in enumerate(DEVICE_SPECS)]
+_check_devices(DEVICES)
+DEVICES_BY_THING = {fp.thing: fp for fp in DEVICES}
+
+def get_device(name=None):
+    """Look a device up by thing name or label slug; None means the primary device."""
+    if not name:
+        return DEVICES[0]
+    for fp in DEVICES:
+        if name in (fp.thing, fp.slug):
+            return fp
+    raise KeyError(f"unknown device {name}")
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# Metrics
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# Prometheus text exposition without a client library. An observation is a bisect
+# and a short lock; gauges are computed only when /metrics is scraped.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _labels(key, extra=""):
+    parts = [f'{k}="{v}"' for k, v in key] + ([extra] if extra else [])
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Histogram:
+    def __init__(self, name, doc, buckets=LATENCY_BUCKETS):
+        self.name, self.doc, self.buckets = name, doc, buckets
+        self.lock = threading.Lock()
+        self.series = {}  # label key -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            s = self.series.get(key)
+            if s is None:
+                s = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(k, list(v)) for k, v in self.series.items()]
+        for key, s in series:
+            total = 0
+            for bound, n in zip(self.buckets + ("+Inf",), s[:-1]):
+                total += n
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(key, le)} {total}")
+            lines.append(f"{self.name}_sum{_labels(key)} {s[-1]:.6f}")
+            lines.append(f"{self.name}_count{_labels(key)} {total}")
+        return lines
+
+class _Timer:
+    __slots__ = ("hist", "labels", "t0")
+
+    def __init__(self, hist, labels):
+        self.hist, self.labels = hist, labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.t0, **self.labels)
+
+class Counter:
+    def __init__(self, name, doc):
+        self.name, self.doc = name, doc
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def inc(self, n=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + n
+
+    def render(self):
+        with self.lock:
+            series = list(self.series.items())
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"] + \
+               [f"{self.name}{_labels(k)} {v}" for k, v in series]
+
+class Gauge:
+    """Read at scrape time: fn() returns [(labels dict, value), ...]."""
+
+    def __init__(self, name, doc, fn):
+        self.name, self.doc, self.fn = name, doc, fn
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge"]
+        try:
+            for labels, value in self.fn():
+                lines.append(f"{self.name}{_labels(sorted(labels.items()))} {value}")
+        except Exception as e:
+            log.warning(f"Gauge {self.name} failed: {e}")
+        return lines
+
+M_GET_SHADOW = Histogram("iflame_get_shadow_seconds", "get_shadow() latency by source (cache, fetch, shared)")
+M_NEXT_CID = Histogram("iflame_next_cid_seconds", "CID allocation latency")
+M_REFRESH_CREDS = Histogram("iflame_refresh_creds_seconds", "Cognito login + AWS credential refresh latency")
+M_AWS_CONNECT = Histogram("iflame_aws_connect_seconds", "AWS IoT websocket connect latency")
+M_AWS_PUBLISH = Histogram("iflame_aws_publish_seconds", "Shadow update publish latency until PUBACK")
+M_COMMAND_SLEEP = Histogram("iflame_command_sleep_seconds", "Time spent in fixed sleeps inside commands")
+M_COMMAND_ACK = Histogram("iflame_command_ack_seconds", "Publish to accepted / applied round trip by stage")
+M_COMMAND = Histogram("iflame_command_seconds", "Command execution time in the device worker")
+M_HA_COMMANDS = Counter("iflame_ha_commands_total", "HA MQTT commands received, by topic")
+M_EVENT_DROPS = Counter("iflame_event_drops_total", "Event subscribers dropped for falling behind")
+M_POLL_FAILURES = Counter("iflame_poll_failures_total", "Shadow polls that raised")
+M_CRED_REFRESHES = Counter("iflame_cred_refreshes_total", "Credential refreshes by result")
+M_AWS_RETRIES = Counter("iflame_aws_retries_total", "Shadow API attempts retried, by operation and reason")
+M_AWS_REJECTED = Counter("iflame_aws_rejected_total", "Shadow API calls refused locally (budget, circuit)")
+M_SHADOW_HEDGES = Counter("iflame_shadow_hedges_total", "Hedged shadow reads sent, and how many won")
+
+METRICS = [M_GET_SHADOW, M_NEXT_CID, M_REFRESH_CREDS, M_AWS_CONNECT, M_AWS_PUBLISH, M_COMMAND_SLEEP,
+           M_COMMAND, M_COMMAND_ACK, M_HA_COMMANDS, M_POLL_FAILURES, M_CRED_REFRESHES, M_EVENT_DROPS,
+           M_AWS_RETRIES, M_AWS_REJECTED, M_SHADOW_HEDGES,
+           Gauge("iflame_aws_rate", "Current shadow API token rate per second (adaptive)",
+                 lambda: [({"device": fp.slug}, round(fp.aws_budget.rate, 2)) for fp in DEVICES]),
+           Gauge("iflame_aws_circuit_open", "0 closed, 1 half-open, 2 open",
+                 lambda: [({}, ("closed", "half_open", "open").index(aws_breaker.state))]),
+           Gauge("iflame_shadow_hedge_delay_seconds", "Current hedge delay for shadow reads",
+                 lambda: [({}, round(hedge_delay(), 3))]),
+           Gauge("iflame_event_subscribers", "Open /events streams", lambda: [({}, len(_subscribers))]),
+           Gauge("iflame_shadow_age_seconds", "Seconds since the cached shadow was stored",
+                 lambda: [({"device": fp.slug}, round(time.time() - fp.shadow_time, 3))
+                          for fp in DEVICES if fp.shadow is not None]),
+           Gauge("iflame_command_queue_depth", "Commands waiting for the device worker",
+                 lambda: [({"device": fp.slug}, fp.cmd_queue.qsize()) for fp in DEVICES]),
+           Gauge("iflame_next_poll_seconds", "Seconds until the device's next scheduled poll",
+                 lambda: [({"device": fp.slug}, round(max(0, fp.poll_next - time.time()), 1)) for fp in DEVICES]),
+           Gauge("iflame_ha_mqtt_connected", "1 while the HA MQTT client is connected",
+                 lambda: [({}, int(ha_mqtt is not None and ha_mqtt.is_connected()))]),
+           Gauge("iflame_aws_push_active", "1 while shadow push subscriptions are live",
+                 lambda: [({}, int(_push_active))]),
+           Gauge("iflame_creds_expiry_seconds", "Seconds until the AWS credentials expire",
+                 lambda: [({}, round(creds_expire - time.time(), 1))])]
+
+def render_metrics():
+    return "\n".join(line for m in METRICS for line in m.render()) + "\n"
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# Command Traces
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# Every command run by a device worker records a trace: queue wait plus spans for
+# the state read, CID allocation, connect, publish, PUBACK wait, sleeps and the
+# follow-up poll. Spans outside a command (polls, push updates) are no-ops.
+# The last TRACE_BUFFER traces are served at /debug/traces.
+
+_traces = collections.deque(maxlen=TRACE_BUFFER)
+_trace_local = threading.local()
+_trace_ids = itertools.count(1)
+
+class Trace:
+    def __init__(self, fp, name, origin):
+        self.id = next(_trace_ids)
+        self.device = fp.slug
+        self.name = name
+        self.origin = origin
+        self.submitted = time.time()
+        self.start = self.end = None
+        self.tags = {}
+        self.spans = []  # [name, start, end, args]
+
+    def to_dict(self):
+        ms = lambda a, b: round((b - a) * 1000, 1) if a and b else None
+        return {
+            "id": self.id, "device": self.device, "command": self.name, "origin": self.origin,
+            "submitted": self.submitted, "queued_ms": ms(self.submitted, self.start),
+            "duration_ms": ms(self.start, self.end), **self.tags,
+            "spans": [{"name": n, "offset_ms": ms(self.submitted, s), "duration_ms": ms(s, e), **a}
+                      for n, s, e, a in sorted(self.spans, key=lambda sp: sp[1])],
+        }
+
+    def chrome_events(self):
+        """Chrome trace / Perfetto complete events; one row (tid) per command."""
+        us = lambda t: int(t * 1e6)
+        events = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": self.id,
+                   "args": {"name": f"{self.device} {self.name} ({self.origin})"}},
+                  {"name": "queued", "ph": "X", "pid": 1, "tid": self.id,
+                   "ts": us(self.submitted), "dur": us(self.start - self.submitted)},
+                  {"name": self.name, "ph": "X", "pid": 1, "tid": self.id,
+                   "ts": us(self.start), "dur": us(self.end - self.start), "args": self.tags}]
+        events += [{"name": n, "ph": "X", "pid": 1, "tid": self.id, "ts": us(s), "dur": us(e - s), "args": a}
+                   for n, s, e, a in self.spans]
+        return events
+
+class _Span:
+    __slots__ = ("trace", "entry")
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.entry = [name, 0.0, 0.0, args]
+
+    @property
+    def args(self):
+        return self.entry[3]
+
+    def __enter__(self):
+        self.entry[1] = time.time()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.entry[2] = time.time()
+        if exc_type is not None:
+            self.entry[3]["error"] = exc_type.__name__
+        self.trace.spans.append(self.entry)
+
+class _NoSpan:
+    __slots__ = ()
+    args = property(lambda self: {})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+def span(name, **args):
+    """Time a block as part of the current command's trace (no-op outside a command)."""
+    trace = getattr(_trace_local, "trace", None)
+    return _NO_SPAN if trace is None else _Span(trace, name, args)
+
+def trace_tag(**tags):
+    trace = getattr(_trace_local, "trace", None)
+    if trace is not None:
+        trace.tags.update(tags)
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# Event Stream
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# /events (SSE) and /events/ws (WebSocket; on the event loop, or flask-sock under the
+# threaded servers) fan out state changes, command acks and availability from the
+# bridge's own state: no client ever causes an AWS call. Each subscriber has a bounded buffer; one that falls behind is dropped.
+
+_subscribers = set()
+_subscribers_lock = threading.Lock()
+_event_ids = itertools.count(1)
+_last_availability = None
+_CLOSED = object()
+
+class Subscriber:
+    def __init__(self, device=None, types=None):
+        self.device = device
+        self.types = types
+        self.queue = queue.Queue(maxsize=EVENT_CLIENT_BUFFER)
+        # A subscriber created on the event loop is woken through it (next_event_async)
+        self.loop = _running_loop()
+        self.ready = asyncio.Event() if self.loop else None
+
+    def wants(self, event, device):
+        return (self.types is None or event in self.types) and \
+               (self.device is None or device is None or device == self.device)
+
+    def put(self, msg):
+        self.queue.put_nowait(msg)
+        self.notify()
+
+    def notify(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+def subscribe(device=None, types=None):
+    sub = Subscriber(device, types)
+    with _subscribers_lock:
+        if len(_subscribers) >= EVENT_MAX_CLIENTS:
+            raise RuntimeError(f"too many event subscribers ({EVENT_MAX_CLIENTS})")
+        _subscribers.add(sub)
+    # Current state first, straight from memory
+    for fp in DEVICES:
+        if fp.streamed_state is not None and sub.wants("state", fp.slug):
+            sub.put(_event("state", fp.slug, fp.streamed_state))
+    if _last_availability is not None and sub.wants("availability", None):
+        sub.put(_event("availability", None, _last_availability))
+    return sub
+
+def unsubscribe(sub, dropped=False):
+    with _subscribers_lock:
+        if sub not in _subscribers:
+            return
+        _subscribers.discard(sub)
+    if dropped:
+        # A consumer this far behind gets no backlog, just the close
+        with sub.queue.mutex:
+            sub.queue.queue.clear()
+    try:
+        sub.queue.put_nowait(_CLOSED)
+    except queue.Full:
+        with sub.queue.mutex:
+            sub.queue.queue.clear()
+        sub.queue.put_nowait(_CLOSED)
+    sub.notify()
+    if dropped:
+        M_EVENT_DROPS.inc()
+        log.warning(f"Dropping slow event subscriber ({EVENT_CLIENT_BUFFER} events behind)")
+
+def close_subscribers():
+    with _subscribers_lock:
+        subs = list(_subscribers)
+    for sub in subs:
+        unsubscribe(sub)
+
+def _event(event, device, data):
+    return {"id": next(_event_ids), "event": event, "device": device, "time": time.time(), "data": data}
+
+def broadcast(event, device, data):
+    """Queue an event for every interested subscriber without ever blocking the caller."""
+    if not _subscribers:
+        return
+    msg = _event(event, device, data)
+    with _subscribers_lock:
+        subs = [s for s in _subscribers if s.wants(event, device)]
+    for sub in subs:
+        try:
+            sub.put(msg)
+        except queue.Full:
+            unsubscribe(sub, dropped=True)
+
+def stream_state(fp, state):
+    with fp.publish_lock:
+        if state == fp.streamed_state:
+            return
+        fp.streamed_state = state
+    broadcast("state", fp.slug, state)
+
+def stream_availability():
+    global _last_availability
+    current = {"online": not _stopping.is_set(), "aws_push": _push_active,
+               "ha_mqtt": bool(ha_mqtt is not None and ha_mqtt.is_connected())}
+    if current != _last_availability:
+        _last_availability = current
+        broadcast("availability", None, current)
+
+def next_event(sub, timeout):
+    """The subscriber's next event, None on timeout; raises EOFError once it is closed."""
+    try:
+        msg = sub.queue.get(timeout=timeout)
+    except queue.Empty:
+        return None
+    if msg is _CLOSED:
+        raise EOFError
+    return msg
+
+async def next_event_async(sub, timeout):
+    """next_event() for a subscriber on the event loop: waits without holding a thread."""
+    while True:
+        sub.ready.clear()
+        try:
+            msg = sub.queue.get_nowait()
+        except queue.Empty:
+            try:
+                await asyncio.wait_for(sub.ready.wait(), timeout)
+            except TimeoutError:
+                return None
+            continue
+        if msg is _CLOSED:
+            raise EOFError
+        return msg
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# Recorder
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# One compact JSON object per line, always with "t" (epoch seconds) and "k" (kind);
+# "d" is the thing name:
+#   start   things          header: the IOT_THING_NAMES specs
+#   shadow  d s             first shadow seen per device
+#   ha      d topic p       HA command (after the startup grace)
+#   ext     d cid cmd       a command someone else sent (app, wall remote)
+#   at      d at            ambient temperature change
+#   fetch   d ms            get_thing_shadow round trip (hedges included)
+#   pub     d cid ms ok     shadow update publish until PUBACK, retries included
+#   state   d s             status payload published to HA
+
+_record_file = None
+_record_lock = threading.RLock()
+_recorded_shadow = set()
+
+def start_recorder():
+    global _record_file
+    if not RECORD_PATH:
+        return
+    os.makedirs(os.path.dirname(RECORD_PATH) or ".", exist_ok=True)
+    with _record_lock:
+        _record_file = open(RECORD_PATH, "a")
+    record("start", things=DEVICE_SPECS)
+    log.info(f"Recording to {RECORD_PATH}")
+
+def stop_recorder(reason):
+    global _record_file
+    with _record_lock:
+        if _record_file is None:
+            return
+        _record_file.close()
+        _record_file = None
+    log.info(f"Recording stopped: {reason}")
+
+def record(kind, **fields):
+    if _record_file is None:
+        return
+    line = json.dumps({"t": round(time.time(), 3), "k": kind, **fields}, separators=(",", ":"))
+    with _record_lock:
+        if _record_file is None:
+            return
+        _record_file.write(line + "\n")
+        _record_file.flush()
+        if _record_file.tell() >= RECORD_MAX_MB * 1024 * 1024:
+            stop_recorder(f"{RECORD_PATH} reached {RECORD_MAX_MB:.0f} MB")
+
+def _record_shadow(fp, previous, shadow):
+    """Record what changed in the shadow that our own commands don't explain."""
+    if fp.thing not in _recorded_shadow:
+        _recorded_shadow.add(fp.thing)
+        record("shadow", d=fp.thing, s=shadow)
+        return
+    cid, cmd = _shadow_cid_cmd(shadow)
+    if previous is not None and cid != _shadow_cid_cmd(previous)[0]:
+        try:
+            ours = int(cid) in fp.cid_issued
+        except (TypeError, ValueError):
+            ours = False
+        if not ours:
+            record("ext", d=fp.thing, cid=cid, cmd=cmd)
+    at = shadow.get("state", {}).get("reported", {}).get("AT")
+    if previous is None or at != previous.get("state", {}).get("reported", {}).get("AT"):
+        record("at", d=fp.thing, at=at)
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# AWS Request Budget
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# Shadow reads and updates go through aws_request(): a token from the thing's bucket,
+# the shared circuit breaker, and jittered retries for transient failures. Reads are
+# also hedged. Cognito calls stay on aws_call() and botocore's own retries.
+
+class AwsUnavailable(RuntimeError):
+    """Refused locally: the request budget is exhausted or the circuit is open."""
+
+RETRYABLE_CODES = {"ThrottlingException", "TooManyRequestsException", "RequestLimitExceeded",
+                   "ServiceUnavailableException", "InternalFailureException", "InternalFailure"}
+
+aws_breaker = CircuitBreaker(AWS_BREAKER_FAILURES, AWS_BREAKER_COOLDOWN)
+_shadow_read_latency = LatencyWindow(200)
+_hedge_lock = threading.Lock()
+_hedge_stats = {"reads": 0, "hedged": 0, "hedge_won": 0}
+
+def _count_hedge(key):
+    with _hedge_lock:
+        _hedge_stats[key] += 1
+
+def _failure_kind(e):
+    """'throttled' / 'transient' for errors worth retrying, None for the rest."""
+    if isinstance(e, ClientError):
+        code = e.response.get("Error", {}).get("Code")
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        if code in ("ThrottlingException", "TooManyRequestsException", "RequestLimitExceeded") or status == 429:
+            return "throttled"
+        return "transient" if code in RETRYABLE_CODES or status >= 500 else None
+    if isinstance(e, (TimeoutError, ConnectionError, BotoCoreError, AwsCrtError)):
+        return "transient"
+    return None
+
+def aws_request(fp, op, fn, *args, **kwargs):
+    """Run one shadow API operation within the budget, retrying transient failures."""
+    for attempt in range(AWS_RETRIES + 1):
+        # Breaker first, so an open circuit doesn't burn budget tokens
+        if not aws_breaker.allow():
+            M_AWS_REJECTED.inc(op=op, reason="circuit_open")
+            raise AwsUnavailable(f"AWS circuit open ({op}); retry in {aws_breaker.stats()['retry_in_s']}s")
+        if not fp.aws_budget.acquire(AWS_RATE_WAIT):
+            aws_breaker.release()
+            M_AWS_REJECTED.inc(op=op, reason="budget")
+            raise AwsUnavailable(f"{fp.thing}: shadow API budget exhausted ({op})")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            kind = _failure_kind(e)
+            if kind is None:
+                # AWS answered; the request itself was wrong
+                aws_breaker.success()
+                raise
+            if kind == "throttled":
+                fp.aws_budget.throttled()
+            if aws_breaker.failure():
+                log.error(f"AWS circuit opened after {AWS_BREAKER_FAILURES} failures: {e}")
+            if attempt == AWS_RETRIES:
+                raise
+            delay = backoff(attempt, AWS_RETRY_BASE, AWS_RETRY_MAX)
+            M_AWS_RETRIES.inc(op=op, reason=kind)
+            log.warning(f"{fp.thing}: {op} {kind} ({e}); retry {attempt + 1}/{AWS_RETRIES} in {delay:.2f}s")
+            time.sleep(delay)
+        else:
+            aws_breaker.success()
+            fp.aws_budget.recovered()
+            return result
+
+def hedge_delay():
+    """p95 of recent shadow reads, clamped; SHADOW_HEDGE_MAX until there are enough samples."""
+    if len(_shadow_read_latency) < 20:
+        return SHADOW_HEDGE_MAX
+    return min(SHADOW_HEDGE_MAX, max(SHADOW_HEDGE_MIN, _shadow_read_latency.quantile(0.95)))
+
+def _hedge_snapshot():
+    with _hedge_lock:
+        return dict(_hedge_stats)
+
+def aws_stats():
+    return {"breaker": aws_breaker.stats(),
+            "budget": {fp.slug: fp.aws_budget.stats() for fp in DEVICES},
+            "hedge": {**_hedge_snapshot(), "enabled": SHADOW_HEDGE, "delay_s": round(hedge_delay(), 3),
+                      "read_p50_s": _shadow_read_latency.quantile(0.5),
+                      "read_p95_s": _shadow_read_latency.quantile(0.95)}}
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # AWS Auth & IoT
 # ═══════════════════════════════════════════════════════════════════════════════
 
-def refresh_creds():
-    global creds, creds_expire, iot_session
-    log.info("Refreshing AWS credentials...")
+def aws_call(fn, *args, **kwargs):
+    """Run a blocking SDK call on the small AWS I/O pool, bounded by AWS_CALL_TIMEOUT."""
+    return _aws_io.submit(fn, *args, **kwargs).result(timeout=AWS_CALL_TIMEOUT)
+
+def ensure_creds():
+    """Refresh expired credentials once, however many threads notice at the same time."""
+    if time.time() <= creds_expire:
+        return
+    with _creds_lock:
+        if time.time() > creds_expire:
+            refresh_creds()
+
+def _cognito_login():
+    """Renew with the refresh token when we have one; fall back to a full SRP login."""
+    global cognito_tokens
+    if cognito_tokens.get("refresh_token"):
+        u = Cognito(POOL_ID, CLIENT_ID, client_secret=CLIENT_SECRET, username=EMAIL,
+                    refresh_token=cognito_tokens["refresh_token"])
+        try:
+            aws_call(u.renew_access_token)
+            cognito_tokens = {**cognito_tokens, "id_token": u.id_token, "access_token": u.access_token}
+            return cognito_tokens["id_token"]
+        except Exception as e:
+            log.warning(f"Refresh token renewal failed, doing full login: {e}")
     u = Cognito(POOL_ID, CLIENT_ID, client_secret=CLIENT_SECRET, username=EMAIL)
-    u.authenticate(password=IFLAME_PW)
-    ic = boto3.client("cognito-identity", region_name=R)
-    lk = f"cognito-idp.{R}.amazonaws.com/{POOL_ID}"
-    iid = ic.get_id(IdentityPoolId=IDENTITY_POOL, Logins={lk: u.id_token})["IdentityId"]
-    cr = ic.get_credentials_for_identity(IdentityId=iid, Logins={lk: u.id_token})["Credentials"]
-    creds = cr
-    creds_expire = time.time() + 3000
+    aws_call(u.authenticate, password=IFLAME_PW)
+    cognito_tokens = {"id_token": u.id_token, "access_token": u.access_token,
+                      "refresh_token": u.refresh_token}
+    return cognito_tokens["id_token"]
+
+def aws_client(name):
+    """Shared boto3 client for this credential generation (cognito-identity is unsigned)."""
+    key = (name, 0 if name == "cognito-identity" else creds_generation)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            if name == "cognito-identity":
+                client = boto3.client(name, region_name=R, config=_boto_config)
+            elif name == "iot-data":
+                client = iot_session.client(name, endpoint_url=f"https://{IOT_EP}", config=_iot_data_config)
+            else:
+                client = iot_session.client(name, config=_boto_config)
+            for stale in [k for k in _clients if k[1] not in (0, creds_generation)]:
+                del _clients[stale]
+            _clients[key] = client
+        return client
+
+def _install_creds(cr):
+    global creds, creds_expire, iot_session, creds_generation
+    expiration = cr.get("Expiration")
+    if hasattr(expiration, "timestamp"):
+        expiration = expiration.timestamp()
+    creds = {k: cr[k] for k in ("AccessKeyId", "SecretKey", "SessionToken")}
+    creds_expire = (expiration - 60) if expiration else time.time() + 3000
     iot_session = boto3.Session(
         aws_access_key_id=cr["AccessKeyId"],
         aws_secret_access_key=cr["SecretKey"],
         aws_session_token=cr["SessionToken"],
         region_name=R
     )
+    creds_generation += 1
+
+def refresh_creds():
     try:
-        iot_session.client("iot").attach_policy(policyName="WiFi-Hub-Policy", target=iid)
-    except:
-        pass
-    log.info("AWS credentials refreshed")
+        with M_REFRESH_CREDS.time():
+            _refresh_creds()
+    except Exception:
+        M_CRED_REFRESHES.inc(result="error")
+        raise
+    M_CRED_REFRESHES.inc(result="ok")
+
+def _refresh_creds():
+    global identity_id
+    log.info("Refreshing AWS credentials...")
+    id_token = _cognito_login()
+    ic = aws_client("cognito-identity")
+    lk = f"cognito-idp.{R}.amazonaws.com/{POOL_ID}"
+    new_identity = identity_id is None
+    if new_identity:
+        identity_id = aws_call(ic.get_id, IdentityPoolId=IDENTITY_POOL, Logins={lk: id_token})["IdentityId"]
+    cr = aws_call(ic.get_credentials_for_identity, IdentityId=identity_id, Logins={lk: id_token})["Credentials"]
+    _install_creds(cr)
+    if new_identity:
+        try:
+            aws_client("iot").attach_policy(policyName="WiFi-Hub-Policy", target=identity_id)
+        except:
+            pass
+    save_cred_cache()
+    # Rotate the IoT websocket so the live session is signed with the new credentials
+    _drop_aws_conn()
+    log.info(f"AWS credentials refreshed (valid {int(creds_expire - time.time())}s)")
 
-def get_shadow():
-    if time.time() > creds_expire:
+def _renew_creds():
+    with _creds_lock:
         refresh_creds()
-    iot_data = iot_session.client("iot-data", endpoint_url=f"https://{IOT_EP}")
-    shadow = iot_data.get_thing_shadow(thingName=THING)
+
+def cred_refresh_loop():
+    """Renew credentials CRED_REFRESH_MARGIN ahead of expiry so no command waits on auth."""
+    while True:
+        wait = creds_expire - CRED_REFRESH_MARGIN - time.time()
+        if wait > 0:
+            time.sleep(min(wait, 60))
+            continue
+        try:
+            _renew_creds()
+        except Exception as e:
+            log.error(f"Background credential refresh failed: {e}")
+            time.sleep(30)
+
+async def cred_refresh_task():
+    """cred_refresh_loop() on the event loop; the refresh itself runs on the executor."""
+    while True:
+        wait = creds_expire - CRED_REFRESH_MARGIN - time.time()
+        if wait > 0:
+            await asyncio.sleep(min(wait, 60))
+            continue
+        try:
+            await _loop.run_in_executor(None, _renew_creds)
+        except Exception as e:
+            log.error(f"Background credential refresh failed: {e}")
+            await asyncio.sleep(30)
+
+def _cred_cache_cipher():
+    if Fernet is None or not CRED_CACHE_PATH:
+        return None
+    key = CRED_CACHE_KEY.encode() if CRED_CACHE_KEY else base64.urlsafe_b64encode(
+        hashlib.sha256(f"{EMAIL}:{IFLAME_PW}:{CLIENT_SECRET}".encode()).digest())
+    return Fernet(key)
+
+def save_cred_cache():
+    cipher = _cred_cache_cipher()
+    if cipher is None:
+        return
+    blob = cipher.encrypt(json.dumps({
+        "tokens": cognito_tokens, "identity_id": identity_id,
+        "creds": creds, "expire": creds_expire,
+    }).encode())
+    try:
+        os.makedirs(os.path.dirname(CRED_CACHE_PATH), mode=0o700, exist_ok=True)
+        tmp = CRED_CACHE_PATH + ".tmp"
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+            f.write(blob)
+        os.replace(tmp, CRED_CACHE_PATH)
+    except OSError as e:
+        log.warning(f"Could not write credential cache: {e}")
+
+def load_cred_cache():
+    """Restore tokens/credentials from disk; returns True if the creds are still usable."""
+    global cognito_tokens, identity_id
+    cipher = _cred_cache_cipher()
+    if cipher is None:
+        if Fernet is None:
+            log.info("Credential cache disabled (cryptography not installed)")
+        return False
+    try:
+        with open(CRED_CACHE_PATH, "rb") as f:
+            cached = json.loads(cipher.decrypt(f.read()))
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError, InvalidToken) as e:
+        log.warning(f"Ignoring unreadable credential cache: {e}")
+        return False
+    cognito_tokens = cached.get("tokens") or {}
+    identity_id = cached.get("identity_id")
+    if cached.get("creds") and cached.get("expire", 0) - time.time() > CRED_REFRESH_MARGIN:
+        _install_creds({**cached["creds"], "Expiration": cached["expire"] + 60})
+        log.info(f"Using cached AWS credentials (valid {int(creds_expire - time.time())}s)")
+        return True
+    return False
+
+def _get_thing_shadow(fp):
+    t0 = time.perf_counter()
+    shadow = aws_client("iot-data").get_thing_shadow(thingName=fp.thing)
+    record("fetch", d=fp.thing, ms=round((time.perf_counter() - t0) * 1000, 1))
     return json.loads(shadow["payload"].read())
 
-def aws_publish(payload_dict):
-    if time.time() > creds_expire:
-        refresh_creds()
-    cp = auth.AwsCredentialsProvider.new_static(
-        access_key_id=creds["AccessKeyId"],
-        secret_access_key=creds["SecretKey"],
-        session_token=creds["SessionToken"]
-    )
-    conn = mqtt_connection_builder.websockets_with_default_aws_signing(
-        endpoint=IOT_EP, region=R, credentials_provider=cp,
-        client_id=f"ha-iflame-{int(time.time())}", clean_session=True,
-    )
-    conn.connect().result(timeout=10)
-    conn.publish(
-        topic=f"$aws/things/{THING}/shadow/update",
-        payload=json.dumps(payload_dict),
-        qos=awsmqtt.QoS.AT_LEAST_ONCE
-    )
-    time.sleep(2)
-    conn.disconnect().result()
+def _read_shadow(fp):
+    """One get_thing_shadow, hedged with a second request after hedge_delay(); first answer wins."""
+    t0 = time.perf_counter()
+
+    def observe(f):
+        # The unhedged request's own latency, so hedging doesn't pull its own delay down
+        if f.exception() is None:
+            _shadow_read_latency.add(time.perf_counter() - t0)
+
+    first = _aws_io.submit(_get_thing_shadow, fp)
+    first.add_done_callback(observe)
+    _count_hedge("reads")
+    pending = {first}
+    if SHADOW_HEDGE and not wait(pending, timeout=hedge_delay()).done and fp.aws_budget.try_acquire():
+        _count_hedge("hedged")
+        M_SHADOW_HEDGES.inc(result="sent")
+        pending.add(_aws_io.submit(_get_thing_shadow, fp))
+    error = None
+    while pending:
+        done, pending = wait(pending, timeout=max(0, t0 + AWS_CALL_TIMEOUT - time.perf_counter()),
+                             return_when=FIRST_COMPLETED)
+        if not done:
+            raise TimeoutError(f"get_thing_shadow({fp.thing}) timed out after {AWS_CALL_TIMEOUT:.0f}s")
+        for f in done:
+            if f.exception() is None:
+                if f is not first:
+                    _count_hedge("hedge_won")
+                    M_SHADOW_HEDGES.inc(result="won")
+                return f.result()
+            error = f.exception()
+    raise error
+
+def _fetch_shadow(fp):
+    ensure_creds()
+    return aws_request(fp, "get_shadow", _read_shadow, fp)
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# Shadow Cache
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# Every shadow we see (REST fetch, update/documents, delta) lands in one snapshot per device.
+# Readers within the TTL share it, concurrent misses share one in-flight fetch, and
+# our own publishes bump the minimum acceptable version so nobody reads back the
+# pre-command state from cache. Returned documents are shared: treat as read-only.
+
+def _shadow_is_fresh(fp):
+    if fp.shadow is None or fp.shadow.get("version", 0) < fp.shadow_min_version:
+        return False
+    ttl = SHADOW_RECONCILE_SECS if _push_active else SHADOW_CACHE_TTL
+    return time.time() - fp.shadow_time < ttl
+
+def _store_shadow(fp, shadow):
+    """Keep the newest shadow by version; returns False if an older one arrived late."""
+    with fp.shadow_lock:
+        if fp.shadow is not None and shadow.get("version", 0) < fp.shadow.get("version", 0):
+            return False
+        previous = fp.shadow
+        fp.shadow = shadow
+        fp.shadow_time = time.time()
+    if _record_file is not None:
+        _record_shadow(fp, previous, shadow)
+    observe_cid(fp, *_shadow_cid_cmd(shadow))
+    _resolve_commands(fp, shadow)
+    return True
+
+def cached_version(fp):
+    with fp.shadow_lock:
+        return fp.shadow.get("version", 0) if fp.shadow is not None else None
+
+def invalidate_shadow(fp, before):
+    """Called after our own publish with cached_version() from just before it: that
+    version is now known to be old. (Not the version cached now: our own update may
+    already have been pushed back, and one past it would never arrive.)"""
+    if before is None:
+        return
+    with fp.shadow_lock:
+        fp.shadow_min_version = max(fp.shadow_min_version, before + 1)
+
+def get_shadow(fp, fresh=False):
+    t0 = time.perf_counter()
+    with fp.shadow_lock:
+        if not fresh and _shadow_is_fresh(fp):
+            M_GET_SHADOW.observe(time.perf_counter() - t0, source="cache")
+            return fp.shadow
+        flight = fp.shadow_flight
+        leader = flight is None
+        if leader:
+            flight = fp.shadow_flight = Future()
+    if not leader:
+        shadow = flight.result()
+        M_GET_SHADOW.observe(time.perf_counter() - t0, source="shared")
+        return shadow
+    try:
+        shadow = _fetch_shadow(fp)
+        if not _store_shadow(fp, shadow):
+            # A push landed a newer version while the fetch was in flight
+            shadow = fp.shadow
+        flight.set_result(shadow)
+        M_GET_SHADOW.observe(time.perf_counter() - t0, source="fetch")
+        return shadow
+    except Exception as e:
+        flight.set_exception(e)
+        raise
+    finally:
+        with fp.shadow_lock:
+            fp.shadow_flight = None
+
+def _aws_credentials():
+    """Delegate for the CRT credentials provider: always sign with the current creds."""
+    return auth.AwsCredentials(creds["AccessKeyId"], creds["SecretKey"], creds["SessionToken"])
+
+def _on_aws_interrupted(connection, error, **kwargs):
+    global _push_active
+    log.warning(f"AWS IoT connection interrupted: {error}")
+    _push_active = False
+    wake_poller()
+    stream_availability()
+
+def _on_aws_resumed(connection, return_code, session_present, **kwargs):
+    global _push_active
+    log.info(f"AWS IoT connection resumed rc={return_code} session_present={session_present}")
+    if not session_present:
+        connection.resubscribe_existing_topics()
+    if not SHADOW_PUSH:
+        return
+    _push_active = True
+    stream_availability()
+    # Catch up on anything that changed while we were disconnected (off the CRT thread)
+    run_blocking(poll_all)
+
+def get_aws_conn():
+    """Return the long-lived AWS IoT websocket connection, connecting on first use.
+
+    The CRT reconnects on its own after an interruption; refresh_creds() drops the
+    connection so the next caller reconnects with the rotated credentials.
+    """
+    global aws_conn
+    ensure_creds()
+    with _aws_conn_lock:
+        if aws_conn is None:
+            conn = mqtt_connection_builder.websockets_with_default_aws_signing(
+                endpoint=IOT_EP, region=R,
+                credentials_provider=auth.AwsCredentialsProvider.new_delegate(_aws_credentials),
+                client_id=f"ha-iflame-{int(time.time())}", clean_session=True,
+                keep_alive_secs=AWS_KEEPALIVE,
+                on_connection_interrupted=on_loop(_on_aws_interrupted),
+                on_connection_resumed=on_loop(_on_aws_resumed),
+            )
+            with M_AWS_CONNECT.time(), span("connect"):
+                conn.connect().result(timeout=10)
+            log.info("AWS IoT connection established")
+            aws_conn = conn
+            _subscribe_shadow(conn)
+        return aws_conn
+
+def _subscribe_shadow(conn):
+    """accepted/rejected always (command acks); documents/delta when SHADOW_PUSH is on."""
+    global _push_active
+    for fp in DEVICES:
+        topics = [(f"{fp.shadow_topic}/update/accepted", _on_shadow_accepted),
+                  (f"{fp.shadow_topic}/update/rejected", _on_shadow_rejected)]
+        if SHADOW_PUSH:
+            topics += [(f"{fp.shadow_topic}/update/documents", _on_shadow_documents),
+                       (f"{fp.shadow_topic}/update/delta", _on_shadow_delta)]
+        for topic, callback in topics:
+            fut, _ = conn.subscribe(topic=topic, qos=awsmqtt.QoS.AT_LEAST_ONCE, callback=on_loop(callback))
+            fut.result(timeout=10)
+    if SHADOW_PUSH:
+        _push_active = True
+        log.info(f"Subscribed to shadow update documents/delta for {len(DEVICES)} device(s)")
+        stream_availability()
+
+def _drop_aws_conn():
+    global aws_conn, _push_active
+    with _aws_conn_lock:
+        conn, aws_conn = aws_conn, None
+        _push_active = False
+    # Let the poll loop re-establish the shadow subscription straight away
+    wake_poller()
+    stream_availability()
+    if conn is not None:
+        try:
+            conn.disconnect()
+        except Exception as e:
+            log.warning(f"AWS IoT disconnect failed: {e}")
+
+def aws_publish(fp, payload_dict):
+    """Publish a shadow update within the request budget, retrying transient failures."""
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        aws_request(fp, "update_shadow", _publish_update, fp, payload_dict)
+        ok = True
+    finally:
+        record("pub", d=fp.thing, cid=payload_dict.get("state", {}).get("desired", {}).get("CID"),
+               ms=round((time.perf_counter() - t0) * 1000, 1), ok=ok)
+
+def _publish_update(fp, payload_dict):
+    """Publish a shadow update and block until the QoS1 PUBACK arrives."""
+    conn = get_aws_conn()
+    try:
+        with M_AWS_PUBLISH.time():
+            with span("publish"):
+                fut, _ = conn.publish(
+                    topic=f"{fp.shadow_topic}/update",
+                    payload=json.dumps(payload_dict),
+                    qos=awsmqtt.QoS.AT_LEAST_ONCE
+                )
+            with span("ack_wait"):
+                fut.result(timeout=AWS_PUBACK_TIMEOUT)
+    except Exception:
+        # Start over with a fresh session rather than reuse one that lost a publish
+        _drop_aws_conn()
+        raise
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# CID Sequencer
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# CIDs are allocated in-process under a lock, seeded from the first shadow we see
+# and kept current by every shadow stored afterwards. A CID we didn't issue that is
+# ahead of ours (app, another bridge) moves the sequence past it; a CID we issued
+# that comes back with a different command means someone raced us to it.
 
-def next_cid():
-    shadow = get_shadow()
-    return str(int(shadow["state"]["desired"]["CID"]) + 1)
+CID_HISTORY = 64
+
+def _shadow_cid_cmd(shadow):
+    d = shadow.get("state", {}).get("desired", {})
+    cmd = d.get("CMD_LST", {}).get("CMD_steps", [{}])[0].get("C", "")
+    return d.get("CID"), cmd
+
+def observe_cid(fp, cid, cmd):
+    """Fold a CID seen in the shadow into the device's sequence."""
+    try:
+        cid = int(cid)
+    except (TypeError, ValueError):
+        return
+    with fp.cid_lock:
+        ours = fp.cid_issued.get(cid)
+        if ours is not None and ours != cmd:
+            log.warning(f"{fp.thing}: CID {cid} conflict: sent {ours}, shadow has {cmd}")
+        if fp.cid_last is None:
+            fp.cid_last = cid
+        elif cid > fp.cid_last:
+            if ours is None:
+                log.info(f"{fp.thing}: CID resync: shadow at {cid}, local sequence at {fp.cid_last}")
+            fp.cid_last = cid
+
+def next_cid(fp, cmd=""):
+    """Allocate the next CID without a shadow read (except to seed the sequence)."""
+    with M_NEXT_CID.time(), span("cid_alloc"):
+        if fp.cid_last is None:
+            observe_cid(fp, *_shadow_cid_cmd(get_shadow(fp)))
+        with fp.cid_lock:
+            fp.cid_last += 1
+            fp.cid_issued[fp.cid_last] = cmd
+            if len(fp.cid_issued) > CID_HISTORY:
+                del fp.cid_issued[next(iter(fp.cid_issued))]
+            return str(fp.cid_last)
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# Command Acknowledgements
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# Every command we publish is tracked by CID: sent -> accepted (shadow/update/accepted
+# with our clientToken) -> applied (the hub's reported state reflects it). It can also
+# end rejected, superseded (a later CID took over first), failed or timed out. Hubs that
+# don't echo CID in reported leave nothing to confirm against: their commands end
+# unconfirmed once the shadow carries them.
+
+ACK_PENDING = ("sent", "accepted")
+
+def _client_token(cid):
+    return f"iflame-bridge-{cid}"
+
+def _command_progress(shadow, cid):
+    """'applied' / 'superseded' once the shadow shows the hub acted on cid, 'unconfirmed' if
+    the hub can't show it, else None."""
+    state = shadow.get("state", {})
+    desired_cid, _ = _shadow_cid_cmd(shadow)
+    reported = state.get("reported", {})
+    try:
+        cid, desired_cid = int(cid), int(desired_cid)
+        if desired_cid < cid:
+            return None
+        if desired_cid > cid:
+            return "superseded"
+        if "CID" in reported:
+            return "applied" if int(reported["CID"]) >= cid else None
+    except (TypeError, ValueError):
+        return None
+    # No CID echo: ST1 already matches most simple commands, so it can't confirm anything
+    return "unconfirmed"
+
+def track_command(fp, cid, cmd):
+    with fp.ack_cond:
+        fp.commands[cid] = {"cid": cid, "cmd": cmd, "device": fp.slug, "state": "sent", "sent": time.time(),
+                            "puback_ms": None, "accepted_ms": None, "applied_ms": None, "error": None}
+        _ack_changed(fp, fp.commands[cid])
+        while len(fp.commands) > CID_HISTORY:
+            del fp.commands[next(iter(fp.commands))]
+
+def _ack_changed(fp, rec):
+    """Wake waiters and stream the new state; call with fp.ack_cond held."""
+    fp.ack_cond.notify_all()
+    for loop, event in fp.ack_waiters:
+        loop.call_soon_threadsafe(event.set)
+    broadcast("ack", fp.slug, dict(rec))
+
+def _update_command(fp, cid, **fields):
+    with fp.ack_cond:
+        rec = fp.commands.get(cid)
+        if rec is None:
+            return
+        rec.update(fields)
+        _ack_changed(fp, rec)
+
+def command_published(fp, cid):
+    with fp.ack_cond:
+        rec = fp.commands.get(cid)
+        if rec is not None and rec["puback_ms"] is None:
+            rec["puback_ms"] = round((time.time() - rec["sent"]) * 1000, 1)
+
+def command_failed(fp, cid, error):
+    _update_command(fp, cid, state="failed", error=str(error))
+
+def _resolve_commands(fp, shadow):
+    """Settle pending commands against a shadow we just stored."""
+    now = time.time()
+    with fp.ack_cond:
+        for rec in fp.commands.values():
+            if rec["state"] not in ACK_PENDING:
+                continue
+            progress = _command_progress(shadow, rec["cid"])
+            if progress is None:
+                continue
+            rec["state"] = progress
+            if progress == "applied":
+                rec["applied_ms"] = round((now - rec["sent"]) * 1000, 1)
+                M_COMMAND_ACK.observe(now - rec["sent"], stage="applied")
+            _ack_changed(fp, rec)
+
+def _on_shadow_accepted(topic, payload, **kwargs):
+    fp = _shadow_device(topic)
+    if fp is None:
+        return
+    try:
+        msg = json.loads(payload)
+        token = msg.get("clientToken", "")
+        if not token.startswith(_client_token("")):
+            return
+        cid = token[len(_client_token("")):]
+        with fp.ack_cond:
+            rec = fp.commands.get(cid)
+            if rec is not None and rec["state"] == "sent":
+                now = time.time()
+                rec["state"] = "accepted"
+                rec["accepted_ms"] = round((now - rec["sent"]) * 1000, 1)
+                rec["version"] = msg.get("version")
+                M_COMMAND_ACK.observe(now - rec["sent"], stage="accepted")
+                _ack_changed(fp, rec)
+    except Exception as e:
+        log.error(f"{fp.thing}: update/accepted failed: {e}")
+
+def _on_shadow_rejected(topic, payload, **kwargs):
+    fp = _shadow_device(topic)
+    if fp is None:
+        return
+    try:
+        msg = json.loads(payload)
+        token = msg.get("clientToken", "")
+        if token.startswith(_client_token("")):
+            cid = token[len(_client_token("")):]
+            log.error(f"{fp.thing}: CID {cid} rejected: {msg.get('code')} {msg.get('message')}")
+            _update_command(fp, cid, state="rejected", error=f"{msg.get('code')} {msg.get('message')}")
+    except Exception as e:
+        log.error(f"{fp.thing}: update/rejected failed: {e}")
+
+def command_status(fp, cid, wait=0):
+    """The command's record (copy), waiting up to `wait` seconds for it to settle."""
+    deadline = time.time() + wait
+    with fp.ack_cond:
+        rec = fp.commands.get(cid)
+        while rec is not None and rec["state"] in ACK_PENDING:
+            if time.time() - rec["sent"] > COMMAND_ACK_TIMEOUT:
+                rec["state"] = "timeout"
+                break
+            remaining = min(deadline, rec["sent"] + COMMAND_ACK_TIMEOUT) - time.time()
+            if remaining <= 0:
+                break
+            fp.ack_cond.wait(remaining)
+            rec = fp.commands.get(cid)
+        return dict(rec) if rec is not None else None
+
+async def command_status_async(fp, cid, wait=0):
+    """command_status() on the event loop: the wait holds no thread."""
+    deadline = time.time() + wait
+    waiter = (asyncio.get_running_loop(), asyncio.Event())
+    with fp.ack_cond:
+        fp.ack_waiters.add(waiter)
+    try:
+        while True:
+            waiter[1].clear()
+            rec = command_status(fp, cid)
+            if rec is None or rec["state"] not in ACK_PENDING:
+                return rec
+            remaining = min(deadline, rec["sent"] + COMMAND_ACK_TIMEOUT) - time.time()
+            if remaining <= 0:
+                return rec
+            try:
+                await asyncio.wait_for(waiter[1].wait(), remaining)
+            except TimeoutError:
+                pass
+    finally:
+        with fp.ack_cond:
+            fp.ack_waiters.discard(waiter)
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # Protocol Encoding/Decoding
@@ -127,76 +1488,40 @@ def next_cid():
 #   bits 4-6: fan level (0=off, 1-6)
 #   bit 3:    ember light (0=off, 1=on)
 #   bits 0-2: flame level (0=off, 1-6)
+#
+# Decoding is table-driven and cached in iflame_codec; these wrappers keep the dict API.
 
 def decode_control_byte(value):
     """Decode the control byte into on/off and overhead light level."""
-    value = int(value)
-    on = value & 1
-    overhead = (value >> 4) & 7
+    on, overhead = codec.decode_control_byte(value)
     return {"on": on, "overhead": overhead}
 
 def encode_control_byte(on, overhead):
     """Encode on/off and overhead light level into control byte."""
-    return 128 + (overhead * 16) + (1 if on else 0)
+    return codec.encode_control_byte(on, overhead)
 
 def decode_fan_flame_byte(value):
     """Decode the fan/flame byte into split, fan, ember, flame."""
-    value = int(value)
-    split = (value >> 7) & 1
-    fan = (value >> 4) & 7
-    ember = (value >> 3) & 1
-    flame = value & 7
+    split, fan, ember, flame = codec.decode_fan_flame_byte(value)
     return {"split": split, "fan": fan, "ember": ember, "flame": flame}
 
 def encode_fan_flame_byte(split, fan, ember, flame):
     """Encode split, fan, ember, flame into fan/flame byte."""
-    return (split * 128) + (fan * 16) + (ember * 8) + flame
+    return codec.encode_fan_flame_byte(split, fan, ember, flame)
 
 def parse_cmd_string(cmd):
-    """Parse a command string into all its components."""
-    parts = cmd.split(":") if cmd else []
-    if len(parts) == 6:
-        # Smart mode: 2:2:1:target_F:control_byte:fan_flame_byte
-        mode = "smart"
-        target_temp = int(parts[3])
-        ctrl = decode_control_byte(int(parts[4]))
-        ff = decode_fan_flame_byte(int(parts[5]))
-    elif len(parts) == 5:
-        # Simple mode: 2:0:1:control_byte:fan_flame_byte
-        mode = "simple"
-        ctrl = decode_control_byte(int(parts[3]))
-        ff = decode_fan_flame_byte(int(parts[4]))
-        target_temp = 0
-    else:
-        return {"mode": "unknown", "is_on": False, "target_temp": 0,
-                "overhead": 0, "fan": 0, "flame": 0, "ember": 0, "split": 0}
-
-    return {
-        "mode": mode,
-        "is_on": bool(ctrl["on"]),
-        "target_temp": target_temp,
-        "overhead": ctrl["overhead"],
-        "fan": ff["fan"],
-        "flame": ff["flame"],
-        "ember": ff["ember"],
-        "split": ff["split"],
-    }
+    """Parse a command string into all its components (a fresh dict per call)."""
+    return codec.decode(cmd)._asdict()
 
 def build_cmd(mode, is_on, target_temp, overhead, fan, flame, ember, split):
     """Build a complete command string from all parameters."""
-    ctrl_byte = encode_control_byte(is_on, overhead)
-    ff_byte = encode_fan_flame_byte(split, fan, ember, flame)
-    if mode == "smart":
-        return f"2:2:1:{target_temp}:{ctrl_byte}:{ff_byte}"
-    else:
-        return f"2:0:1:{ctrl_byte}:{ff_byte}"
+    return codec.encode(mode, is_on, target_temp, overhead, fan, flame, ember, split)
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # Shadow → State Parser
 # ═══════════════════════════════════════════════════════════════════════════════
 
-def parse_shadow(shadow):
-    global _last_known_target
+def parse_shadow(fp, shadow):
     d = shadow["state"]["desired"]
     r = shadow["state"]["reported"]
     at = float(r["AT"])
@@ -205,7 +1530,8 @@ def parse_shadow(shadow):
     parsed = parse_cmd_string(cmd)
 
     if parsed["mode"] == "smart":
-        _last_known_target = parsed["target_temp"]
+        with _state_lock:
+            fp.last_known_target = parsed["target_temp"]
 
     # thermostat_active: hub has a target temp and is managing on/off cycling
     thermostat_active = st1 > 0
@@ -235,16 +1561,31 @@ def parse_shadow(shadow):
 # Fireplace Commands
 # ═══════════════════════════════════════════════════════════════════════════════
 
-def _send_cmd(cmd):
+# build_cmd() arguments, in order; parse_cmd_string() returns the same keys
+CMD_FIELDS = ("mode", "is_on", "target_temp", "overhead", "fan", "flame", "ember", "split")
+
+def _send_cmd(fp, cmd):
     """Send a command string to the fireplace."""
-    cid = next_cid()
-    aws_publish({"state": {"desired": {"CID": cid, "CMD_LST": {"CMD_steps": [{"C": cmd, "D": 0.2}]}}}})
-    log.info(f"CMD sent: {cmd} CID={cid}")
+    with span("send_cmd", cmd=cmd) as sp:
+        cid = sp.args["cid"] = next_cid(fp, cmd)
+        track_command(fp, cid, cmd)
+        before = cached_version(fp)
+        try:
+            aws_publish(fp, {"state": {"desired": {"CID": cid, "CMD_LST": {"CMD_steps": [{"C": cmd, "D": 0.2}]}}},
+                             "clientToken": _client_token(cid)})
+        except Exception as e:
+            command_failed(fp, cid, e)
+            raise
+        command_published(fp, cid)
+    invalidate_shadow(fp, before)
+    expect_convergence(fp, cid, cmd)
+    log.info(f"{fp.thing}: CMD sent: {cmd} CID={cid}")
     return cid
 
-def _get_current_state():
+def _get_current_state(fp):
     """Read current state from shadow."""
-    shadow = get_shadow()
+    with span("state_read"):
+        shadow = get_shadow(fp)
     d = shadow["state"]["desired"]
     r = shadow["state"]["reported"]
     cmd = d.get("CMD_LST", {}).get("CMD_steps", [{}])[0].get("C", "")
@@ -252,95 +1593,500 @@ def _get_current_state():
     parsed["AT"] = float(r["AT"])
     return parsed
 
-def do_on():
-    s = _get_current_state()
+def do_on(fp):
+    s = _get_current_state(fp)
     cmd = build_cmd("simple", True, 0, s["overhead"], s["fan"], s["flame"], s["ember"], s["split"])
-    cid = _send_cmd(cmd)
-    poll_and_publish()
+    cid = _send_cmd(fp, cmd)
+    poll_and_publish(fp)
     return {"ok": True, "cid": cid, "cmd": cmd}
 
-def do_off():
-    s = _get_current_state()
+def do_off(fp):
+    s = _get_current_state(fp)
     cmd = build_cmd("simple", False, 0, s["overhead"], s["fan"], s["flame"], s["ember"], s["split"])
-    cid = _send_cmd(cmd)
-    poll_and_publish()
+    cid = _send_cmd(fp, cmd)
+    poll_and_publish(fp)
     return {"ok": True, "cid": cid, "cmd": cmd}
 
-def do_smart(temp):
+def do_update(fp, **changes):
+    """Apply any subset of CMD_FIELDS on top of the current state as one command."""
+    s = _get_current_state(fp)
+    fields = {k: s[k] for k in CMD_FIELDS}
+    fields.update(changes)
+    cmd = build_cmd(**fields)
+    cid = _send_cmd(fp, cmd)
+    poll_and_publish(fp)
+    return {"ok": True, "cid": cid, "cmd": cmd}
+
+def do_smart(fp, temp, **changes):
     try:
-        s = _get_current_state()
+        s = _get_current_state(fp)
         ambient = s["AT"]
     except Exception as e:
         log.warning(f"Could not read state for smart decision: {e}")
         ambient = 0
         s = {"overhead": 0, "fan": 0, "flame": 0, "ember": 0, "split": 0}
+    s.update(changes)
 
     if temp > ambient:
         # Step 1: simple ON
         cmd1 = build_cmd("simple", True, 0, s["overhead"], s["fan"], s["flame"], s["ember"], s["split"])
-        cid1 = _send_cmd(cmd1)
+        cid1 = _send_cmd(fp, cmd1)
         log.info(f"SMART step 1 - simple ON: CID={cid1} (target {temp}F > ambient {ambient}F)")
-        time.sleep(3)
+        if not command_sleep(fp, 3):
+            log.info(f"SMART cancelled after step 1 (CID={cid1})")
+            return {"ok": False, "cid": cid1, "cmd": cmd1, "cancelled": True}
         # Step 2: smart command
         cmd2 = build_cmd("smart", True, temp, s["overhead"], s["fan"], s["flame"], s["ember"], s["split"])
-        cid2 = _send_cmd(cmd2)
+        cid2 = _send_cmd(fp, cmd2)
         log.info(f"SMART step 2 - target {temp}F: CID={cid2}")
-        poll_and_publish()
+        poll_and_publish(fp)
         return {"ok": True, "cid": cid2, "cmd": cmd2, "target_temp": temp}
     else:
         log.info(f"SMART: target {temp}F <= ambient {ambient}F, sending OFF")
-        return do_off()
+        if changes:
+            return do_update(fp, mode="simple", is_on=False, target_temp=0, **changes)
+        return do_off(fp)
 
-def do_set_fan(level):
+def do_set_fan(fp, level):
     level = max(0, min(6, int(level)))
-    s = _get_current_state()
+    s = _get_current_state(fp)
     cmd = build_cmd(s["mode"], s["is_on"], s["target_temp"], s["overhead"],
                     level, s["flame"], s["ember"], s["split"])
-    cid = _send_cmd(cmd)
+    cid = _send_cmd(fp, cmd)
     log.info(f"FAN set to {level}")
-    poll_and_publish()
+    poll_and_publish(fp)
     return {"ok": True, "cid": cid, "fan": level}
 
-def do_set_flame(level):
+def do_set_flame(fp, level):
     level = max(0, min(6, int(level)))
-    s = _get_current_state()
+    s = _get_current_state(fp)
     cmd = build_cmd(s["mode"], s["is_on"], s["target_temp"], s["overhead"],
                     s["fan"], level, s["ember"], s["split"])
-    cid = _send_cmd(cmd)
+    cid = _send_cmd(fp, cmd)
     log.info(f"FLAME set to {level}")
-    poll_and_publish()
+    poll_and_publish(fp)
     return {"ok": True, "cid": cid, "flame": level}
 
-def do_set_split(split_on):
+def do_set_split(fp, split_on):
     split = 1 if split_on else 0
-    s = _get_current_state()
+    s = _get_current_state(fp)
     cmd = build_cmd(s["mode"], s["is_on"], s["target_temp"], s["overhead"],
                     s["fan"], s["flame"], s["ember"], split)
-    cid = _send_cmd(cmd)
+    cid = _send_cmd(fp, cmd)
     log.info(f"SPLIT set to {'F+B' if split else 'Front'}")
-    poll_and_publish()
+    poll_and_publish(fp)
     return {"ok": True, "cid": cid, "split": split}
 
-def do_set_ember(ember_on):
+def do_set_ember(fp, ember_on):
     ember = 1 if ember_on else 0
-    s = _get_current_state()
+    s = _get_current_state(fp)
     cmd = build_cmd(s["mode"], s["is_on"], s["target_temp"], s["overhead"],
                     s["fan"], s["flame"], ember, s["split"])
-    cid = _send_cmd(cmd)
+    cid = _send_cmd(fp, cmd)
     log.info(f"EMBER set to {'ON' if ember else 'OFF'}")
-    poll_and_publish()
+    poll_and_publish(fp)
     return {"ok": True, "cid": cid, "ember": ember}
 
-def do_set_overhead(level):
+def do_set_overhead(fp, level):
     level = max(0, min(5, int(level)))
-    s = _get_current_state()
+    s = _get_current_state(fp)
     cmd = build_cmd(s["mode"], s["is_on"], s["target_temp"], level,
                     s["fan"], s["flame"], s["ember"], s["split"])
-    cid = _send_cmd(cmd)
+    cid = _send_cmd(fp, cmd)
     log.info(f"OVERHEAD set to {level}")
-    poll_and_publish()
+    poll_and_publish(fp)
     return {"ok": True, "cid": cid, "overhead": level}
 
+# ═══════════════════════════════════════════════════════════════════════════════
+# Command Executor
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# One worker thread per device runs its commands, so the paho and Flask threads only
+# enqueue and a slow fireplace never holds up the others.
+# URGENT (OFF) jumps the queue and cancels everything submitted before it,
+# including a smart sequence waiting between its two steps. Only NORMAL commands
+# count against COMMAND_QUEUE_MAX: an OFF is never turned away.
+
+PRIO_URGENT = 0
+PRIO_NORMAL = 1
+
+class CommandQueueFull(Exception):
+    pass
+
+def submit_command(fp, fn, *args, priority=PRIO_NORMAL, origin=None, **kwargs):
+    """Queue fn(fp, *args, **kwargs) for the device's command worker; returns a Future.
+
+    origin labels the trace; REST requests default to their path.
+    """
+    fut = Future()
+    seq = next(_cmd_seq)
+    if origin is None:
+        origin = f"rest {request.path}" if has_request_context() else "internal"
+    with fp.cmd_cond:
+        if priority != PRIO_URGENT and fp.cmd_queue.qsize() >= COMMAND_QUEUE_MAX:
+            log.warning(f"{fp.thing}: command queue full ({COMMAND_QUEUE_MAX}), rejecting {fn.__name__}")
+            raise CommandQueueFull(f"command queue full ({COMMAND_QUEUE_MAX})")
+        fp.cmd_queue.put_nowait((priority, seq, fn, args, kwargs, fut, Trace(fp, fn.__name__, origin)))
+        if priority == PRIO_URGENT:
+            fp.cmd_cancel_seq = seq
+            fp.cmd_cond.notify_all()
+    if priority == PRIO_URGENT and fn is not flush_changes:
+        # The queued HA batch will be cancelled by this command; don't leave it marked queued
+        discard_changes(fp)
+    depth = fp.cmd_queue.qsize()
+    if depth > COMMAND_QUEUE_MAX // 2:
+        log.warning(f"{fp.thing}: command queue depth {depth}/{COMMAND_QUEUE_MAX}")
+    return fut
+
+def run_command(fp, fn, *args, priority=PRIO_NORMAL, origin=None, **kwargs):
+    """Submit and wait: for REST routes, which answer with the command result."""
+    return submit_command(fp, fn, *args, priority=priority, origin=origin, **kwargs).result(timeout=COMMAND_TIMEOUT)
+
+def command_queue_depth(fp=None):
+    return sum(d.cmd_queue.qsize() for d in ([fp] if fp else DEVICES))
+
+def command_sleep(fp, secs):
+    """Sleep inside a command; returns False if an urgent command cancelled it."""
+    with M_COMMAND_SLEEP.time(), span("sleep", secs=secs), fp.cmd_cond:
+        return not fp.cmd_cond.wait_for(lambda: fp.cmd_current_seq < fp.cmd_cancel_seq, timeout=secs)
+
+def start_command_workers():
+    for fp in DEVICES:
+        threading.Thread(target=command_worker, args=(fp,), daemon=True, name=f"cmd-{fp.slug}").start()
+
+def command_worker(fp):
+    while True:
+        job = fp.cmd_queue.get()
+        try:
+            _run_job(fp, *job)
+        finally:
+            fp.cmd_queue.task_done()
+
+def _run_job(fp, priority, seq, fn, args, kwargs, fut, trace):
+    if not fut.set_running_or_notify_cancel():
+        return
+    if priority != PRIO_URGENT and seq < fp.cmd_cancel_seq:
+        log.info(f"{fp.thing}: dropping {fn.__name__}: superseded by an urgent command")
+        fut.set_result({"ok": False, "cancelled": True})
+        return
+    with fp.cmd_cond:
+        fp.cmd_current_seq = seq
+    trace.start = time.time()
+    _trace_local.trace = trace
+    try:
+        with M_COMMAND.time(device=fp.slug, command=fn.__name__):
+            result = fn(fp, *args, **kwargs)
+        if isinstance(result, dict):
+            trace.tags.update({k: result[k] for k in ("ok", "cid", "cmd", "cancelled") if k in result})
+        fut.set_result(result)
+    except Exception as e:
+        log.error(f"{fp.thing}: command failed: {e}")
+        trace.tags["error"] = str(e)
+        fut.set_exception(e)
+    finally:
+        _trace_local.trace = None
+        trace.end = time.time()
+        _traces.append(trace)
+
+def drain_commands(timeout):
+    """Wait for every device's queued and running commands; returns True if all finished."""
+    deadline = time.time() + timeout
+    while any(fp.cmd_queue.unfinished_tasks for fp in DEVICES):
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# Command Coalescing
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# HA commands merge into one pending batch of field changes. The batch is queued
+# COMMAND_COALESCE_SECS after its first change and taken when the worker reaches
+# it, so changes made while the worker is busy fold into the same command.
+# "power" is the on/off/thermostat intent: "on", "off", "heat" or a target temp;
+# "off" skips the window and goes out as an URGENT command.
+
+def queue_change(fp, **changes):
+    """Merge field changes into the pending batch; later values supersede earlier ones."""
+    with fp.pending_lock:
+        for k, v in changes.items():
+            if k in fp.pending and fp.pending[k] != v:
+                log.debug(f"{fp.thing}: coalesced {k}: {fp.pending[k]} superseded by {v}")
+        fp.pending.update(changes)
+        if changes.get("power") == "off":
+            if fp.pending_timer is not None:
+                fp.pending_timer.cancel()
+                fp.pending_timer = None
+            _queue_batch(fp, PRIO_URGENT)
+        elif fp.pending_timer is None and not fp.batch_queued:
+            fp.pending_timer = call_later(COMMAND_COALESCE_SECS, _queue_batch, fp)
+
+def _queue_batch(fp, priority=PRIO_NORMAL):
+    with fp.pending_lock:
+        fp.pending_timer = None
+        try:
+            submit_command(fp, flush_changes, priority=priority, origin="ha")
+            fp.batch_queued = True
+        except CommandQueueFull:
+            log.error(f"{fp.thing}: dropping command batch: {fp.pending}")
+            fp.pending.clear()
+
+def discard_changes(fp):
+    """Drop the pending batch (timer, queued job, changes): an urgent command superseded it."""
+    with fp.pending_lock:
+        if fp.pending_timer is not None:
+            fp.pending_timer.cancel()
+            fp.pending_timer = None
+        if fp.pending:
+            log.info(f"{fp.thing}: discarding command batch superseded by an urgent command: {fp.pending}")
+        fp.pending.clear()
+        fp.batch_queued = False
+
+def flush_changes(fp):
+    with fp.pending_lock:
+        changes, fp.pending = fp.pending, {}
+        fp.batch_queued = False
+    if not changes:
+        return
+    trace_tag(changes=dict(changes))
+    log.info(f"{fp.thing}: flushing command batch: {changes}")
+    return apply_changes(fp, changes)
+
+def _heat_target(fp):
+    """Pick a thermostat target for HA's 'heat' mode: last target, bumped above ambient."""
+    with _state_lock:
+        last = fp.last_known_target
+    target = last if last and last > 60 else 72
+    try:
+        shadow = get_shadow(fp)
+        ambient = float(shadow["state"]["reported"]["AT"])
+        if target <= ambient:
+            target = int(ambient) + 2
+            log.info(f"Heat mode: target {last}F <= ambient {ambient}F, bumped to {target}F")
+    except Exception as e:
+        log.warning(f"Could not check ambient for heat mode: {e}")
+        if target <= 72:
+            target = 74
+    log.info(f"Heat mode: sending SMART at {target}F")
+    return target
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# Multi-field State Changes + Presets
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# PATCH /state, the JSON state/set topic and presets all reduce a body such as
+# {"flame": 4, "fan": 2, "ember": true, "mode": "smart", "target_temp": 74}
+# to one set of queue_change() fields, so a whole scene goes out as one command.
+
+STATE_FIELDS = {"fan": 6, "flame": 6, "overhead": 5, "ember": 1, "split": 1}
+STATE_MODES = {"off": "off", "on": "on", "simple": "on", "heat": "heat", "smart": "heat", "thermostat": "heat"}
+TARGET_TEMP_MIN, TARGET_TEMP_MAX = 60, 83  # °F, what the hub's thermostat accepts
+
+_presets_lock = threading.Lock()
+_presets = {}
+
+def _as_level(field, value):
+    if isinstance(value, str) and value.lower() in ("on", "true", "off", "false"):
+        value = value.lower() in ("on", "true")
+    return max(0, min(STATE_FIELDS[field], int(value)))
+
+def state_changes(body):
+    """Validate a state body (optionally naming a preset) into queue_change() fields."""
+    if not isinstance(body, dict):
+        raise ValueError("expected a JSON object")
+    body = dict(body)
+    if "preset" in body:
+        name = body.pop("preset")
+        with _presets_lock:
+            preset = _presets.get(name)
+        if preset is None:
+            raise ValueError(f"unknown preset {name!r}")
+        body = {**preset, **body}
+    changes = {f: _as_level(f, body.pop(f)) for f in STATE_FIELDS if f in body}
+    mode = body.pop("mode", None)
+    target = body.pop("target_temp", body.pop("temp", None))
+    if mode is not None and str(mode).lower() not in STATE_MODES:
+        raise ValueError(f"unknown mode {mode!r} (expected one of {sorted(STATE_MODES)})")
+    if body:
+        raise ValueError(f"unknown fields: {sorted(body)}")
+    power = STATE_MODES.get(str(mode).lower()) if mode is not None else None
+    if target is not None:
+        if power not in (None, "heat"):
+            raise ValueError(f"target_temp needs mode heat/smart or no mode, not {mode!r}")
+        try:
+            power = int(float(target))
+        except (TypeError, ValueError):
+            raise ValueError(f"target_temp must be a number, not {target!r}")
+        if not TARGET_TEMP_MIN <= power <= TARGET_TEMP_MAX:
+            raise ValueError(f"target_temp must be {TARGET_TEMP_MIN}-{TARGET_TEMP_MAX}F, not {target}")
+    if power is not None:
+        changes["power"] = power
+    if not changes:
+        raise ValueError("no changes given")
+    return changes
+
+def apply_changes(fp, changes):
+    """Send merged field changes (plus optional power) as one command; runs on the worker."""
+    changes = dict(changes)
+    power = changes.pop("power", None)
+    if power == "on":
+        return do_update(fp, mode="simple", is_on=True, target_temp=0, **changes)
+    elif power == "off":
+        return do_update(fp, mode="simple", is_on=False, target_temp=0, **changes)
+    elif power == "heat":
+        result = do_smart(fp, _heat_target(fp), **changes)
+        with _state_lock:
+            fp.last_mode_change = time.time()
+        return result
+    elif power is not None:
+        return do_smart(fp, power, **changes)
+    return do_update(fp, **changes)
+
+def load_presets():
+    global _presets
+    try:
+        with open(PRESETS_PATH) as f:
+            presets = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        log.warning(f"Could not read presets from {PRESETS_PATH}: {e}")
+        return
+    with _presets_lock:
+        _presets = presets
+    log.info(f"Loaded {len(presets)} preset(s): {', '.join(presets)}")
+
+def _save_presets():
+    with _presets_lock:
+        data = json.dumps(_presets, indent=2, sort_keys=True)
+    os.makedirs(os.path.dirname(PRESETS_PATH), exist_ok=True)
+    tmp = PRESETS_PATH + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(data)
+    os.replace(tmp, PRESETS_PATH)
+
+def set_preset(name, body):
+    if not isinstance(body, dict) or "preset" in body:
+        raise ValueError("a preset is a state object and cannot reference another preset")
+    state_changes(body)
+    with _presets_lock:
+        _presets[name] = body
+    _save_presets()
+
+def delete_preset(name):
+    with _presets_lock:
+        found = _presets.pop(name, None) is not None
+    if found:
+        _save_presets()
+    return found
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# HA Entities
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# One row per HA entity. Discovery configs and command routing are both generated
+# from ENTITIES, so a new control is a new row (plus its handler).
+#   state    – (field, value_template) of the state it shows, via _state_source()
+#   topics   – other discovery keys -> per-device topic suffix
+#   commands – discovery key -> (command topic suffix, handler(fp, payload))
+#   config   – static discovery fields
+
+Entity = collections.namedtuple("Entity", "component object_id unique_id name icon state topics commands config",
+                                defaults=(None, {}, {}, {}))
+
+ON_OFF = {"payload_on": "ON", "payload_off": "OFF"}
+
+def _slider(top):
+    return {"min": 0, "max": top, "step": 1, "mode": "slider"}
+
+def _state_source(fp, field, template):
+    """state_topic/value_template for an entity: the JSON status topic, or its field topic."""
+    if HA_FIELD_TOPICS:
+        return {"state_topic": fp.topic(f"{TOPIC_FIELD_STATE}/{field}"),
+                "value_template": template.replace(f"value_json.{field}", "value_json")}
+    return {"state_topic": fp.topic(TOPIC_STATE), "value_template": template}
+
+def _on_power(fp, payload):
+    if payload == "ON":
+        queue_change(fp, power="on")
+    elif payload == "OFF":
+        queue_change(fp, power="off")
+
+def _on_climate_mode(fp, payload):
+    if payload in ("off", "heat"):
+        queue_change(fp, power=payload)
+        with _state_lock:
+            fp.last_mode_change = time.time()
+
+def _on_climate_temp(fp, payload):
+    _temp = int(float(payload))
+    with _state_lock:
+        if (time.time() - fp.last_mode_change) < 5:
+            log.info(f"Ignoring stale temp {_temp}F ({time.time() - fp.last_mode_change:.1f}s after mode change)")
+            return
+        fp.user_target_temp = _temp
+        fp.user_target_time = time.time()
+        fp.last_known_target = _temp
+    log.info(f"Temp command received: {_temp}F")
+    queue_change(fp, power=_temp)
+
+def _on_level(field, top):
+    def handler(fp, payload):
+        queue_change(fp, **{field: max(0, min(top, int(float(payload))))})
+    return handler
+
+def _on_toggle(field):
+    def handler(fp, payload):
+        queue_change(fp, **{field: 1 if payload in ("ON", "on", "1", "true") else 0})
+    return handler
+
+def _on_state_json(fp, payload):
+    queue_change(fp, **state_changes(json.loads(payload)))
+
+def _on_preset(fp, payload):
+    queue_change(fp, **state_changes({"preset": payload.strip()}))
+
+ENTITIES = (
+    Entity("switch", "iflame_fireplace", "iflame_fireplace_switch", "", "mdi:fireplace",
+           state=("is_on", "{{ 'ON' if value_json.is_on else 'OFF' }}"),
+           commands={"command_topic": (TOPIC_CMD, _on_power)}, config=ON_OFF),
+    Entity("climate", "iflame_thermostat", "iflame_fireplace_thermostat", "Thermostat", "mdi:fireplace",
+           topics={"mode_state_topic": TOPIC_CLIMATE_STATE, "temperature_state_topic": TOPIC_CLIMATE_STATE,
+                   "current_temperature_topic": TOPIC_CLIMATE_STATE},
+           commands={"mode_command_topic": (TOPIC_CLIMATE_MODE_CMD, _on_climate_mode),
+                     "temperature_command_topic": (TOPIC_CLIMATE_TEMP_CMD, _on_climate_temp)},
+           config={"modes": ["off", "heat"], "mode_state_template": "{{ value_json.mode }}",
+                   "temperature_state_template": "{{ value_json.target_temp }}",
+                   "current_temperature_template": "{{ value_json.current_temp }}",
+                   "min_temp": TARGET_TEMP_MIN, "max_temp": TARGET_TEMP_MAX, "temp_step": 1, "temperature_unit": "F"}),
+    Entity("sensor", "iflame_ambient_temp", "iflame_ambient_temp", "Temperature", None,
+           state=("AT", "{{ value_json.AT }}"),
+           config={"unit_of_measurement": "\u00b0F", "device_class": "temperature", "state_class": "measurement"}),
+    Entity("sensor", "iflame_mode", "iflame_mode", "Mode", "mdi:fire", state=("mode", "{{ value_json.mode }}")),
+    Entity("number", "iflame_fan", "iflame_fan_level", "Fan", "mdi:fan", state=("fan", "{{ value_json.fan }}"),
+           commands={"command_topic": (TOPIC_FAN_CMD, _on_level("fan", 6))}, config=_slider(6)),
+    Entity("number", "iflame_flame", "iflame_flame_level", "Flame", "mdi:fire",
+           state=("flame", "{{ value_json.flame }}"),
+           commands={"command_topic": (TOPIC_FLAME_CMD, _on_level("flame", 6))}, config=_slider(6)),
+    Entity("switch", "iflame_split", "iflame_split_flow", "Split Flow", "mdi:arrow-split-vertical",
+           state=("split", "{{ 'ON' if value_json.split == 1 else 'OFF' }}"),
+           commands={"command_topic": (TOPIC_SPLIT_CMD, _on_toggle("split"))}, config=ON_OFF),
+    Entity("switch", "iflame_ember", "iflame_ember_light", "Ember Light", "mdi:fire-circle",
+           state=("ember", "{{ 'ON' if value_json.ember == 1 else 'OFF' }}"),
+           commands={"command_topic": (TOPIC_EMBER_CMD, _on_toggle("ember"))}, config=ON_OFF),
+    Entity("number", "iflame_overhead", "iflame_overhead_lights", "Overhead Lights", "mdi:ceiling-light",
+           state=("overhead", "{{ value_json.overhead }}"),
+           commands={"command_topic": (TOPIC_OVERHEAD_CMD, _on_level("overhead", 5))}, config=_slider(5)),
+)
+
+# Command topic suffix -> handler: every entity command plus the JSON state/preset topics
+HA_COMMANDS = {suffix: handler for e in ENTITIES for suffix, handler in e.commands.values()}
+HA_COMMANDS.update({TOPIC_STATE_CMD: _on_state_json, TOPIC_PRESET_CMD: _on_preset})
+
+# config topic -> sha256 of the payload the broker retains (seen via our subscription)
+_discovery_retained = {}
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # HA MQTT Bridge
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -351,366 +2097,1176 @@ def setup_ha_mqtt():
     ha_mqtt.username_pw_set(HA_MQTT_USER, HA_MQTT_PASS)
     ha_mqtt.will_set(TOPIC_AVAIL, "offline", retain=True)
     ha_mqtt.on_connect = on_ha_connect
+    ha_mqtt.on_disconnect = on_ha_disconnect
     ha_mqtt.on_message = on_ha_message
+    if _loop is not None:
+        # Before connect(): the socket callbacks fire inside it
+        attach_ha_mqtt(ha_mqtt)
     ha_mqtt.connect(HA_MQTT_HOST, HA_MQTT_PORT)
-    ha_mqtt.loop_start()
+    if _loop is None:
+        ha_mqtt.loop_start()
 
 def on_ha_connect(client, userdata, flags, rc, properties=None):
     global _startup_grace
     log.info(f"HA MQTT connected rc={rc}")
-    _startup_grace = time.time() + 5
+    with _state_lock:
+        _startup_grace = time.time() + 5
     client.publish(TOPIC_AVAIL, "online", retain=True)
-    client.subscribe(TOPIC_CMD)
-    client.subscribe(TOPIC_CLIMATE_MODE_CMD)
-    client.subscribe(TOPIC_CLIMATE_TEMP_CMD)
-    client.subscribe(TOPIC_FAN_CMD)
-    client.subscribe(TOPIC_FLAME_CMD)
-    client.subscribe(TOPIC_SPLIT_CMD)
-    client.subscribe(TOPIC_EMBER_CMD)
-    client.subscribe(TOPIC_OVERHEAD_CMD)
-    publish_discovery()
+    for fp in DEVICES:
+        client.subscribe([(fp.topic(suffix), 0) for suffix in HA_COMMANDS])
+        # The retained configs come back on subscribe; publish_discovery compares hashes
+        topics = list(discovery_payloads(fp))
+        for topic in topics:
+            _discovery_retained.pop(topic, None)
+        client.subscribe([(topic, 0) for topic in topics])
+        # The broker may have lost our retained state; republish it in full
+        with fp.publish_lock:
+            fp.published_state = fp.published_climate = None
+            shadow = fp.shadow
+            if shadow is not None and shadow.get("version") == fp.published_version:
+                publish_state(fp, parse_shadow(fp, shadow))
+            elif shadow is not None:
+                publish_shadow(fp, shadow)
+            elif fp.warm_state is not None:
+                publish_state(fp, fp.warm_state)
+    call_later(HA_DISCOVERY_SETTLE, _publish_all_discovery)
+    startup_phase("ha_connected")
+    stream_availability()
+
+def on_ha_disconnect(client, userdata, flags, rc, properties=None):
+    log.warning(f"HA MQTT disconnected rc={rc}")
+    stream_availability()
+
+def _route_ha_topic(topic):
+    """Map an HA command topic to (device, command suffix); None if it isn't ours."""
+    for fp in DEVICES:
+        if topic.startswith(fp.prefix + "/"):
+            suffix = topic[len(fp.prefix) + 1:]
+            if suffix in HA_COMMANDS:
+                return fp, suffix
+    return None
 
 def on_ha_message(client, userdata, msg):
-    global _last_known_target, _user_target_temp, _user_target_time, _last_mode_change
+    if msg.topic.startswith("homeassistant/"):
+        # Our own retained discovery configs, echoed back on subscribe
+        _discovery_retained[msg.topic] = _digest(msg.payload)
+        return
     payload = msg.payload.decode()
-    topic = msg.topic
+    route = _route_ha_topic(msg.topic)
+    if route is None:
+        return
+    fp, topic = route
 
     if time.time() < _startup_grace:
-        log.info(f"Ignoring retained msg on {topic}: {payload} (startup grace)")
+        log.info(f"Ignoring retained msg on {msg.topic}: {payload} (startup grace)")
         return
 
-    log.info(f"HA command on {topic}: {payload}")
+    log.info(f"HA command on {msg.topic}: {payload}")
+    M_HA_COMMANDS.inc(device=fp.slug, topic=topic)
+    record("ha", d=fp.thing, topic=topic, p=payload)
     try:
-        if topic == TOPIC_CMD:
-            if payload == "ON":
-                do_on()
-            elif payload == "OFF":
-                do_off()
-
-        elif topic == TOPIC_CLIMATE_MODE_CMD:
-            if payload == "off":
-                do_off()
-                _last_mode_change = time.time()
-            elif payload == "heat":
-                target = _last_known_target if _last_known_target and _last_known_target > 60 else 72
-                try:
-                    shadow = get_shadow()
-                    ambient = float(shadow["state"]["reported"]["AT"])
-                    if target <= ambient:
-                        target = int(ambient) + 2
-                        log.info(f"Heat mode: target {_last_known_target}F <= ambient {ambient}F, bumped to {target}F")
-                except Exception as e:
-                    log.warning(f"Could not check ambient for heat mode: {e}")
-                    if target <= 72:
-                        target = 74
-                log.info(f"Heat mode: sending SMART at {target}F")
-                do_smart(target)
-                _last_mode_change = time.time()
-
-        elif topic == TOPIC_CLIMATE_TEMP_CMD:
-            _temp = int(float(payload))
-            if (time.time() - _last_mode_change) < 5:
-                log.info(f"Ignoring stale temp {_temp}F ({time.time() - _last_mode_change:.1f}s after mode change)")
-                return
-            _user_target_temp = _temp
-            _user_target_time = time.time()
-            _last_known_target = _temp
-            log.info(f"Temp command received: {_temp}F")
-            do_smart(_temp)
-
-        elif topic == TOPIC_FAN_CMD:
-            do_set_fan(int(float(payload)))
-
-        elif topic == TOPIC_FLAME_CMD:
-            do_set_flame(int(float(payload)))
-
-        elif topic == TOPIC_SPLIT_CMD:
-            if payload in ("ON", "on", "1", "true"):
-                do_set_split(True)
-            else:
-                do_set_split(False)
-
-        elif topic == TOPIC_EMBER_CMD:
-            if payload in ("ON", "on", "1", "true"):
-                do_set_ember(True)
-            else:
-                do_set_ember(False)
-
-        elif topic == TOPIC_OVERHEAD_CMD:
-            do_set_overhead(int(float(payload)))
-
+        HA_COMMANDS[topic](fp, payload)
     except Exception as e:
         log.error(f"Command failed: {e}")
 
-def publish_discovery():
+def _digest(payload):
+    return hashlib.sha256(payload).hexdigest()
+
+def discovery_payloads(fp):
+    """{config topic: JSON payload} for every entity in ENTITIES."""
     dev = {
-        "identifiers": ["iflame_rff_10fdc28"],
-        "name": "iFlame Fireplace",
+        "identifiers": [f"iflame_{fp.thing.lower().replace('-', '_')}"],
+        "name": f"iFlame {fp.label}",
         "manufacturer": "iFlame / Girard",
-        "model": "RFF-10FDC28",
+        "model": fp.thing,
         "sw_version": "13.00"
     }
-
-    # Switch (simple on/off)
-    ha_mqtt.publish("homeassistant/switch/iflame_fireplace/config", json.dumps({
-        "name": "Fireplace",
-        "unique_id": "iflame_fireplace_switch",
-        "command_topic": TOPIC_CMD,
-        "state_topic": TOPIC_STATE,
-        "value_template": "{{ 'ON' if value_json.is_on else 'OFF' }}",
-        "payload_on": "ON",
-        "payload_off": "OFF",
-        "availability_topic": TOPIC_AVAIL,
-        "icon": "mdi:fireplace",
-        "device": dev,
-    }), retain=True)
-
-    # Climate (smart thermostat)
-    ha_mqtt.publish("homeassistant/climate/iflame_thermostat/config", json.dumps({
-        "name": "Fireplace Thermostat",
-        "unique_id": "iflame_fireplace_thermostat",
-        "modes": ["off", "heat"],
-        "mode_command_topic": TOPIC_CLIMATE_MODE_CMD,
-        "mode_state_topic": TOPIC_CLIMATE_STATE,
-        "mode_state_template": "{{ value_json.mode }}",
-        "temperature_command_topic": TOPIC_CLIMATE_TEMP_CMD,
-        "temperature_state_topic": TOPIC_CLIMATE_STATE,
-        "temperature_state_template": "{{ value_json.target_temp }}",
-        "current_temperature_topic": TOPIC_CLIMATE_STATE,
-        "current_temperature_template": "{{ value_json.current_temp }}",
-        "min_temp": 60,
-        "max_temp": 83,
-        "temp_step": 1,
-        "temperature_unit": "F",
-        "availability_topic": TOPIC_AVAIL,
-        "icon": "mdi:fireplace",
-        "device": dev,
-    }), retain=True)
-
-    # Ambient temp sensor
-    ha_mqtt.publish("homeassistant/sensor/iflame_ambient_temp/config", json.dumps({
-        "name": "Fireplace Temperature",
-        "unique_id": "iflame_ambient_temp",
-        "state_topic": TOPIC_STATE,
-        "value_template": "{{ value_json.AT }}",
-        "unit_of_measurement": "\u00b0F",
-        "device_class": "temperature",
-        "state_class": "measurement",
-        "availability_topic": TOPIC_AVAIL,
-        "device": dev,
-    }), retain=True)
-
-    # Mode sensor
-    ha_mqtt.publish("homeassistant/sensor/iflame_mode/config", json.dumps({
-        "name": "Fireplace Mode",
-        "unique_id": "iflame_mode",
-        "state_topic": TOPIC_STATE,
-        "value_template": "{{ value_json.mode }}",
-        "availability_topic": TOPIC_AVAIL,
-        "icon": "mdi:fire",
-        "device": dev,
-    }), retain=True)
-
-    # Fan level (number 0-6)
-    ha_mqtt.publish("homeassistant/number/iflame_fan/config", json.dumps({
-        "name": "Fireplace Fan",
-        "unique_id": "iflame_fan_level",
-        "command_topic": TOPIC_FAN_CMD,
-        "state_topic": TOPIC_STATE,
-        "value_template": "{{ value_json.fan }}",
-        "min": 0,
-        "max": 6,
-        "step": 1,
-        "mode": "slider",
-        "icon": "mdi:fan",
-        "availability_topic": TOPIC_AVAIL,
-        "device": dev,
-    }), retain=True)
-
-    # Flame level (number 0-6)
-    ha_mqtt.publish("homeassistant/number/iflame_flame/config", json.dumps({
-        "name": "Fireplace Flame",
-        "unique_id": "iflame_flame_level",
-        "command_topic": TOPIC_FLAME_CMD,
-        "state_topic": TOPIC_STATE,
-        "value_template": "{{ value_json.flame }}",
-        "min": 0,
-        "max": 6,
-        "step": 1,
-        "mode": "slider",
-        "icon": "mdi:fire",
-        "availability_topic": TOPIC_AVAIL,
-        "device": dev,
-    }), retain=True)
-
-    # Split flow (switch)
-    ha_mqtt.publish("homeassistant/switch/iflame_split/config", json.dumps({
-        "name": "Fireplace Split Flow",
-        "unique_id": "iflame_split_flow",
-        "command_topic": TOPIC_SPLIT_CMD,
-        "state_topic": TOPIC_STATE,
-        "value_template": "{{ 'ON' if value_json.split == 1 else 'OFF' }}",
-        "payload_on": "ON",
-        "payload_off": "OFF",
-        "icon": "mdi:arrow-split-vertical",
-        "availability_topic": TOPIC_AVAIL,
-        "device": dev,
-    }), retain=True)
-
-    # Ember light (switch)
-    ha_mqtt.publish("homeassistant/switch/iflame_ember/config", json.dumps({
-        "name": "Fireplace Ember Light",
-        "unique_id": "iflame_ember_light",
-        "command_topic": TOPIC_EMBER_CMD,
-        "state_topic": TOPIC_STATE,
-        "value_template": "{{ 'ON' if value_json.ember == 1 else 'OFF' }}",
-        "payload_on": "ON",
-        "payload_off": "OFF",
-        "icon": "mdi:fire-circle",
-        "availability_topic": TOPIC_AVAIL,
-        "device": dev,
-    }), retain=True)
-
-    # Overhead lights (number 0-5)
-    ha_mqtt.publish("homeassistant/number/iflame_overhead/config", json.dumps({
-        "name": "Fireplace Overhead Lights",
-        "unique_id": "iflame_overhead_lights",
-        "command_topic": TOPIC_OVERHEAD_CMD,
-        "state_topic": TOPIC_STATE,
-        "value_template": "{{ value_json.overhead }}",
-        "min": 0,
-        "max": 5,
-        "step": 1,
-        "mode": "slider",
-        "icon": "mdi:ceiling-light",
-        "availability_topic": TOPIC_AVAIL,
-        "device": dev,
-    }), retain=True)
-
-    log.info("MQTT discovery published (all controls)")
-
-def publish_state(state):
-    """Publish to both switch state and climate state topics."""
+    payloads = {}
+    for e in ENTITIES:
+        config = {"name": f"{fp.label} {e.name}" if e.name else fp.label, "unique_id": f"{e.unique_id}{fp.uid}"}
+        for key, (suffix, _) in e.commands.items():
+            config[key] = fp.topic(suffix)
+        if e.state:
+            config.update(_state_source(fp, *e.state))
+        for key, suffix in e.topics.items():
+            config[key] = fp.topic(suffix)
+        config.update(e.config)
+        if e.icon:
+            config["icon"] = e.icon
+        config["availability_topic"] = TOPIC_AVAIL
+        config["device"] = dev
+        payloads[f"homeassistant/{e.component}/{e.object_id}{fp.uid}/config"] = json.dumps(config)
+    return payloads
+
+def publish_discovery(fp):
+    """Publish only the configs that differ from what the broker retains."""
+    payloads = discovery_payloads(fp)
+    published = 0
+    for topic, payload in payloads.items():
+        digest = _digest(payload.encode())
+        if _discovery_retained.get(topic) == digest:
+            continue
+        ha_mqtt.publish(topic, payload, retain=True)
+        _discovery_retained[topic] = digest
+        published += 1
+    log.info(f"MQTT discovery for {fp.thing}: {published} of {len(payloads)} configs published"
+             f"{'' if published else ' (broker up to date)'}")
+
+def _publish_all_discovery():
+    for fp in DEVICES:
+        try:
+            publish_discovery(fp)
+        except Exception as e:
+            log.error(f"{fp.thing}: discovery publish failed: {e}")
+
+def publish_shadow(fp, shadow):
+    """Parse and publish a shadow, unless this or a newer version has already been published.
+
+    Poll, push and delta threads all land here; publish_lock keeps a slow older version
+    from overwriting a newer one in HA."""
+    with fp.publish_lock:
+        version = shadow.get("version")
+        if version is not None and fp.published_version is not None and version <= fp.published_version:
+            return
+        state = parse_shadow(fp, shadow)
+        try:
+            fp.history.append(state)
+        except Exception as e:
+            log.warning(f"{fp.thing}: history append failed: {e}")
+        changed = state != fp.streamed_state
+        stream_state(fp, state)
+        publish_state(fp, state)
+        if version is not None:
+            fp.published_version = version
+    if changed:
+        save_state_snapshot()
+
+def publish_state(fp, state):
+    """Publish to both switch state and climate state topics, skipping unchanged payloads."""
     if not ha_mqtt:
         return
-    ha_mqtt.publish(TOPIC_STATE, json.dumps(state), retain=True)
+    with fp.publish_lock:
+        _publish_state(fp, state)
+
+def _publish_state(fp, state):
+    if state != fp.published_state:
+        ha_mqtt.publish(fp.topic(TOPIC_STATE), json.dumps(state), retain=True)
+        startup_phase("first_publish")
+        record("state", d=fp.thing, s=state)
+        if HA_FIELD_TOPICS:
+            previous = fp.published_state or {}
+            for field, value in state.items():
+                if field not in previous or previous[field] != value:
+                    ha_mqtt.publish(fp.topic(f"{TOPIC_FIELD_STATE}/{field}"), json.dumps(value), retain=True)
+        fp.published_state = state
 
     # Climate state
     st1 = state.get("ST1", 0)
-    target = st1 if st1 > 0 else state.get("target_temp", 0)
-    if target == 0:
-        target = _last_known_target
-    user_set_recently = _user_target_temp is not None and (time.time() - _user_target_time) < 30
-    if user_set_recently:
-        if st1 == _user_target_temp:
-            pass
-        else:
-            target = _user_target_temp
+    with _state_lock:
+        target = st1 if st1 > 0 else state.get("target_temp", 0)
+        if target == 0:
+            target = fp.last_known_target
+        user_set_recently = fp.user_target_temp is not None and (time.time() - fp.user_target_time) < 30
+        if user_set_recently:
+            if st1 == fp.user_target_temp:
+                pass
+            else:
+                target = fp.user_target_temp
     climate = {
         "mode": "heat" if state.get("thermostat_active") or state.get("flame_on") else "off",
         "target_temp": target,
         "current_temp": state["AT"],
     }
-    ha_mqtt.publish(TOPIC_CLIMATE_STATE, json.dumps(climate), retain=True)
+    if climate != fp.published_climate:
+        ha_mqtt.publish(fp.topic(TOPIC_CLIMATE_STATE), json.dumps(climate), retain=True)
+        fp.published_climate = climate
 
-def poll_and_publish():
+def poll_and_publish(fp, fresh=False):
     try:
-        shadow = get_shadow()
-        state = parse_shadow(shadow)
-        publish_state(state)
+        with span("poll_and_publish"):
+            publish_shadow(fp, get_shadow(fp, fresh=fresh))
     except Exception as e:
-        log.error(f"Poll failed: {e}")
+        log.error(f"{fp.thing}: poll failed: {e}")
+        M_POLL_FAILURES.inc(device=fp.slug)
+
+def poll_all(fresh=False):
+    for fp in DEVICES:
+        poll_and_publish(fp, fresh=fresh)
+
+def _shadow_device(topic):
+    # $aws/things/<thing>/shadow/update/...
+    return DEVICES_BY_THING.get(topic.split("/")[2])
+
+def _on_shadow_documents(topic, payload, **kwargs):
+    """Push path: every accepted shadow update (app, wall remote, hub, us) lands here."""
+    fp = _shadow_device(topic)
+    if fp is None:
+        return
+    try:
+        shadow = json.loads(payload)["current"]
+        if _store_shadow(fp, shadow):
+            publish_shadow(fp, shadow)
+    except Exception as e:
+        log.error(f"{fp.thing}: shadow document failed: {e}")
+
+def _on_shadow_delta(topic, payload, **kwargs):
+    """Delta carries only the desired fields the hub hasn't reported yet; fold them in."""
+    fp = _shadow_device(topic)
+    if fp is None or fp.shadow is None:
+        return
+    try:
+        msg = json.loads(payload)
+        shadow = copy.deepcopy(fp.shadow)
+        shadow["state"].setdefault("desired", {}).update(msg.get("state", {}))
+        shadow["version"] = msg.get("version", shadow.get("version", 0))
+        if _store_shadow(fp, shadow):
+            publish_shadow(fp, shadow)
+    except Exception as e:
+        log.error(f"{fp.thing}: shadow delta failed: {e}")
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# Poll Scheduler
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# Each device has its own next-poll time. A command pulls it in and polls fast until
+# the shadow shows the command took; an idle, unchanged unit backs off; a thermostat
+# hovering near its target is watched more closely while there is no push feed.
+
+def expect_convergence(fp, cid, cmd):
+    """Called after a publish: poll fast until the shadow reflects (cid, cmd)."""
+    fp.converge_cmd = (cid, cmd)
+    fp.converge_reported = _command_reported(fp.shadow)
+    fp.converge_until = time.time() + POLL_FAST_WINDOW
+    fp.poll_next = min(fp.poll_next, time.time() + POLL_FAST_SECS)
+    wake_poller()
+
+def _command_reported(shadow):
+    """What the hub reports apart from ambient temperature, which moves on its own."""
+    if shadow is None:
+        return None
+    return {k: v for k, v in shadow["state"].get("reported", {}).items() if k != "AT"}
+
+def _converged(fp, shadow):
+    """The hub has acted on our last command (or a later one has replaced it)."""
+    progress = _command_progress(shadow, fp.converge_cmd[0])
+    if progress == "unconfirmed":
+        # No CID echo: only a change in what the hub reports counts; otherwise the
+        # fast window runs out
+        return _command_reported(shadow) != fp.converge_reported
+    return progress is not None
+
+def next_poll_interval(fp):
+    """Seconds until this device's next reconciliation poll, judged from its latest shadow."""
+    base = SHADOW_RECONCILE_SECS if _push_active else POLL_SECS
+    shadow = fp.shadow
+    if shadow is None:
+        return base
+    if fp.converge_until:
+        if _converged(fp, shadow):
+            log.info(f"{fp.thing}: CID {fp.converge_cmd[0]} converged")
+        elif time.time() < fp.converge_until:
+            return POLL_FAST_SECS
+        else:
+            log.warning(f"{fp.thing}: CID {fp.converge_cmd[0]} not reflected after {POLL_FAST_WINDOW:.0f}s")
+        fp.converge_until = 0
+    state = parse_shadow(fp, shadow)
+    if not state["is_on"]:
+        signature = (state["cmd"], state["ST1"])
+        if signature == fp.poll_signature and fp.poll_backoff:
+            fp.poll_backoff = min(fp.poll_backoff * 2, max(base, POLL_IDLE_MAX_SECS))
+        else:
+            fp.poll_backoff = base
+        fp.poll_signature = signature
+        return fp.poll_backoff
+    fp.poll_signature, fp.poll_backoff = None, 0
+    target = state["target_temp"] or state["ST1"]
+    if not _push_active and state["thermostat_active"] and abs(state["AT"] - target) <= POLL_NEAR_TARGET_F:
+        return min(base, POLL_NEAR_TARGET_SECS)
+    return base
+
+def _ensure_push():
+    if SHADOW_PUSH and not _push_active:
+        try:
+            get_aws_conn()
+        except Exception as e:
+            log.error(f"Shadow subscription failed: {e}")
+
+def _poll_round(push_was):
+    """Reschedule every device if the push feed came up or went down; returns the due ones."""
+    if _push_active != push_was:
+        # Feed came up or went down: reconcile now and reschedule on the new base
+        for fp in DEVICES:
+            fp.poll_next = 0
+    return [fp for fp in DEVICES if time.time() >= fp.poll_next]
+
+def _poll_device(fp):
+    try:
+        poll_and_publish(fp, fresh=True)
+        interval = next_poll_interval(fp)
+    except Exception as e:
+        log.error(f"Poll loop error: {e}")
+        interval = POLL_SECS
+    fp.poll_next = time.time() + interval
+
+def _poll_idle():
+    """Seconds until the next device is due."""
+    return max(0.05, min(fp.poll_next for fp in DEVICES) - time.time())
+
+def wake_poller():
+    """Run the poll scheduler now rather than at its next due time (from any thread)."""
+    if _loop is not None:
+        _loop.call_soon_threadsafe(_poll_wakeup.set)
+    else:
+        _poll_wake.set()
 
 def poll_loop():
+    # start_bridge() has already polled once and scheduled each device
+    push_was = _push_active
     while True:
+        _ensure_push()
+        due = _poll_round(push_was)
+        push_was = _push_active
+        for fp in due:
+            _poll_device(fp)
+        _poll_wake.wait(_poll_idle())
+        _poll_wake.clear()
+
+async def poll_task():
+    """poll_loop() on the event loop: due devices are polled side by side on the executor."""
+    push_was = _push_active
+    while True:
+        if SHADOW_PUSH and not _push_active:
+            await _loop.run_in_executor(None, _ensure_push)
+        due = _poll_round(push_was)
+        push_was = _push_active
+        await asyncio.gather(*(_loop.run_in_executor(None, _poll_device, fp) for fp in due))
         try:
-            poll_and_publish()
-        except Exception as e:
-            log.error(f"Poll loop error: {e}")
-        time.sleep(30)
+            await asyncio.wait_for(_poll_wakeup.wait(), _poll_idle())
+        except TimeoutError:
+            pass
+        _poll_wakeup.clear()
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # Flask REST API
 # ═══════════════════════════════════════════════════════════════════════════════
 
+# Every route takes an optional ?device=<thing or label>; the default is the first device.
+
+@app.before_request
+def _check_device_arg():
+    """An unknown ?device= is a 404 for every route, before it reaches the handler."""
+    try:
+        _device()
+    except KeyError as e:
+        return jsonify({"ok": False, "error": e.args[0]}), 404
+
+def _device(args=None):
+    return get_device((request.args if args is None else args).get("device"))
+
+def _json_body():
+    body = request.get_json(force=True, silent=True)
+    if body is None:
+        raise ValueError("request body is not valid JSON")
+    return body
+
+@app.route("/devices")
+def devices():
+    return jsonify([{"thing": fp.thing, "label": fp.label, "device": fp.slug, "topic_prefix": fp.prefix}
+                    for fp in DEVICES])
+
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/debug/aws")
+def debug_aws():
+    """Request budget, circuit breaker and hedged-read statistics."""
+    return jsonify(aws_stats())
+
+@app.route("/debug/traces")
+def debug_traces():
+    """Recent command traces; ?format=chrome for chrome://tracing / ui.perfetto.dev."""
+    try:
+        limit = max(0, min(TRACE_BUFFER, int(request.args.get("limit", TRACE_BUFFER))))
+    except ValueError:
+        return jsonify({"error": f"limit must be an integer, not {request.args['limit']!r}"}), 400
+    traces = [t for t in list(_traces) if t.end is not None]
+    if request.args.get("device"):
+        device = _device().slug
+        traces = [t for t in traces if t.device == device]
+    traces = traces[len(traces) - limit:] if limit < len(traces) else traces
+    if request.args.get("format") == "chrome":
+        return jsonify({"traceEvents": [e for t in traces for e in t.chrome_events()],
+                        "displayTimeUnit": "ms"})
+    return jsonify([t.to_dict() for t in reversed(traces)])
+
+def _float_arg(name):
+    """A finite float query argument, or None when it is absent."""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        number = float("nan")
+    if not -float("inf") < number < float("inf"):
+        raise ValueError(f"{name} must be a number, not {value!r}")
+    return number
+
+def _time_arg(name, default, now):
+    """Epoch seconds, or a negative value meaning seconds before now."""
+    value = _float_arg(name)
+    if value is None:
+        return default
+    return now + value if value <= 0 else value
+
+def _history_args(now):
+    """(start, end, step, fields) from the query string; ValueError on anything unusable."""
+    end = _time_arg("end", now, now)
+    start = _time_arg("start", end - 86400, now)
+    if start >= end:
+        raise ValueError(f"start must be before end (start={start}, end={end})")
+    step = _float_arg("step")
+    if step is None:
+        step = max(1, (end - start) / 300)
+    elif step <= 0:
+        raise ValueError(f"step must be a positive number of seconds, not {request.args['step']!r}")
+    step = max(step, (end - start) / HISTORY_MAX_BUCKETS)
+    fields = [f for f in request.args.get("fields", "").split(",") if f] or list(HISTORY_FIELDS)
+    unknown = set(fields) - set(HISTORY_FIELDS)
+    if unknown:
+        raise ValueError(f"unknown fields: {sorted(unknown)}")
+    return start, end, step, fields
+
+@app.route("/history")
+def history():
+    """Downsampled state history: ?start=&end=, ?step= bucket seconds, ?fields=AT,fan,..."""
+    try:
+        fp = _device()
+        start, end, step, fields = _history_args(time.time())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        return jsonify({"device": fp.slug, "start": start, "end": end, "step": step,
+                        "buckets": fp.history.query(start, end, step, fields)})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def _event_filters(args=None):
+    args = request.args if args is None else args
+    device = _device(args).slug if args.get("device") else None
+    types = set(args["types"].split(",")) if args.get("types") else None
+    return device, types
+
+def _sse_frame(msg):
+    """One Server-Sent Events frame; a keepalive comment for None."""
+    if msg is None:
+        return ": keepalive\n\n"
+    return f"id: {msg['id']}\nevent: {msg['event']}\ndata: {json.dumps(msg)}\n\n"
+
+@app.route("/events")
+def events():
+    """Server-Sent Events: state, ack and availability; ?device= and ?types=state,ack filter."""
+    try:
+        sub = subscribe(*_event_filters())
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 503
+
+    def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    msg = next_event(sub, EVENT_KEEPALIVE_SECS)
+                except EOFError:
+                    yield "event: closed\ndata: {}\n\n"
+                    return
+                yield _sse_frame(msg)
+        finally:
+            unsubscribe(sub)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+if Sock is not None:
+    sock = Sock(app)
+
+    @app.before_request
+    def _check_ws_server():
+        """flask-sock needs werkzeug's socket; waitress has none, so point the client elsewhere."""
+        if request.path == "/events/ws" and "werkzeug.socket" not in request.environ:
+            where = f"port {EVENT_WS_PORT}" if EVENT_WS_PORT else "nowhere (EVENT_WS_PORT=0)"
+            return jsonify({"error": f"/events/ws is served on {where} under waitress"}), 404
+
+    def events_ws_app(environ, start_response):
+        """The app behind EVENT_WS_PORT: /events/ws only."""
+        if environ.get("PATH_INFO") != "/events/ws":
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b"only /events/ws is served on this port\n"]
+        return app(environ, start_response)
+
+    @sock.route("/events/ws")
+    def events_ws(ws):
+        """WebSocket flavour of /events: one JSON message per event."""
+        try:
+            sub = subscribe(*_event_filters())
+        except RuntimeError as e:
+            ws.close(1013, str(e))
+            return
+        try:
+            while ws.connected:
+                try:
+                    msg = next_event(sub, EVENT_KEEPALIVE_SECS)
+                except EOFError:
+                    break
+                if msg is not None:
+                    ws.send(json.dumps(msg))
+        finally:
+            unsubscribe(sub)
+
 @app.route("/status")
 def status():
     try:
-        shadow = get_shadow()
-        return jsonify(parse_shadow(shadow))
+        fp = _device()
+        shadow = get_shadow(fp, fresh=request.args.get("fresh") == "1")
+        return jsonify(parse_shadow(fp, shadow))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route("/on", methods=["POST"])
-def turn_on():
+def _ack_wait(args=None):
+    """Seconds to wait for an ack from ?wait=true[&timeout=]; 0 without ?wait."""
+    args = request.args if args is None else args
+    wait = args.get("wait", "false")
+    if wait not in ("1", "true", "0", "false"):
+        raise ValueError(f"wait must be true or false, not {wait!r}")
+    if wait in ("0", "false"):
+        return 0
+    try:
+        timeout = float(args.get("timeout", COMMAND_ACK_TIMEOUT))
+    except ValueError:
+        timeout = -1
+    if not 0 <= timeout < float("inf"):
+        raise ValueError(f"timeout must be a number of seconds, not {args['timeout']!r}")
+    return timeout
+
+@app.before_request
+def _check_ack_args():
+    """Bad ?wait=/?timeout= is a 400 before a command route publishes anything."""
     try:
-        return jsonify(do_on())
+        _ack_wait()
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+def _command_reply(fp, result):
+    """jsonify a command result; with ?wait=true, only once the hub has confirmed it."""
+    wait = _ack_wait()
+    if wait and isinstance(result, dict) and result.get("cid"):
+        result = {**result, "ack": command_status(fp, result["cid"], wait=wait)}
+    return jsonify(result)
+
+@app.route("/commands/<cid>")
+def command(cid):
+    """Ack state of a command; ?wait=true blocks until it settles (or ?timeout=)."""
+    try:
+        fp = _device()
+        rec = command_status(fp, cid, wait=_ack_wait())
+        if rec is None:
+            return jsonify({"error": f"unknown CID {cid}"}), 404
+        return jsonify(rec)
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+        return jsonify({"error": str(e)}), 500
 
-@app.route("/off", methods=["POST"])
-def turn_off():
+@app.route("/state", methods=["PATCH"])
+def patch_state():
+    """Any subset of fan/flame/ember/split/overhead, mode, target_temp and preset as one command."""
     try:
-        return jsonify(do_off())
+        fp = _device()
+        changes = state_changes(_json_body())
+    except (ValueError, TypeError) as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
-
-@app.route("/smart", methods=["POST"])
-def smart_mode():
     try:
-        temp = int(request.json.get("temp", 73))
-        return jsonify(do_smart(temp))
+        priority = PRIO_URGENT if changes.get("power") == "off" else PRIO_NORMAL
+        return _command_reply(fp, run_command(fp, apply_changes, changes, priority=priority))
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
-@app.route("/fan", methods=["POST"])
-def set_fan():
+@app.route("/presets")
+def presets():
+    with _presets_lock:
+        return jsonify(dict(_presets))
+
+@app.route("/presets/<name>", methods=["PUT"])
+def put_preset(name):
     try:
-        level = int(request.json.get("level", 0))
-        return jsonify(do_set_fan(level))
+        set_preset(name, _json_body())
+        return jsonify({"ok": True, "preset": name})
+    except (ValueError, TypeError) as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
-@app.route("/flame", methods=["POST"])
-def set_flame():
+@app.route("/presets/<name>", methods=["DELETE"])
+def remove_preset(name):
     try:
-        level = int(request.json.get("level", 0))
-        return jsonify(do_set_flame(level))
+        if not delete_preset(name):
+            return jsonify({"ok": False, "error": f"unknown preset {name!r}"}), 404
+        return jsonify({"ok": True})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
-@app.route("/split", methods=["POST"])
-def set_split():
+# POST command routes: path -> (command, JSON body field with its default and type, priority).
+# The Flask views and the event-loop core are both generated from this table.
+COMMAND_ROUTES = {
+    "/on": (do_on, None, PRIO_NORMAL),
+    "/off": (do_off, None, PRIO_URGENT),
+    "/smart": (do_smart, ("temp", 73, int), PRIO_NORMAL),
+    "/fan": (do_set_fan, ("level", 0, int), PRIO_NORMAL),
+    "/flame": (do_set_flame, ("level", 0, int), PRIO_NORMAL),
+    "/split": (do_set_split, ("on", False, None), PRIO_NORMAL),
+    "/ember": (do_set_ember, ("on", False, None), PRIO_NORMAL),
+    "/overhead": (do_set_overhead, ("level", 0, int), PRIO_NORMAL),
+}
+
+def _command_args(param, body):
+    if param is None:
+        return ()
+    field, default, kind = param
+    value = body.get(field, default)
+    return (kind(value) if kind else value,)
+
+def _command_view(fn, param, priority):
+    def view():
+        try:
+            args = _command_args(param, request.json if param else None)
+            fp = _device()
+            return _command_reply(fp, run_command(fp, fn, *args, priority=priority))
+        except Exception as e:
+            return jsonify({"ok": False, "error": str(e)}), 500
+    return view
+
+for _path, (_fn, _param, _priority) in COMMAND_ROUTES.items():
+    app.add_url_rule(_path, _path.strip("/"), _command_view(_fn, _param, _priority), methods=["POST"])
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# Serving + Lifecycle
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# Requests are served concurrently; every read-modify-write of the command bytes
+# still happens on the device's command worker, so parallel /fan and /flame calls
+# queue behind each other instead of clobbering one another. shutdown() drives the
+# HTTP server through stop_accepting(), drain() and close(): iflame_aio.HttpServer
+# has them, and _Waitress maps them onto waitress.
+
+_ready = threading.Event()
+_stop_requested = threading.Event()
+_stopping = threading.Event()
+
+def sd_notify(state):
+    """systemd notify protocol (Type=notify); a no-op outside systemd."""
+    addr = os.environ.get("NOTIFY_SOCKET")
+    if not addr:
+        return
+    if addr.startswith("@"):
+        addr = "\0" + addr[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.connect(addr)
+            s.sendall(state.encode())
+    except OSError as e:
+        log.warning(f"sd_notify({state}) failed: {e}")
+
+def _health():
+    ok = _ready.is_set() and not _stopping.is_set()
+    return {"ready": ok, "aws_push": _push_active,
+            "ha_mqtt": bool(ha_mqtt is not None and ha_mqtt.is_connected()),
+            "startup": startup_timings}, 200 if ok else 503
+
+@app.route("/health")
+def health():
+    body, code = _health()
+    return jsonify(body), code
+
+def _on_signal(signum, frame):
+    log.info(f"Received {signal.Signals(signum).name}")
+    _stop_requested.set()
+
+def shutdown(server=None, ws_server=None):
+    """Stop taking work, finish what's queued, then leave HA and AWS cleanly."""
+    if _stopping.is_set():
+        return
+    _stopping.set()
+    sd_notify("STOPPING=1")
+    stream_availability()
+    log.info(f"Shutting down: draining commands (up to {SHUTDOWN_GRACE:.0f}s, "
+             f"{SHUTDOWN_GRACE + SHUTDOWN_STEPS_SECS:.0f}s in all)")
+    for fp in DEVICES:
+        with fp.pending_lock:
+            if fp.pending_timer is not None:
+                fp.pending_timer.cancel()
+                fp.pending_timer = None
+                _queue_batch(fp)
+    if server is not None:
+        # Stop accepting; connections already open keep being served while we drain
+        server.stop_accepting()
+    if not drain_commands(SHUTDOWN_GRACE):
+        log.warning(f"Shutdown: {sum(fp.cmd_queue.unfinished_tasks for fp in DEVICES)} command(s) still pending")
+    close_subscribers()
+    if ws_server is not None:
+        ws_server.shutdown()
+    if server is not None:
+        server.drain(SHUTDOWN_HTTP_SECS)
+    if ha_mqtt is not None:
+        try:
+            ha_mqtt.publish(TOPIC_AVAIL, "offline", retain=True).wait_for_publish(timeout=SHUTDOWN_HA_SECS)
+            ha_mqtt.disconnect()
+            ha_mqtt.loop_stop()
+        except Exception as e:
+            log.warning(f"HA MQTT disconnect failed: {e}")
+    save_state_snapshot()
+    stop_recorder("shutdown")
+    for fp in DEVICES:
+        fp.history.close()
+    with _aws_conn_lock:
+        conn = aws_conn
+    if conn is not None:
+        try:
+            conn.disconnect().result(timeout=SHUTDOWN_AWS_SECS)
+        except Exception as e:
+            log.warning(f"AWS IoT disconnect failed: {e}")
+    if server is not None:
+        server.close()
+    log.info("Shutdown complete")
+
+class _Waitress:
+    """A waitress server behind the three calls shutdown() makes."""
+    def __init__(self, server):
+        self.server = server
+
+    def stop_accepting(self):
+        self.server.accepting = False
+
+    def drain(self, timeout):
+        self.server.task_dispatcher.shutdown(timeout=timeout)
+
+    def close(self):
+        self.server.close()
+
+def _mark_ready():
+    _ready.set()
+    sd_notify("READY=1")
+    startup_phase("ready")
+    log.info("Startup timings: " + ", ".join(f"{k} {v:.2f}s" for k, v in startup_timings.items()))
+
+def serve():
+    """Serve the REST API from threads until SIGTERM/SIGINT, then shut down gracefully."""
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+    server = ws_server = None
+    if HTTP_SERVER == "asyncio":
+        log.warning("h11/wsproto not installed; serving from threads instead of the event loop")
+    if HTTP_SERVER != "flask" and create_server is not None:
+        waitress = create_server(app, host=HTTP_HOST, port=HTTP_PORT, threads=HTTP_THREADS)
+        threading.Thread(target=waitress.run, daemon=True, name="http").start()
+        server = _Waitress(waitress)
+        log.info(f"Serving on {HTTP_HOST}:{HTTP_PORT} (waitress, {HTTP_THREADS} threads)")
+        if Sock is not None and EVENT_WS_PORT:
+            ws_server = make_server(HTTP_HOST, EVENT_WS_PORT, events_ws_app, threaded=True)
+            threading.Thread(target=ws_server.serve_forever, daemon=True, name="http-ws").start()
+            log.info(f"Serving /events/ws on {HTTP_HOST}:{EVENT_WS_PORT}")
+    else:
+        if HTTP_SERVER != "flask":
+            log.warning("waitress not installed; using the Flask development server")
+        threading.Thread(target=app.run, kwargs={"host": HTTP_HOST, "port": HTTP_PORT, "threaded": True},
+                         daemon=True, name="http").start()
+    _mark_ready()
+    _stop_requested.wait()
+    shutdown(server, ws_server)
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# Event-Loop Core
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# HTTP_SERVER=asyncio: one event loop serves the REST API (iflame_aio), drives the paho
+# client through its socket callbacks, takes the AWS IoT callbacks and runs the poll
+# scheduler, credential refresh and coalescing timers. A request waiting for a command,
+# an ack or the next event holds no thread. Blocking work (shadow reads, Cognito, the
+# AWS IoT connect, the routes only Flask serves) runs on the loop's executor of
+# HTTP_THREADS threads. Each device's command worker stays a thread of its own: a
+# command blocks on its PUBACK and sleeps between the steps of a sequence.
+
+def _running_loop():
     try:
-        on = request.json.get("on", False)
-        return jsonify(do_set_split(on))
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+def on_loop(fn):
+    """Wrap a callback made on another library's thread (the AWS CRT) to run on the event loop."""
+    @functools.wraps(fn)
+    def callback(*args, **kwargs):
+        if _loop is None:
+            return fn(*args, **kwargs)
+        try:
+            _loop.call_soon_threadsafe(functools.partial(fn, *args, **kwargs))
+        except RuntimeError:
+            pass  # the loop has closed: we are exiting
+    return callback
+
+def run_blocking(fn, *args):
+    """Run fn(*args) off the calling thread: on the loop's executor, else a thread of its own."""
+    if _loop is not None:
+        _loop.call_soon_threadsafe(_loop.run_in_executor, None, fn, *args)
+    else:
+        threading.Thread(target=fn, args=args, daemon=True).start()
+
+class _LoopTimer:
+    """A callback due on the event loop with threading.Timer's cancel(), callable from any thread."""
+    def __init__(self, delay, fn, args):
+        self.cancelled = False
+        self.fn, self.args = fn, args
+        _loop.call_soon_threadsafe(_loop.call_later, delay, self._fire)
+
+    def _fire(self):
+        if not self.cancelled:
+            self.fn(*self.args)
+
+    def cancel(self):
+        self.cancelled = True
+
+def call_later(delay, fn, *args):
+    """Run fn(*args) in `delay` seconds, on the event loop if there is one; returns it for cancel()."""
+    if _loop is not None:
+        return _LoopTimer(delay, fn, args)
+    timer = threading.Timer(delay, fn, args)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+def attach_ha_mqtt(client):
+    """Watch paho's socket from the event loop instead of running its network thread.
+
+    paho calls these from whichever thread connects or publishes, hence the hops. The
+    writer stays registered while paho has output queued (_ha_mqtt_write): paho's own
+    unregister callback can race a publish from another thread and strand a packet.
+    """
+    def on_open(client, userdata, sock):
+        _loop.call_soon_threadsafe(_loop.add_reader, sock.fileno(), client.loop_read)
+
+    def on_close(client, userdata, sock):
+        # paho closes the socket as soon as this returns
+        if _running_loop() is _loop:
+            _ha_mqtt_forget(sock.fileno())
+        else:
+            _loop.call_soon_threadsafe(_ha_mqtt_forget, sock.fileno())
+
+    def on_register_write(client, userdata, sock):
+        fd = sock.fileno()
+        _loop.call_soon_threadsafe(_loop.add_writer, fd, _ha_mqtt_write, client, fd)
+
+    client.on_socket_open = on_open
+    client.on_socket_close = on_close
+    client.on_socket_register_write = on_register_write
+
+def _ha_mqtt_write(client, fd):
+    client.loop_write()
+    # A socket closed in loop_write() has been forgotten already (on_close)
+    if client.socket() is not None and not client.want_write():
+        _loop.remove_writer(fd)
+
+def _ha_mqtt_forget(fd):
+    try:
+        _loop.remove_reader(fd)
+        _loop.remove_writer(fd)
+    except OSError:
+        pass  # closed before we got here: the selector has dropped it already
+
+async def ha_mqtt_task(client):
+    """loop_forever()'s housekeeping: keepalive pings, and reconnecting with backoff."""
+    delay = 1
+    while not _stopping.is_set():
+        await asyncio.sleep(1)
+        if client.socket() is not None:
+            client.loop_misc()
+        elif not _stopping.is_set():
+            try:
+                await _loop.run_in_executor(None, client.reconnect)
+                delay = 1
+            except Exception as e:
+                log.warning(f"HA MQTT reconnect failed: {e}; retrying in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 120)
+
+# REST routes that wait (commands, acks, events, shadow reads) are served here; the
+# rest go to the Flask app on the executor. Both share the parsing helpers above.
+
+def _api(handler):
+    """Flask's before_request checks (?device=, ?wait=, ?timeout=) for a route on the loop."""
+    async def checked(req, **kwargs):
+        try:
+            _device(req.args)
+        except KeyError as e:
+            return aio.json_response({"ok": False, "error": e.args[0]}, 404)
+        try:
+            _ack_wait(req.args)
+        except ValueError as e:
+            return aio.json_response({"ok": False, "error": str(e)}, 400)
+        return await handler(req, **kwargs)
+    return checked
+
+def _request_json(req):
+    """_json_body() for a request on the loop."""
+    try:
+        body = req.json()
+    except ValueError:
+        body = None
+    if body is None:
+        raise ValueError("request body is not valid JSON")
+    return body
+
+async def _command_reply_async(fp, req, fut):
+    """_command_reply() for a submitted command. A client that gives up (timeout or
+    disconnect) doesn't cancel the command, just as with run_command()."""
+    result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(fut)), COMMAND_TIMEOUT)
+    wait = _ack_wait(req.args)
+    if wait and isinstance(result, dict) and result.get("cid"):
+        result = {**result, "ack": await command_status_async(fp, result["cid"], wait=wait)}
+    return aio.json_response(result)
+
+async def _api_command(req, fn, param, priority):
+    try:
+        args = _command_args(param, req.json() if param else None)
+        fp = _device(req.args)
+        fut = submit_command(fp, fn, *args, priority=priority, origin=f"rest {req.path}")
+        return await _command_reply_async(fp, req, fut)
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+        return aio.json_response({"ok": False, "error": str(e)}, 500)
 
-@app.route("/ember", methods=["POST"])
-def set_ember():
+async def _api_patch_state(req):
     try:
-        on = request.json.get("on", False)
-        return jsonify(do_set_ember(on))
+        fp = _device(req.args)
+        changes = state_changes(_request_json(req))
+    except (ValueError, TypeError) as e:
+        return aio.json_response({"ok": False, "error": str(e)}, 400)
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+        return aio.json_response({"ok": False, "error": str(e)}, 500)
+    try:
+        priority = PRIO_URGENT if changes.get("power") == "off" else PRIO_NORMAL
+        fut = submit_command(fp, apply_changes, changes, priority=priority, origin=f"rest {req.path}")
+        return await _command_reply_async(fp, req, fut)
+    except Exception as e:
+        return aio.json_response({"ok": False, "error": str(e)}, 500)
 
-@app.route("/overhead", methods=["POST"])
-def set_overhead():
+async def _api_command_status(req, cid):
     try:
-        level = int(request.json.get("level", 0))
-        return jsonify(do_set_overhead(level))
+        fp = _device(req.args)
+        rec = await command_status_async(fp, cid, wait=_ack_wait(req.args))
+        if rec is None:
+            return aio.json_response({"error": f"unknown CID {cid}"}, 404)
+        return aio.json_response(rec)
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+        return aio.json_response({"error": str(e)}, 500)
+
+async def _api_status(req):
+    try:
+        fp = _device(req.args)
+        fresh = req.args.get("fresh") == "1"
+        if fresh or not _shadow_is_fresh(fp):
+            shadow = await _loop.run_in_executor(None, get_shadow, fp, fresh)
+        else:
+            shadow = get_shadow(fp)
+        return aio.json_response(parse_shadow(fp, shadow))
+    except Exception as e:
+        return aio.json_response({"error": str(e)}, 500)
+
+async def _api_events(req):
+    try:
+        sub = subscribe(*_event_filters(req.args))
+    except RuntimeError as e:
+        return aio.json_response({"error": str(e)}, 503)
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    msg = await next_event_async(sub, EVENT_KEEPALIVE_SECS)
+                except EOFError:
+                    yield "event: closed\ndata: {}\n\n"
+                    return
+                yield _sse_frame(msg)
+        finally:
+            unsubscribe(sub)
+
+    return aio.Stream(stream(), content_type="text/event-stream",
+                      headers=[("Cache-Control", "no-cache"), ("X-Accel-Buffering", "no")])
+
+async def _api_events_ws(ws, req):
+    try:
+        sub = subscribe(*_event_filters(req.args))
+    except KeyError as e:
+        await ws.close(1008, e.args[0])
+        return
+    except RuntimeError as e:
+        await ws.close(1013, str(e))
+        return
+    try:
+        while True:
+            try:
+                msg = await next_event_async(sub, EVENT_KEEPALIVE_SECS)
+            except EOFError:
+                return
+            if msg is not None:
+                await ws.send(json.dumps(msg))
+    finally:
+        unsubscribe(sub)
+
+async def _api_health(req):
+    return aio.json_response(*_health())
+
+def core_routes():
+    routes = [("POST", re.escape(path), _api(functools.partial(_api_command, fn=fn, param=param, priority=priority)))
+              for path, (fn, param, priority) in COMMAND_ROUTES.items()]
+    return routes + [
+        ("PATCH", "/state", _api(_api_patch_state)),
+        ("GET", "/commands/(?P<cid>[^/]+)", _api(_api_command_status)),
+        ("GET", "/status", _api(_api_status)),
+        ("GET", "/events", _api(_api_events)),
+        ("GET", "/health", _api(_api_health)),
+    ]
+
+async def core_main():
+    """Run the bridge on one event loop until SIGTERM/SIGINT, then shut down gracefully."""
+    global _loop, _poll_wakeup
+    _loop = asyncio.get_running_loop()
+    _loop.set_default_executor(ThreadPoolExecutor(max_workers=HTTP_THREADS, thread_name_prefix="blocking"))
+    _poll_wakeup = asyncio.Event()
+    stop = asyncio.Event()
+
+    def on_signal(signum):
+        _on_signal(signum, None)
+        stop.set()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        _loop.add_signal_handler(signum, on_signal, signum)
+    await _loop.run_in_executor(None, start_bridge)
+    start_command_workers()
+    tasks = [asyncio.create_task(cred_refresh_task()), asyncio.create_task(poll_task()),
+             asyncio.create_task(ha_mqtt_task(ha_mqtt))]
+    server = aio.HttpServer(core_routes(), websockets={"/events/ws": _api_events_ws},
+                            fallback=aio.wsgi_fallback(app, server=(HTTP_HOST, HTTP_PORT)))
+    await server.start(HTTP_HOST, HTTP_PORT)
+    log.info(f"Serving on {HTTP_HOST}:{HTTP_PORT} (asyncio, {HTTP_THREADS} executor threads)")
+    _mark_ready()
+    await stop.wait()
+    await _loop.run_in_executor(None, shutdown, server)
+    for task in tasks:
+        task.cancel()
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# Warm Start
+# ═══════════════════════════════════════════════════════════════════════════════
+#
+# HA gets the previous run's state the moment it connects, without waiting for Cognito
+# or a shadow read. Startup overlaps the independent phases and records when each one
+# finished, seconds since process start (GET /health "startup").
+
+_startup_t0 = time.perf_counter()
+startup_timings = {}
+_snapshot_lock = threading.Lock()
+
+def startup_phase(name):
+    """Record the first time a startup milestone is reached."""
+    if name not in startup_timings:
+        startup_timings[name] = round(time.perf_counter() - _startup_t0, 3)
+        log.info(f"Startup: {name} at {startup_timings[name]:.2f}s")
+
+def save_state_snapshot():
+    if not STATE_SNAPSHOT_PATH:
+        return
+    with _state_lock:
+        devices = {fp.thing: {"state": fp.streamed_state, "cid": fp.cid_last,
+                              "last_known_target": fp.last_known_target}
+                   for fp in DEVICES if fp.streamed_state is not None}
+    if not devices:
+        return
+    data = json.dumps({"saved": time.time(), "devices": devices})
+    try:
+        with _snapshot_lock:
+            os.makedirs(os.path.dirname(STATE_SNAPSHOT_PATH), exist_ok=True)
+            tmp = STATE_SNAPSHOT_PATH + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, STATE_SNAPSHOT_PATH)
+    except OSError as e:
+        log.warning(f"Could not write state snapshot: {e}")
+
+def load_state_snapshot():
+    """Restore each device's last state, CID and target; returns how many were restored."""
+    if not STATE_SNAPSHOT_PATH:
+        return 0
+    try:
+        with open(STATE_SNAPSHOT_PATH) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as e:
+        log.warning(f"Ignoring unreadable state snapshot: {e}")
+        return 0
+    restored = 0
+    for fp in DEVICES:
+        entry = snapshot.get("devices", {}).get(fp.thing)
+        if not entry or not entry.get("state"):
+            continue
+        fp.warm_state = fp.streamed_state = entry["state"]
+        with _state_lock:
+            fp.last_known_target = entry.get("last_known_target", fp.last_known_target)
+        observe_cid(fp, entry.get("cid"), entry["state"].get("cmd"))
+        restored += 1
+    log.info(f"Restored state snapshot for {restored} device(s) "
+             f"({time.time() - snapshot.get('saved', 0):.0f}s old)")
+    return restored
+
+def start_bridge():
+    """HA connect runs alongside the credential setup; the first shadow fetch and the
+    AWS IoT connection start as soon as credentials are in."""
+    start_recorder()
+    load_presets()
+    load_state_snapshot()
+    with ThreadPoolExecutor(max_workers=2 + len(DEVICES), thread_name_prefix="startup") as pool:
+        ha = pool.submit(setup_ha_mqtt)
+        if not load_cred_cache():
+            refresh_creds()
+        startup_phase("creds")
+        fetches = [pool.submit(poll_and_publish, fp, True) for fp in DEVICES]
+        push = pool.submit(get_aws_conn) if SHADOW_PUSH else None
+        for fetch in fetches:
+            fetch.result()
+        startup_phase("first_shadow")
+        for fp in DEVICES:
+            if fp.shadow is not None:
+                fp.poll_next = time.time() + next_poll_interval(fp)
+        if push is not None:
+            try:
+                push.result()
+                startup_phase("aws_push")
+            except Exception as e:
+                log.error(f"Shadow subscription failed: {e}")
+        ha.result()
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # Main
 # ═══════════════════════════════════════════════════════════════════════════════
 
 if __name__ == "__main__":
-    refresh_creds()
-    setup_ha_mqtt()
-    t = threading.Thread(target=poll_loop, daemon=True)
-    t.start()
-    log.info("iFlame API + MQTT bridge starting on port 5088")
-    app.run(host="0.0.0.0", port=5088)
+    log.info(f"iFlame API + MQTT bridge starting on port {HTTP_PORT}")
+    if HTTP_SERVER == "asyncio" and aio is not None:
+        asyncio.run(core_main())
+    else:
+        start_bridge()
+        threading.Thread(target=cred_refresh_loop, daemon=True).start()
+        start_command_workers()
+        t = threading.Thread(target=poll_loop, daemon=True)
+        t.start()
+        serve()
@@ -0,0 +1,330 @@
+"""A small asyncio HTTP/1.1 server for the bridge's event-loop core.
+
+h11 parses requests and frames responses; after an upgrade, wsproto frames WebSocket
+messages. Neither does any I/O of its own, so each connection is one coroutine on the
+loop: an idle keep-alive connection, an open event stream or a request waiting for a
+command costs no thread. Routes are async handlers. A request with no matching route
+goes to a WSGI app, which runs on an executor.
+"""
+import asyncio, io, json, logging, re, sys, time
+from http import HTTPStatus
+from urllib.parse import parse_qsl, unquote_to_bytes
+
+import h11
+from wsproto.connection import Connection as WsConnection, ConnectionType
+from wsproto.events import BytesMessage, CloseConnection, Ping, TextMessage
+from wsproto.utilities import generate_accept_token
+
+log = logging.getLogger("iflame")
+
+MAX_BODY = 1 << 20
+READ_CHUNK = 64 * 1024
+
+
+class Request:
+    def __init__(self, method, target, headers, body, remote=None):
+        self.method = method
+        path, _, self.query = target.partition("?")
+        # PEP 3333: the path is the unquoted bytes, decoded as latin-1
+        self.path = unquote_to_bytes(path).decode("latin-1")
+        # First value wins, like Flask's request.args.get()
+        self.args = {}
+        for key, value in parse_qsl(self.query, keep_blank_values=True):
+            self.args.setdefault(key, value)
+        self.headers = {}
+        for name, value in headers:
+            name, value = name.decode("latin-1").lower(), value.decode("latin-1")
+            self.headers[name] = f"{self.headers[name]}, {value}" if name in self.headers else value
+        self.body = body
+        self.remote = remote
+
+    def json(self):
+        """The body parsed as JSON; ValueError if it isn't."""
+        return json.loads(self.body)
+
+
+class Response:
+    def __init__(self, body=b"", status=200, content_type="text/plain; charset=utf-8", headers=()):
+        self.body = body.encode() if isinstance(body, str) else body
+        self.status = status
+        self.headers = [("Content-Type", content_type)] if content_type else []
+        self.headers += [(k, v) for k, v in headers if k.lower() != "content-length"]
+
+
+class Stream:
+    """A response whose body is an async iterator of chunks, sent as they are produced.
+
+    The connection closes after it, and it is cancelled as soon as the client goes away.
+    """
+    def __init__(self, chunks, status=200, content_type="text/plain; charset=utf-8", headers=()):
+        self.chunks = chunks
+        self.status = status
+        self.headers = [("Content-Type", content_type), ("Connection", "close"), *headers]
+
+
+def json_response(data, status=200):
+    """The asyncio counterpart of flask.jsonify (same compact, key-sorted encoding)."""
+    return Response(json.dumps(data, separators=(",", ":"), sort_keys=True) + "\n", status,
+                    content_type="application/json")
+
+
+class WebSocket:
+    """The server side of an upgraded connection. Incoming frames are only answered
+    (ping, close); handlers push text messages."""
+    def __init__(self, reader, writer, data=b""):
+        self._reader, self._writer = reader, writer
+        self._ws = WsConnection(ConnectionType.SERVER, trailing_data=data)
+        self.connected = True
+
+    async def send(self, text):
+        if not self.connected:
+            raise ConnectionError("WebSocket closed")
+        self._writer.write(self._ws.send(TextMessage(data=text)))
+        await self._writer.drain()
+
+    async def close(self, code=1000, reason=None):
+        if self.connected:
+            self.connected = False
+            self._writer.write(self._ws.send(CloseConnection(code=code, reason=reason)))
+            await self._writer.drain()
+
+    async def _pump(self):
+        """Answer pings and the closing handshake; returns once the client has gone."""
+        while True:
+            for event in self._ws.events():
+                if isinstance(event, Ping):
+                    self._writer.write(self._ws.send(event.response()))
+                elif isinstance(event, CloseConnection):
+                    if self.connected:
+                        self.connected = False
+                        self._writer.write(self._ws.send(event.response()))
+                    return
+                elif isinstance(event, (TextMessage, BytesMessage)):
+                    pass
+            data = await self._reader.read(READ_CHUNK)
+            if not data:
+                self.connected = False
+                return
+            self._ws.receive_data(data)
+
+
+class HttpServer:
+    """routes: [(method, path regex, async handler(request, **groups))]; websockets:
+    {path: async handler(ws, request)}; fallback: async handler(request) for the rest.
+
+    A handler returns a Response or a Stream. stop_accepting(), drain() and close()
+    may be called from any thread; start() runs on the loop that will serve.
+    """
+    def __init__(self, routes, websockets=None, fallback=None, max_body=MAX_BODY):
+        self.routes = [(method, re.compile(pattern), handler) for method, pattern, handler in routes]
+        self.websockets = websockets or {}
+        self.fallback = fallback
+        self.max_body = max_body
+        self.loop = None
+        self._server = None
+        self._connections = set()
+        self._busy = set()
+
+    async def start(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._serve_connection, host, port)
+
+    def stop_accepting(self):
+        """Close the listening socket; open connections keep being served."""
+        self.loop.call_soon_threadsafe(self._server.close)
+
+    def drain(self, timeout):
+        """Wait up to `timeout` for requests in progress, then drop every connection."""
+        asyncio.run_coroutine_threadsafe(self._drain(timeout), self.loop).result()
+
+    def close(self):
+        self.stop_accepting()
+        self.drain(0)
+
+    async def _drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self._busy and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        tasks = list(self._connections)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _serve_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        conn = h11.Connection(h11.SERVER)
+        try:
+            while True:
+                try:
+                    req = await self._read_request(conn, reader, writer)
+                except h11.RemoteProtocolError as e:
+                    if conn.our_state in (h11.IDLE, h11.SEND_RESPONSE):
+                        await self._send(conn, writer, Response(str(e), e.error_status_hint))
+                    return
+                if req is None:
+                    return
+                self._busy.add(task)
+                try:
+                    ws_handler = self.websockets.get(req.path)
+                    if ws_handler is not None and req.headers.get("upgrade", "").lower() == "websocket":
+                        await self._serve_websocket(conn, reader, writer, req, ws_handler)
+                        return
+                    resp = await self._dispatch(req, ws_handler)
+                    if isinstance(resp, Stream):
+                        await self._send_stream(conn, reader, writer, resp)
+                        return
+                    await self._send(conn, writer, resp, head=req.method == "HEAD")
+                finally:
+                    self._busy.discard(task)
+                if conn.our_state is h11.MUST_CLOSE:
+                    return
+                conn.start_next_cycle()
+        except (ConnectionError, h11.LocalProtocolError, h11.RemoteProtocolError):
+            pass
+        except Exception as e:
+            log.warning(f"HTTP connection failed: {e}")
+        finally:
+            self._connections.discard(task)
+            self._busy.discard(task)
+            writer.close()
+
+    async def _read_request(self, conn, reader, writer):
+        """The next complete request on the connection; None once the client is done."""
+        head, body = None, bytearray()
+        while True:
+            event = conn.next_event()
+            if event is h11.NEED_DATA:
+                if conn.they_are_waiting_for_100_continue:
+                    writer.write(conn.send(h11.InformationalResponse(status_code=100, headers=[])))
+                data = await reader.read(READ_CHUNK)
+                conn.receive_data(data)
+            elif isinstance(event, h11.Request):
+                head = event
+            elif isinstance(event, h11.Data):
+                body += event.data
+                if len(body) > self.max_body:
+                    raise h11.RemoteProtocolError("request body too large", error_status_hint=413)
+            elif isinstance(event, h11.EndOfMessage):
+                return Request(head.method.decode("ascii"), head.target.decode("latin-1"), head.headers,
+                               bytes(body), writer.get_extra_info("peername"))
+            else:
+                # ConnectionClosed, or PAUSED after a response that closed the connection
+                return None
+
+    async def _dispatch(self, req, ws_handler=None):
+        if ws_handler is not None:
+            return json_response({"error": "WebSocket upgrade required"}, 400)
+        method = "GET" if req.method == "HEAD" else req.method
+        allowed = False
+        for route_method, pattern, handler in self.routes:
+            match = pattern.fullmatch(req.path)
+            if match is None:
+                continue
+            if route_method != method:
+                allowed = True
+                continue
+            try:
+                return await handler(req, **match.groupdict())
+            except Exception as e:
+                log.exception(f"{req.method} {req.path} failed")
+                return json_response({"error": str(e)}, 500)
+        if self.fallback is not None:
+            return await self.fallback(req)
+        if allowed:
+            return json_response({"error": "method not allowed"}, 405)
+        return json_response({"error": "not found"}, 404)
+
+    async def _send(self, conn, writer, resp, head=False):
+        headers = [*resp.headers, ("Content-Length", str(len(resp.body)))]
+        writer.write(conn.send(h11.Response(status_code=resp.status, headers=headers,
+                                            reason=HTTPStatus(resp.status).phrase)))
+        if resp.body and not head:
+            writer.write(conn.send(h11.Data(data=resp.body)))
+        writer.write(conn.send(h11.EndOfMessage()))
+        await writer.drain()
+
+    async def _send_stream(self, conn, reader, writer, resp):
+        async def pump():
+            writer.write(conn.send(h11.Response(status_code=resp.status, headers=resp.headers,
+                                                reason=HTTPStatus(resp.status).phrase)))
+            async for chunk in resp.chunks:
+                writer.write(conn.send(h11.Data(data=chunk.encode() if isinstance(chunk, str) else chunk)))
+                await writer.drain()
+            writer.write(conn.send(h11.EndOfMessage()))
+            await writer.drain()
+
+        async def client_gone():
+            while await reader.read(READ_CHUNK):
+                pass
+
+        try:
+            await _until_first(pump(), client_gone())
+        finally:
+            # Run the body's cleanup now, not whenever the generator is collected
+            if hasattr(resp.chunks, "aclose"):
+                await resp.chunks.aclose()
+
+    async def _serve_websocket(self, conn, reader, writer, req, handler):
+        key = req.headers.get("sec-websocket-key", "").encode()
+        if not key or req.headers.get("sec-websocket-version") != "13":
+            await self._send(conn, writer, json_response({"error": "bad WebSocket handshake"}, 400))
+            return
+        writer.write(conn.send(h11.InformationalResponse(status_code=101, headers=[
+            ("Upgrade", "websocket"), ("Connection", "Upgrade"),
+            ("Sec-WebSocket-Accept", generate_accept_token(key))])))
+        await writer.drain()
+        ws = WebSocket(reader, writer, conn.trailing_data[0])
+        try:
+            await _until_first(handler(ws, req), ws._pump())
+            await ws.close()
+        except Exception as e:
+            log.warning(f"WebSocket {req.path} failed: {e}")
+
+
+async def _until_first(*coros):
+    """Run coroutines side by side; when one finishes, cancel the rest."""
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for task in done:
+        task.result()
+
+
+def wsgi_fallback(app, executor=None, server=("localhost", 80)):
+    """An async handler that runs requests through a WSGI app on `executor`."""
+    async def handler(req):
+        return await asyncio.get_running_loop().run_in_executor(executor, _call_wsgi, app, req, server)
+    return handler
+
+
+def _call_wsgi(app, req, server):
+    environ = {
+        "REQUEST_METHOD": req.method, "SCRIPT_NAME": "", "PATH_INFO": req.path,
+        "QUERY_STRING": req.query, "SERVER_NAME": server[0], "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/1.1", "REMOTE_ADDR": req.remote[0] if req.remote else "",
+        "CONTENT_LENGTH": str(len(req.body)), "wsgi.version": (1, 0), "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(req.body), "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True, "wsgi.multiprocess": False, "wsgi.run_once": False,
+    }
+    for name, value in req.headers.items():
+        key = name.upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        environ[key] = value
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split()[0]), headers]
+
+    result = app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return Response(body, started[0], content_type=None, headers=started[1])
@@ -0,0 +1,152 @@
+"""Request budget primitives for the AWS shadow API: rate limiting, circuit breaking,
+jittered backoff and a latency window for hedging decisions.
+
+TokenBucket is adaptive: a throttle response from AWS halves its rate, and every
+success afterwards wins back a twentieth of the configured rate, so a bucket sized a
+little too generously settles just under what the service actually allows.
+"""
+import collections, random, threading, time
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, min_rate=None):
+        self.max_rate = self.rate = float(rate)
+        self.min_rate = min_rate if min_rate is not None else self.max_rate / 8
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+        self.acquired = self.denied = self.throttles = 0
+        self.wait_total = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def try_acquire(self):
+        """Take a token only if one is available right now."""
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.acquired += 1
+            return True
+
+    def acquire(self, timeout):
+        """Take a token, waiting up to `timeout` seconds; False if none came in time."""
+        t0 = time.monotonic()
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.acquired += 1
+                    self.wait_total += now - t0
+                    return True
+                wait = (1 - self.tokens) / self.rate
+                if now + wait > t0 + timeout:
+                    self.denied += 1
+                    return False
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.throttles += 1
+
+    def recovered(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def stats(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            return {"rate": round(self.rate, 2), "max_rate": self.max_rate, "burst": self.burst,
+                    "tokens": round(self.tokens, 2), "acquired": self.acquired, "denied": self.denied,
+                    "throttles": self.throttles, "wait_total_s": round(self.wait_total, 3)}
+
+
+class CircuitBreaker:
+    """closed -> open after `failures` consecutive failures; after `cooldown` seconds one
+    trial call is let through (half_open) and its outcome closes or reopens the circuit."""
+
+    def __init__(self, failures, cooldown):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self.trial = False
+        self.opens = self.rejected = 0
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+                self.trial = False
+            if self.state == "half_open" and not self.trial:
+                self.trial = True
+                return True
+            self.rejected += 1
+            return False
+
+    def release(self):
+        """Give back a half_open trial that allow() granted but the caller never used."""
+        with self.lock:
+            if self.state == "half_open":
+                self.trial = False
+
+    def success(self):
+        with self.lock:
+            self.consecutive = 0
+            self.state = "closed"
+
+    def failure(self):
+        """Returns True if this failure opened the circuit."""
+        with self.lock:
+            self.consecutive += 1
+            if self.state == "half_open" or (self.state == "closed" and self.consecutive >= self.failures):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.opens += 1
+                return True
+            return False
+
+    def stats(self):
+        with self.lock:
+            retry_in = max(0.0, self.cooldown - (time.monotonic() - self.opened_at)) if self.state == "open" else 0
+            return {"state": self.state, "consecutive_failures": self.consecutive, "opens": self.opens,
+                    "rejected": self.rejected, "retry_in_s": round(retry_in, 1)}
+
+
+class LatencyWindow:
+    """The last `size` latencies, for quantiles."""
+
+    def __init__(self, size=200):
+        self.samples = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, secs):
+        with self.lock:
+            self.samples.append(secs)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def quantile(self, q):
+        with self.lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def backoff(attempt, base, cap):
+    """Full-jitter exponential backoff: uniform in [0, min(cap, base * 2**attempt)]."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
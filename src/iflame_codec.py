@@ -0,0 +1,122 @@
+"""iFlame command string codec: table-driven decode/encode plus batch APIs.
+
+Command format (simple):  2:0:1:<control_byte>:<fan_flame_byte>
+Command format (smart):   2:2:1:<target_F>:<control_byte>:<fan_flame_byte>
+
+Both bytes only use their low 8 bits, so each decodes through a 256-entry table.
+Batch functions decode/encode whole archives (CMD_LST history, shadow dumps) and
+use NumPy when it is installed. tests/test_codec.py fuzzes both against the
+bridge's original per-call functions.
+"""
+from functools import lru_cache
+from typing import NamedTuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class CmdState(NamedTuple):
+    mode: str
+    is_on: bool
+    target_temp: int
+    overhead: int
+    fan: int
+    flame: int
+    ember: int
+    split: int
+
+
+FIELDS = CmdState._fields
+UNKNOWN = CmdState("unknown", False, 0, 0, 0, 0, 0, 0)
+
+# value & 255 -> (on, overhead)
+CTRL_TABLE = tuple((v & 1, (v >> 4) & 7) for v in range(256))
+# value & 255 -> (split, fan, ember, flame)
+FF_TABLE = tuple(((v >> 7) & 1, (v >> 4) & 7, (v >> 3) & 1, v & 7) for v in range(256))
+
+
+def decode_control_byte(value):
+    return CTRL_TABLE[int(value) & 255]
+
+
+def decode_fan_flame_byte(value):
+    return FF_TABLE[int(value) & 255]
+
+
+def encode_control_byte(on, overhead):
+    return 128 + (overhead * 16) + (1 if on else 0)
+
+
+def encode_fan_flame_byte(split, fan, ember, flame):
+    return (split * 128) + (fan * 16) + (ember * 8) + flame
+
+
+@lru_cache(maxsize=4096)
+def decode(cmd):
+    """Command string -> CmdState (UNKNOWN for anything that isn't 5 or 6 fields)."""
+    parts = cmd.split(":") if cmd else ()
+    if len(parts) == 6:
+        on, overhead = CTRL_TABLE[int(parts[4]) & 255]
+        split, fan, ember, flame = FF_TABLE[int(parts[5]) & 255]
+        return CmdState("smart", bool(on), int(parts[3]), overhead, fan, flame, ember, split)
+    if len(parts) == 5:
+        on, overhead = CTRL_TABLE[int(parts[3]) & 255]
+        split, fan, ember, flame = FF_TABLE[int(parts[4]) & 255]
+        return CmdState("simple", bool(on), 0, overhead, fan, flame, ember, split)
+    return UNKNOWN
+
+
+def encode(mode, is_on, target_temp, overhead, fan, flame, ember, split):
+    """Fields (or a CmdState via encode(*state)) -> command string."""
+    ctrl = 128 + (overhead * 16) + (1 if is_on else 0)
+    ff = (split * 128) + (fan * 16) + (ember * 8) + flame
+    if mode == "smart":
+        return f"2:2:1:{target_temp}:{ctrl}:{ff}"
+    return f"2:0:1:{ctrl}:{ff}"
+
+
+# ── Batch ──
+
+def decode_many(cmds):
+    """Iterable of command strings -> list of CmdState."""
+    return [decode(c) for c in cmds]
+
+
+def decode_columns(cmds):
+    """Command strings -> {field: column}. Columns are NumPy arrays when available.
+
+    Archives repeat a handful of distinct commands, so each distinct string is
+    parsed once and the columns are gathered from the parsed values.
+    """
+    if np is None:
+        states = decode_many(cmds)
+        return {f: [s[i] for s in states] for i, f in enumerate(FIELDS)}
+    index = {}
+    inverse = np.fromiter((index.setdefault(c, len(index)) for c in cmds), dtype=np.intp)
+    states = decode_many(index)
+    cols = {}
+    for i, f in enumerate(FIELDS):
+        if f == "mode":
+            values = np.array([s[i] for s in states], dtype=object)
+        elif f == "is_on":
+            values = np.array([s[i] for s in states], dtype=bool)
+        else:
+            values = np.array([s[i] for s in states], dtype=np.int64)
+        cols[f] = values[inverse]
+    return cols
+
+
+def encode_columns(mode, is_on, target_temp, overhead, fan, flame, ember, split):
+    """Field columns (equal-length sequences) -> list of command strings."""
+    if np is None:
+        return [encode(*row) for row in zip(mode, is_on, target_temp, overhead, fan, flame, ember, split)]
+    on = np.asarray(is_on).astype(bool).astype(np.int64)
+    ctrl = 128 + np.asarray(overhead, dtype=np.int64) * 16 + on
+    ff = (np.asarray(split, dtype=np.int64) * 128 + np.asarray(fan, dtype=np.int64) * 16
+          + np.asarray(ember, dtype=np.int64) * 8 + np.asarray(flame, dtype=np.int64))
+    smart = np.asarray(mode, dtype=object) == "smart"
+    return [f"2:2:1:{t}:{c}:{b}" if s else f"2:0:1:{c}:{b}"
+            for s, t, c, b in zip(smart.tolist(), list(target_temp), ctrl.tolist(), ff.tolist())]
+
@@ -0,0 +1,140 @@
+"""Bounded time-series history of parsed fireplace state.
+
+Each sample is a fixed 24-byte record kept in an in-RAM ring and appended to
+<dir>/<name>.bin. When the file passes max_bytes it rolls over to .1, .2, ...
+and the oldest segment beyond `segments` is deleted, so disk use is bounded too.
+query() answers from RAM when the range allows and otherwise scans the segments.
+"""
+import collections, os, struct, threading, time
+
+# t, AT, ST1, target_temp, fan, flame, overhead, mode, flags
+RECORD = struct.Struct("<dfhhBBBBBxxx")
+MODES = ("off", "simple", "thermostat")
+FLAGS = ("is_on", "flame_on", "thermostat_active", "ember", "split")
+NUMERIC = ("AT", "ST1", "target_temp", "fan", "flame", "overhead")
+FIELDS = NUMERIC + FLAGS
+
+
+def pack(t, state):
+    flags = 0
+    for i, f in enumerate(FLAGS):
+        if state.get(f):
+            flags |= 1 << i
+    mode = MODES.index(state["mode"]) if state.get("mode") in MODES else 0
+    return RECORD.pack(t, float(state.get("AT", 0)), int(state.get("ST1", 0)), int(state.get("target_temp", 0)),
+                       int(state.get("fan", 0)), int(state.get("flame", 0)), int(state.get("overhead", 0)),
+                       mode, flags)
+
+
+def unpack(rec):
+    """Record tuple -> (t, {field: value}) with flags as 0/1."""
+    t, at, st1, target, fan, flame, overhead, mode, flags = rec
+    values = {"AT": at, "ST1": st1, "target_temp": target, "fan": fan, "flame": flame, "overhead": overhead,
+              "mode": MODES[mode] if mode < len(MODES) else "off"}
+    for i, f in enumerate(FLAGS):
+        values[f] = (flags >> i) & 1
+    return t, values
+
+
+class HistoryStore:
+    def __init__(self, name, directory=None, ram_points=10000, max_bytes=8 << 20, segments=4):
+        self.name = name
+        self.path = os.path.join(directory, f"{name}.bin") if directory else None
+        self.max_bytes = max_bytes
+        self.segments = segments
+        self.lock = threading.Lock()
+        self.ram = collections.deque(maxlen=ram_points)
+        self.file = None
+        if self.path:
+            os.makedirs(directory, exist_ok=True)
+            self._load_tail()
+
+    def _load_tail(self):
+        """Seed the RAM ring from the newest records on disk."""
+        records = []
+        for path in self._segment_paths()[:2]:
+            records = self._read(path) + records
+            if len(records) >= self.ram.maxlen:
+                break
+        self.ram.extend(records[-self.ram.maxlen:])
+
+    def _segment_paths(self):
+        """Existing segment files, newest first."""
+        paths = [self.path] + [f"{self.path}.{i}" for i in range(1, self.segments)]
+        return [p for p in paths if os.path.exists(p)]
+
+    @staticmethod
+    def _read(path):
+        with open(path, "rb") as f:
+            data = f.read()
+        data = data[:len(data) - len(data) % RECORD.size]  # drop a torn final write
+        return list(RECORD.iter_unpack(data))
+
+    def _rollover(self):
+        self.file.close()
+        self.file = None
+        for i in range(self.segments - 1, 0, -1):
+            src = self.path if i == 1 else f"{self.path}.{i - 1}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i}")
+
+    def append(self, state, t=None):
+        rec = pack(time.time() if t is None else t, state)
+        with self.lock:
+            self.ram.append(RECORD.unpack(rec))
+            if not self.path:
+                return
+            if self.file is None:
+                self.file = open(self.path, "ab")
+            self.file.write(rec)
+            self.file.flush()
+            if self.file.tell() >= self.max_bytes:
+                self._rollover()
+
+    def records(self, start, end):
+        """Raw record tuples with start <= t < end, oldest first."""
+        with self.lock:
+            ram = list(self.ram)
+        if (ram and ram[0][0] <= start) or not self.path:
+            return [r for r in ram if start <= r[0] < end]
+        out = []
+        with self.lock:
+            paths = self._segment_paths()
+        for path in reversed(paths):
+            out.extend(r for r in self._read(path) if start <= r[0] < end)
+        return out
+
+    def query(self, start, end, step, fields=FIELDS):
+        """min/max/avg per `step`-second bucket; flags average to the fraction of samples set."""
+        buckets = {}
+        for rec in self.records(start, end):
+            t, values = unpack(rec)
+            i = int((t - start) // step)
+            b = buckets.get(i)
+            if b is None:
+                b = buckets[i] = {"n": 0, **{f: [float("inf"), float("-inf"), 0.0] for f in fields}}
+            b["n"] += 1
+            for f in fields:
+                v = values[f]
+                acc = b[f]
+                if v < acc[0]:
+                    acc[0] = v
+                if v > acc[1]:
+                    acc[1] = v
+                acc[2] += v
+        out = []
+        for i in sorted(buckets):
+            b = buckets[i]
+            n = b["n"]
+            row = {"t": start + i * step, "n": n}
+            for f in fields:
+                lo, hi, total = b[f]
+                row[f] = {"min": round(lo, 2), "max": round(hi, 2), "avg": round(total / n, 2)}
+            out.append(row)
+        return out
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,79 @@
+"""The bridge's original per-call codec, verbatim from before iflame_codec replaced it.
+
+tests/test_codec.py fuzzes iflame_codec against these; bench/codec_bench.py times them.
+"""
+
+
+def decode_control_byte(value):
+    """Decode the control byte into on/off and overhead light level."""
+    value = int(value)
+    on = value & 1
+    overhead = (value >> 4) & 7
+    return {"on": on, "overhead": overhead}
+
+def encode_control_byte(on, overhead):
+    """Encode on/off and overhead light level into control byte."""
+    return 128 + (overhead * 16) + (1 if on else 0)
+
+def decode_fan_flame_byte(value):
+    """Decode the fan/flame byte into split, fan, ember, flame."""
+    value = int(value)
+    split = (value >> 7) & 1
+    fan = (value >> 4) & 7
+    ember = (value >> 3) & 1
+    flame = value & 7
+    return {"split": split, "fan": fan, "ember": ember, "flame": flame}
+
+def encode_fan_flame_byte(split, fan, ember, flame):
+    """Encode split, fan, ember, flame into fan/flame byte."""
+    return (split * 128) + (fan * 16) + (ember * 8) + flame
+
+def parse_cmd_string(cmd):
+    """Parse a command string into all its components."""
+    parts = cmd.split(":") if cmd else []
+    if len(parts) == 6:
+        # Smart mode: 2:2:1:target_F:control_byte:fan_flame_byte
+        mode = "smart"
+        target_temp = int(parts[3])
+        ctrl = decode_control_byte(int(parts[4]))
+        ff = decode_fan_flame_byte(int(parts[5]))
+    elif len(parts) == 5:
+        # Simple mode: 2:0:1:control_byte:fan_flame_byte
+        mode = "simple"
+        ctrl = decode_control_byte(int(parts[3]))
+        ff = decode_fan_flame_byte(int(parts[4]))
+        target_temp = 0
+    else:
+        return {"mode": "unknown", "is_on": False, "target_temp": 0,
+                "overhead": 0, "fan": 0, "flame": 0, "ember": 0, "split": 0}
+
+    return {
+        "mode": mode,
+        "is_on": bool(ctrl["on"]),
+        "target_temp": target_temp,
+        "overhead": ctrl["overhead"],
+        "fan": ff["fan"],
+        "flame": ff["flame"],
+        "ember": ff["ember"],
+        "split": ff["split"],
+    }
+
+def build_cmd(mode, is_on, target_temp, overhead, fan, flame, ember, split):
+    """Build a complete command string from all parameters."""
+    ctrl_byte = encode_control_byte(is_on, overhead)
+    ff_byte = encode_fan_flame_byte(split, fan, ember, flame)
+    if mode == "smart":
+        return f"2:2:1:{target_temp}:{ctrl_byte}:{ff_byte}"
+    else:
+        return f"2:0:1:{ctrl_byte}:{ff_byte}"
+
+
+def random_cmd(rng):
+    """A command string as found in shadow history, with some malformed ones mixed in."""
+    kind = rng.random()
+    if kind < 0.05:
+        return rng.choice(["", "2:0:1", "2:0:1:192:34:1:9", "garbage"])
+    byte = lambda: rng.choice([rng.randrange(256), rng.randrange(-512, 4096)])
+    if kind < 0.5:
+        return f"2:0:1:{byte()}:{byte()}"
+    return f"2:2:1:{rng.randrange(40, 100)}:{byte()}:{byte()}"
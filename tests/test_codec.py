@@ -0,0 +1,65 @@
+"""Fuzz iflame_codec (single and batch) against the bridge's original codec functions."""
+import os, random, sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import iflame_codec as codec
+import codec_reference as ref
+
+N = 20000
+
+
+@pytest.fixture(params=["numpy", "pure"])
+def batch_codec(request, monkeypatch):
+    """The batch API both with NumPy (when installed) and on its pure-Python fallback."""
+    if request.param == "numpy" and codec.np is None:
+        pytest.skip("numpy not installed")
+    if request.param == "pure":
+        monkeypatch.setattr(codec, "np", None)
+    return codec
+
+
+def random_rows(rng, n):
+    return [(rng.choice(["simple", "smart"]), rng.random() < 0.5, rng.randrange(40, 100), rng.randrange(6),
+             rng.randrange(7), rng.randrange(7), rng.randrange(2), rng.randrange(2)) for _ in range(n)]
+
+
+def test_byte_tables_match_reference():
+    for v in range(-1024, 4096):
+        assert dict(zip(("on", "overhead"), codec.decode_control_byte(v))) == ref.decode_control_byte(v), v
+        assert dict(zip(("split", "fan", "ember", "flame"), codec.decode_fan_flame_byte(v))) == \
+            ref.decode_fan_flame_byte(v), v
+
+
+def test_decode_matches_reference():
+    rng = random.Random(0)
+    for _ in range(N):
+        cmd = ref.random_cmd(rng)
+        assert codec.decode(cmd)._asdict() == ref.parse_cmd_string(cmd), cmd
+
+
+def test_decode_columns_matches_reference(batch_codec):
+    rng = random.Random(1)
+    cmds = [ref.random_cmd(rng) for _ in range(N)]
+    cols = batch_codec.decode_columns(cmds)
+    for i, cmd in enumerate(cmds):
+        row = {f: (bool(cols[f][i]) if f == "is_on" else cols[f][i]) for f in codec.FIELDS}
+        assert row == ref.parse_cmd_string(cmd), cmd
+
+
+def test_encode_matches_reference():
+    for row in random_rows(random.Random(2), N):
+        assert codec.encode(*row) == ref.build_cmd(*row), row
+
+
+def test_encode_columns_matches_reference(batch_codec):
+    rows = random_rows(random.Random(3), N)
+    assert batch_codec.encode_columns(*zip(*rows)) == [ref.build_cmd(*row) for row in rows]
+
+
+def test_encode_decode_round_trip():
+    for row in random_rows(random.Random(4), N):
+        state = codec.decode(codec.encode(*row))
+        expected = (row[0], row[1], row[2] if row[0] == "smart" else 0) + row[3:]
+        assert tuple(state) == expected, row